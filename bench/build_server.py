@@ -0,0 +1,111 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Measures the latency of build server requests with many concurrent build
+clients, like Ninja running with a high number of parallel jobs. Every
+request is made on a new connection, just like every build client process
+connects to the server once.
+
+    $ python bench/build_server.py --clients 64 --requests 20000
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src',
+                                'craftr', 'stdlib', 'net.craftr.backend', 'ninja'))
+from craftr.core import protocol
+from craftr.core.build import BuildSet, Commands, Master, Operator, Target
+from build_server import BuildServer
+
+
+def make_master(num_targets, num_build_sets):
+  master = Master()
+  for i in range(num_targets):
+    target = master.add_target(Target(master, 'bench@target{}'.format(i)))
+    op = target.add_operator(Operator(master, 'compile#1',
+      Commands([['gcc', '-c', '$<src', '-o', '$@obj', '$flags']])))
+    op.variables['flags'] = ['-O2', '-g', '-Iinclude']
+    for j in range(num_build_sets):
+      bset = BuildSet(master, description='Compile $<src')
+      bset.add_input_files('src', ['/src/{}/{}.c'.format(i, j)])
+      bset.add_output_files('obj', ['/build/{}/{}.o'.format(i, j)])
+      op.add_build_set(bset)
+  return master
+
+
+def client(args):
+  address, requests = args
+  latencies = []
+  for target, index in requests:
+    tstart = time.perf_counter()
+    with protocol.connect(address) as sock:
+      protocol.request(sock, protocol.get_action_request(
+        'bench@target{}'.format(target), 'compile#1', index))
+    latencies.append(time.perf_counter() - tstart)
+  return latencies
+
+
+def percentile(values, p):
+  return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--clients', type=int, default=64)
+  parser.add_argument('--requests', type=int, default=20000)
+  parser.add_argument('--targets', type=int, default=100)
+  parser.add_argument('--build-sets', type=int, default=50)
+  parser.add_argument('--transport', choices=['unix', 'tcp'])
+  parser.add_argument('--precompute', action='store_true')
+  args = parser.parse_args(argv)
+
+  master = make_master(args.targets, args.build_sets)
+  requests = [(i % args.targets, (i // args.targets) % args.build_sets)
+              for i in range(args.requests)]
+  chunks = [requests[i::args.clients] for i in range(args.clients)]
+
+  # Fork the clients before the server thread is started.
+  with multiprocessing.Pool(args.clients) as pool:
+    with BuildServer(master, transport=args.transport) as server:
+      if args.precompute:
+        server.precompute()
+      tstart = time.perf_counter()
+      results = pool.map(client, [(server.address(), x) for x in chunks])
+      elapsed = time.perf_counter() - tstart
+
+  latencies = sorted(x for r in results for x in r)
+  print('address:     {}'.format(server.address()))
+  print('requests:    {} from {} clients in {:.3f}s ({:.0f} req/s)'.format(
+    len(latencies), args.clients, elapsed, len(latencies) / elapsed))
+  for p in (0.5, 0.9, 0.99):
+    print('p{:<10} {:.3f} ms'.format(int(p * 100), percentile(latencies, p) * 1000))
+
+
+if __name__ == '__main__':
+  main()
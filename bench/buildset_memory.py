@@ -0,0 +1,104 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Measures the memory used per #BuildSet for a synthetic C-like build graph,
+once when the graph is constructed and once when it is loaded from a JSON
+graph file. Every target has a number of compile build sets (one source
+and one object file each) and a link build set that consumes all of the
+object files of the target.
+
+    $ python bench/buildset_memory.py --targets 100 --sources 1000
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from craftr.core.build import BuildSet, Commands, Master, Operator, Target
+
+
+def build_graph(master, num_targets, num_sources, root):
+  compile_commands = Commands([['gcc', '-c', '$<src', '-o', '$@obj', '$cflags']])
+  link_commands = Commands([['gcc', '-o', '$@bin', '$<obj']])
+  for i in range(num_targets):
+    target = master.add_target(Target(master, 'project@target{}'.format(i)))
+    src_dir = os.path.join(root, 'project', 'target{}'.format(i), 'src')
+    obj_dir = os.path.join(root, 'build', 'debug', 'project', 'target{}'.format(i), 'obj')
+    op = target.add_operator(Operator(master, 'cxx.compileC#1', compile_commands))
+    op.variables['cflags'] = ['-g', '-O0']
+    objects = []
+    for j in range(num_sources):
+      bset = BuildSet(master)
+      bset.add_input_files('src', [os.path.join(src_dir, 'file{}.c'.format(j))])
+      objects += bset.add_output_files('obj', [os.path.join(obj_dir, 'file{}.o'.format(j))])
+      op.add_build_set(bset)
+    op = target.add_operator(Operator(master, 'cxx.link#1', link_commands))
+    bset = BuildSet(master)
+    bset.add_input_files('obj', objects)
+    bset.add_output_files('bin', [os.path.join(obj_dir, '..', 'target{}'.format(i))])
+    op.add_build_set(bset)
+
+
+def measure(func):
+  gc.collect()
+  tracemalloc.start()
+  result = func()
+  gc.collect()
+  size = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return result, size
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--targets', type=int, default=100)
+  parser.add_argument('--sources', type=int, default=1000)
+  args = parser.parse_args(argv)
+
+  num_build_sets = args.targets * (args.sources + 1)
+  root = os.path.abspath(os.sep)
+  master = Master()
+  _, size = measure(lambda: build_graph(master, args.targets, args.sources, root))
+  print('construct: {} build sets, {:.1f} bytes per build set'.format(
+    num_build_sets, size / num_build_sets))
+
+  with tempfile.TemporaryDirectory() as tmp:
+    filename = os.path.join(tmp, 'graph.json')
+    master.save(filename)
+    del master
+    def load():
+      loaded = Master()
+      loaded.load(filename)
+      loaded.load_all()
+      return loaded
+    loaded, size = measure(load)
+    print('load:      {} build sets, {:.1f} bytes per build set'.format(
+      num_build_sets, size / num_build_sets))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,102 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Measures the time to write a synthetic Ninja file with the #ninja_syntax
+writer, in the way the Ninja backend exports build sets: one edge with its
+variables per build set, plus a few link steps with thousands of inputs.
+Pass `--reference` to compare against another version of `ninja_syntax.py`,
+for example the one distributed with Ninja.
+
+    $ python bench/ninja_writer.py --edges 500000
+    $ python bench/ninja_writer.py --reference /path/to/ninja/misc/ninja_syntax.py
+"""
+
+import argparse
+import importlib.util
+import io
+import os
+import time
+
+NINJA_DIR = os.path.join(os.path.dirname(__file__), '..', 'src', 'craftr',
+                         'stdlib', 'net.craftr.backend', 'ninja')
+COMMAND = '$python /craftr/action_client.py --index $action_index $target $operator $index $hash'
+
+
+def load_module(name, filename):
+  spec = importlib.util.spec_from_file_location(name, filename)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def export(module, fp, args):
+  writer = module.Writer(fp, width=9000)
+  writer.variable('builddir', '/build')
+  for i in range(args.edges // 1000 + 1):
+    writer.rule('rule_bench_target{}_compile_1'.format(i), COMMAND,
+                description='$build_description', depfile='$build_depfile', deps='gcc')
+  for i in range(args.edges):
+    rule = 'rule_bench_target{}_compile_1'.format(i // 1000)
+    writer.build(['/build/obj dir/{}/{}.o'.format(i // 1000, i)], rule,
+                 ['/src/{}/{}.c'.format(i // 1000, i)], order_only=[],
+                 variables={'target': 'bench@target{}'.format(i // 1000),
+                            'operator': 'compile#1', 'index': str(i % 1000),
+                            'hash': '{:040x}'.format(i),
+                            'build_description': 'Compile /src/{}.c'.format(i),
+                            'build_depfile': '/build/{}.o.d'.format(i)})
+  objects = ['/build/obj dir/{}/{}.o'.format(i // 1000, i) for i in range(args.edges)]
+  for i in range(args.links):
+    writer.build(['/build/app{}'.format(i)], 'rule_link', objects[:args.link_inputs],
+                 variables={'build_description': 'Link app{}'.format(i)})
+  if hasattr(writer, 'flush'):
+    writer.flush()
+
+
+def bench(name, module, args):
+  fp = io.StringIO()
+  tstart = time.perf_counter()
+  export(module, fp, args)
+  elapsed = time.perf_counter() - tstart
+  size = len(fp.getvalue())
+  print('{:<12} {:>8.3f}s  {:>8.1f} MB  {:>8.1f} MB/s'.format(
+    name, elapsed, size / 1e6, size / 1e6 / elapsed))
+  return fp.getvalue()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--edges', type=int, default=500000)
+  parser.add_argument('--links', type=int, default=10)
+  parser.add_argument('--link-inputs', type=int, default=20000)
+  parser.add_argument('--reference', help='another ninja_syntax.py to compare with')
+  args = parser.parse_args(argv)
+
+  output = bench('ninja_syntax', load_module('ninja_syntax', os.path.join(NINJA_DIR, 'ninja_syntax.py')), args)
+  if args.reference:
+    expected = bench('reference', load_module('reference', args.reference), args)
+    print('identical output: {}'.format(output == expected))
+
+
+if __name__ == '__main__':
+  main()
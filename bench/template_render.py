@@ -0,0 +1,89 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Measures the time to compile and render templates with and without the
+template cache, the generic and the generated render functions, and the
+time to render the description of a build set.
+
+    $ python bench/template_render.py --count 1000000
+"""
+
+import argparse
+import os
+import shlex
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from nr.collections import ChainDict
+from craftr.core.build import BuildSet, Commands, Master, Operator, Target
+from craftr.core.template import TemplateCompiler
+
+DESCRIPTION = 'Compile $<src -> $@obj ($flags)'
+
+
+def bench(name, count, func):
+  tstart = time.perf_counter()
+  for _ in range(count):
+    func()
+  elapsed = time.perf_counter() - tstart
+  print('{:<28} {:>8.3f}s  {:>8.0f} ns/render'.format(name, elapsed, elapsed / count * 1e9))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--count', type=int, default=1000000)
+  args = parser.parse_args(argv)
+
+  master = Master()
+  target = master.add_target(Target(master, 'bench@main'))
+  op = target.add_operator(Operator(master, 'compile#1',
+    Commands([['gcc', '-c', '$<src', '-o', '$@obj', '$flags']])))
+  op.variables['flags'] = ['-O2', '-g']
+  bset = BuildSet(master, description=DESCRIPTION)
+  bset.add_input_files('src', ['/src/main.c'])
+  bset.add_output_files('obj', ['/build/main.o'])
+  op.add_build_set(bset)
+  inputs, outputs, variables = bset.inputs, bset.outputs, op.variables
+
+  command = ['gcc', '-c', '$<src', '-o', '$@obj', '$flags']
+  compile_uncached = lambda x: [TemplateCompiler._compile(y) for y in x]
+  render_generic = lambda templates, variables: \
+      [y for t in templates for y in t._render_generic(inputs, outputs, variables)]
+  bench('compile+render (uncached)', args.count,
+        lambda: render_generic(compile_uncached(command), variables))
+  cached = TemplateCompiler().compile_list(command)
+  bench('render (generic)', args.count,
+        lambda: render_generic(cached._templates, variables))
+  bench('render (generated)', args.count,
+        lambda: cached.render(inputs, outputs, variables))
+
+  # This is how get_description() compiled the description for every call.
+  variables = ChainDict({}, op.variables)
+  bench('description (uncached)', args.count,
+        lambda: ' '.join(render_generic(compile_uncached(shlex.split(DESCRIPTION)), variables)))
+  bench('get_description()', args.count, bset.get_description)
+
+
+if __name__ == '__main__':
+  main()
@@ -124,7 +124,9 @@ class Session(_build.Master):
     self._build_directory = nr.fs.canonical(build_directory)
     self._build_variant = build_variant
     self._current_scopes = []
-    self.graph_filename = nr.fs.join(build_root, 'craftr_graph.{}.json'.format(build_variant))
+    self.graph_format = 'json'
+    self.graph_sharded = False
+    self.changed_shards = None  # Set by save() if graph_sharded is enabled
     self.cli_options = cli_options
     self.options = {}
     self.loader = CraftrModuleLoader(self)
@@ -139,6 +141,7 @@ class Session(_build.Master):
     self.os_info = OsInfo.new()
     self.build_info = BuildInfo(self._build_variant)
     self.main_module = None
+    self.build_server = None  # Set by the daemon, see craftr.daemon
     Target.init_properties(self.target_props)
 
   def add_module_search_path(self, path):
@@ -244,34 +247,82 @@ class Session(_build.Master):
       return self._current_scopes[-1].current_target
     return None
 
-  def reload(self):
-    super().__init__()
-    self.load()
+  GRAPH_SUFFIXES = {'json': '.json', 'binary': '.bin', 'sharded': '.manifest'}
+
+  def get_graph_filename(self, format=None, sharded=None):
+    """
+    Returns the filename of the serialized build graph in the specified
+    *format*. Defaults to the #graph_format of the session. For a sharded
+    graph, this is the filename of the manifest.
+    """
+
+    if sharded is None:
+      sharded = self.graph_sharded
+    suffix = self.GRAPH_SUFFIXES['sharded' if sharded else (format or self.graph_format)]
+    return nr.fs.join(self._build_root, 'craftr_graph.{}{}'.format(
+      self._build_variant, suffix))
+
+  @property
+  def graph_filename(self):
+    return self.get_graph_filename()
+
+  def find_graph_filename(self):
+    """
+    Returns the filename of the most recently saved build graph, in any
+    format. If no graph file exists, the #graph_filename is returned.
+    """
+
+    candidates = [self.get_graph_filename(x, x == 'sharded') for x in self.GRAPH_SUFFIXES]
+    candidates = [x for x in candidates if nr.fs.isfile(x)]
+    if not candidates:
+      return self.graph_filename
+    return max(candidates, key=nr.fs.getmtime)
+
+  def reload(self, filename=None):
+    if not filename:
+      filename = self.find_graph_filename()
+    return super().reload(filename)
 
   # Master overrides
 
+  def get_metadata(self):
+    result = super().get_metadata()
+    result.update({'variant': self._build_variant, 'main_module': self.main_module})
+    return result
+
+  def load_metadata(self, metadata):
+    super().load_metadata(metadata)
+    self._build_variant = metadata['variant']
+    self.main_module = metadata['main_module']
+
   def to_json(self):
-    return {'variant': self._build_variant, 'main_module': self.main_module,
-            'data': super().to_json()}
+    result = self.get_metadata()
+    result['data'] = super().to_json()
+    return result
+
+  def unpack_json(self, data):
+    return data, data['data']
 
   def load_json(self, data):
-    self._build_variant = data['variant']
-    self.main_module = data['main_module']
+    self.load_metadata(data)
     super().load_json(data['data'])
 
   def add_target(self, target):
     target.scope.targets[target.name] = target
     return super().add_target(target)
 
-  def save(self, filename=None):
+  def save(self, filename=None, format=None, sharded=None):
+    format = format or self.graph_format
+    if sharded is None:
+      sharded = self.graph_sharded
     if not filename:
-      filename = self.graph_filename
+      filename = self.get_graph_filename(format, sharded)
     nr.fs.makedirs(nr.fs.dir(filename))
-    super().save(filename)
+    self.changed_shards = super().save(filename, format, sharded)
 
   def load(self, filename=None):
     if not filename:
-      filename = self.graph_filename
+      filename = self.find_graph_filename()
     super().load(filename)
 
 
@@ -327,6 +378,10 @@ class Target(_build.Target):
     def path_get_parent_dir(self):
       return self._target.directory
 
+    @nr.interface.override
+    def path_canonicalize(self, paths, parent_dir):
+      return self._target.master.canonicalize_paths(paths, parent_dir)
+
   def __init__(self, name: str, scope:Scope):
     super().__init__(session, '{}@{}'.format(scope.name, name))
     self.name = name
@@ -502,15 +557,20 @@ class Operator(_build.Operator):
   to be passed explicitly.
   """
 
+  __slots__ = ()
+
   def __init__(self, *args, **kwargs):
     super().__init__(session, *args, **kwargs)
 
 
 class BuildSet(_build.BuildSet):
 
+  __slots__ = ()
+
   def __init__(self, inputs, outputs, variables=None, *args, **kwargs):
     super().__init__(session, *args, **kwargs)
-    self.variables.update(variables or {})
+    if variables:
+      self.variables.update(variables)
     for set_name, files in inputs.items():
       if isinstance(files, str):
         files = [files]
@@ -604,7 +664,8 @@ __all__ += [
   'depends',
   'properties',
   'operator',
-  'build_set'
+  'build_set',
+  'pool'
 ]
 
 
@@ -860,7 +921,7 @@ def properties(*args, target=None, **kwarg_props):
       target[c_key] = value
 
 
-def operator(name, commands, variables=None, target=None, bind=None, **kwargs):
+def operator(name, commands, variables=None, target=None, bind=None, pool=None, **kwargs):
   """
   Creates a new #Operator in the current target and returns it. This is not
   usually called from a project build script but modules that implement new
@@ -872,6 +933,9 @@ def operator(name, commands, variables=None, target=None, bind=None, **kwargs):
   If *target* is specified, the function is assumed to be used independently
   from the current target's context and is therefore not bound to the current
   target or the specified one.
+
+  The build sets of the operator run in the specified *pool*, which must be
+  declared with #pool() before the build graph is exported.
   """
 
   if target is None:
@@ -888,7 +952,7 @@ def operator(name, commands, variables=None, target=None, bind=None, **kwargs):
     target._operator_name_counter[name] = count + 1
     name += '#' + str(count)
 
-  op = target.add_operator(Operator(name, commands, **kwargs))
+  op = target.add_operator(Operator(name, commands, pool=pool, **kwargs))
   op.variables.update(variables or {})
   bind_operator(op)
   return op
@@ -908,6 +972,29 @@ def build_set(*args, operator=None, **kwargs):
   return bset
 
 
+def pool(name, depth):
+  """
+  Declares a pool in which at most *depth* build sets run in parallel and
+  returns the depth. Operators are assigned to the pool with the *pool*
+  argument of #operator(). The `pool:<name>` option overrides the depth,
+  for example `-Opool:link=4` on the command-line or in the configuration:
+
+  ```toml
+  [pool]
+  link = 4
+  ```
+  """
+
+  value = session.options.get('pool:' + name)
+  if value is not None:
+    try:
+      depth = int(value)
+    except ValueError:
+      raise ValueError('invalid depth for pool {!r}: {!r}'.format(name, value))
+  session.declare_pool(name, depth)
+  return depth
+
+
 # Utilities
 # =========
 
@@ -82,6 +82,15 @@ class PropType:
     """
     raise NotImplementedError
 
+  def coerce_list(self, name, values, owner=None):
+    """
+    Coerces a list of *values*, eg. the items of a #List property. Types that
+    can process many values more efficiently at once can override this method.
+    """
+
+    return [self.coerce(name + '[' + str(i) + ']', x, owner)
+            for i, x in enumerate(values)]
+
   def default(self):
     raise NotImplementedError
 
@@ -161,23 +170,37 @@ class Path(String):
   class OwnerInterface(nr.interface.Interface):
     def path_get_parent_dir(self):
       raise NotImplementedError
+    def path_canonicalize(self, paths, parent_dir):
+      """
+      Return the canonical versions of the list of *paths*, relative to
+      *parent_dir*. Allows the owner to cache canonicalized paths.
+      """
+      raise NotImplementedError
 
   def __init__(self, parent_dir_getter=None):
     self.parent_dir_getter = parent_dir_getter
 
   def coerce(self, name, value, owner=None):
-    if self.parent_dir_getter:
-      parent_dir = self.parent_dir_getter(owner)
-    else:
-      if owner is None:
-        raise RuntimeError('Path.coerce(): no owner object received')
-      if not Path.OwnerInterface.provided_by(owner):
-        raise RuntimeError('Path.coerce(): owner (type "{}") does not '
-                           'implement Path.OwnerInterface'.format(
-                             type(owner).__name__))
-      parent_dir = owner.path_get_parent_dir()
     value = super().coerce(name, value, owner)
-    return path.canonical(value, path.abs(parent_dir))
+    return self._canonicalize([value], owner)[0]
+
+  def coerce_list(self, name, values, owner=None):
+    values = [super(Path, self).coerce(name + '[' + str(i) + ']', x, owner)
+              for i, x in enumerate(values)]
+    return self._canonicalize(values, owner)
+
+  def _canonicalize(self, values, owner):
+    if self.parent_dir_getter:
+      parent_dir = path.abs(self.parent_dir_getter(owner))
+      return [path.canonical(x, parent_dir) for x in values]
+    if owner is None:
+      raise RuntimeError('Path.coerce(): no owner object received')
+    if not Path.OwnerInterface.provided_by(owner):
+      raise RuntimeError('Path.coerce(): owner (type "{}") does not '
+                         'implement Path.OwnerInterface'.format(
+                           type(owner).__name__))
+    parent_dir = path.abs(owner.path_get_parent_dir())
+    return owner.path_canonicalize(values, parent_dir)
 
 
 class List(PropType, metaclass=GenericMeta):
@@ -198,8 +221,7 @@ class List(PropType, metaclass=GenericMeta):
     elif not isinstance(value, list):
       raise self.typeerror(name, 'list', value)
     if self.item_type:
-      value = [self.item_type.coerce(name + '[' + str(i) + ']', x, owner)
-               for i, x in enumerate(value)]
+      value = self.item_type.coerce_list(name, value, owner)
     return value
 
   def default(self):
@@ -0,0 +1,483 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+A local cache of the outputs of build sets, so that a build set that was
+built before with the same commands and inputs does not need to be run
+again, for example after switching between branches.
+
+An action is identified by the hash of its build set and the content
+digests of its input files (see #ActionCache.action_key()). The cache
+stores the output files of an action by their digest in a content-addressed
+directory, together with the output of its commands and the digests of the
+dependencies that were discovered when it was run. An action can only be
+restored if these dependencies did not change.
+
+The cache directory contains an SQLite database with the actions, the
+stored files and the digests of the input files (a #DigestStore for the
+#DigestCache of the cache), and the stored files in the `cas/`
+subdirectory. Files are stored and restored as reflinks (copy-on-write
+clones) where the filesystem supports it and copied otherwise. With
+*hardlinks*, they are hard-linked instead, which is faster but allows a
+command that modifies its output in place to modify the cached file. When
+the stored files exceed the size limit, the least recently used files are
+evicted.
+
+The cache is shared by concurrent processes, like the build clients that
+Ninja runs. It is configured by the following environment variables (see
+#ActionCache.from_environ()):
+
+* `CRAFTR_ACTION_CACHE`: The cache directory. The cache is disabled if it
+  is not set.
+* `CRAFTR_ACTION_CACHE_SIZE`: The size limit in bytes, optionally with a
+  `K`, `M` or `G` suffix. Defaults to #DEFAULT_MAX_SIZE.
+* `CRAFTR_ACTION_CACHE_HARDLINKS`: Set to `true` to use hard links.
+
+Like #protocol, this module depends only on the standard library.
+"""
+
+__all__ = ['ActionCache', 'CacheEntry', 'format_hit_rate', 'parse_size', 'run_cached']
+
+import collections
+import errno
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from craftr.core.digests import DigestCache, DigestStore
+from typing import Dict, Iterable, List, Optional
+
+VERSION = 1
+
+#: The default size limit of the stored files.
+DEFAULT_MAX_SIZE = 5 << 30
+
+#: When the size limit is exceeded, files are evicted until the size is
+#: below this fraction of the limit.
+EVICTION_TARGET = 0.9
+
+SCHEMA = '''
+CREATE TABLE actions (
+  key TEXT PRIMARY KEY,
+  outputs TEXT NOT NULL,
+  deps TEXT NOT NULL,
+  output BLOB NOT NULL,
+  duration REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE blobs (
+  digest TEXT PRIMARY KEY,
+  size INTEGER NOT NULL,
+  last_used REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX blobs_last_used ON blobs (last_used);
+CREATE TABLE files (
+  path TEXT PRIMARY KEY,
+  size INTEGER NOT NULL,
+  mtime_ns INTEGER NOT NULL,
+  ino INTEGER NOT NULL,
+  digest TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID;
+INSERT INTO stats VALUES ('hits', 0), ('misses', 0), ('size', 0);
+'''
+
+#: A cached action. *outputs* and *deps* map the output files and the
+#: discovered dependencies to their digests, *output* is the output of
+#: the commands (bytes) and *duration* the time it took to run them.
+CacheEntry = collections.namedtuple('CacheEntry', 'outputs deps output duration')
+
+_FICLONE = 0x40049409
+
+
+def parse_size(value: str) -> int:
+  """
+  Parses a size in bytes with an optional `K`, `M` or `G` suffix.
+  """
+
+  value = value.strip().upper()
+  for i, suffix in enumerate('KMG'):
+    if value.endswith(suffix):
+      return int(float(value[:-1]) * (1 << (10 * (i + 1))))
+  return int(value)
+
+
+def format_hit_rate(hits: int, misses: int) -> str:
+  """
+  Formats the number of *hits* and *misses* of a build for the user.
+  """
+
+  total = hits + misses
+  return 'action cache: {} of {} build sets restored ({:.0f}%)'.format(
+    hits, total, 100.0 * hits / total if total else 0)
+
+
+def _reflink(src, dst):
+  """
+  Creates *dst* as a copy-on-write clone of *src*. Returns #False if the
+  platform or filesystem does not support it.
+  """
+
+  if not sys.platform.startswith('linux'):
+    return False
+  import fcntl
+  with open(src, 'rb') as fsrc:
+    with open(dst, 'wb') as fdst:
+      try:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+      except OSError:
+        pass
+      else:
+        return True
+  os.remove(dst)
+  return False
+
+
+class _FileDigests(DigestStore):
+  """
+  Stores the digests of the files in the `files` table of the cache, where
+  they are shared with the other processes that use the cache.
+  """
+
+  def __init__(self, conn):
+    self._conn = conn
+
+  def load_digests(self, filenames):
+    result = {}
+    for i in range(0, len(filenames), 500):
+      chunk = filenames[i:i+500]
+      query = 'SELECT path, size, mtime_ns, ino, digest FROM files WHERE path IN ({})'
+      for row in self._conn.execute(query.format(','.join('?' * len(chunk))), chunk):
+        result[row[0]] = tuple(row[1:])
+    return result
+
+  def store_digests(self, entries):
+    with self._conn:
+      self._conn.executemany('DELETE FROM files WHERE path = ?',
+        ((k,) for k, v in entries.items() if v is None))
+      self._conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+        ((k,) + v for k, v in entries.items() if v is not None))
+
+
+class ActionCache:
+  """
+  The action cache in the *directory*. The stored files are limited to
+  *max_size* bytes. With *hardlinks*, files are hard-linked into and out
+  of the cache.
+
+  The number of hits and misses of #restore() are counted in #hits and
+  #misses, and in the cache database for all processes (see #stats()).
+  """
+
+  def __init__(self, directory: str, max_size: int = DEFAULT_MAX_SIZE,
+               hardlinks: bool = False):
+    self.directory = directory
+    self.max_size = max_size
+    self.hardlinks = hardlinks
+    self.hits = 0
+    self.misses = 0
+    os.makedirs(os.path.join(directory, 'cas'), exist_ok=True)
+    self._conn = sqlite3.connect(os.path.join(directory, 'cache.db'), timeout=60)
+    self._conn.execute('PRAGMA journal_mode=WAL')
+    self._conn.execute('PRAGMA synchronous=NORMAL')
+    if self._conn.execute('PRAGMA user_version').fetchone()[0] != VERSION:
+      with self._conn:
+        self._conn.execute('BEGIN IMMEDIATE')
+        # Check again, another process may have created the tables.
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] != VERSION:
+          for (name,) in self._conn.execute(
+              "SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+            self._conn.execute('DROP TABLE {}'.format(name))
+          for statement in SCHEMA.split(';'):
+            if statement.strip():
+              self._conn.execute(statement)
+          self._conn.execute('PRAGMA user_version = {}'.format(VERSION))
+    self._digest_cache = DigestCache(store=_FileDigests(self._conn))
+
+  @classmethod
+  def from_environ(cls, environ=None) -> Optional['ActionCache']:
+    """
+    Creates the #ActionCache that is configured by the environment
+    variables, or returns #None if the cache is not enabled.
+    """
+
+    if environ is None:
+      environ = os.environ
+    directory = environ.get('CRAFTR_ACTION_CACHE')
+    if not directory:
+      return None
+    size = environ.get('CRAFTR_ACTION_CACHE_SIZE')
+    return cls(directory, parse_size(size) if size else DEFAULT_MAX_SIZE,
+               environ.get('CRAFTR_ACTION_CACHE_HARDLINKS') == 'true')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if self._conn is not None:
+      self._conn.close()
+      self._conn = None
+
+  def _blob_path(self, digest):
+    return os.path.join(self.directory, 'cas', digest[:2], digest[2:])
+
+  def digests(self, filenames: Iterable[str]) -> Dict[str, Optional[str]]:
+    """
+    Returns the content digests of the files, or #None for files that do
+    not exist (see #DigestCache.digests()).
+    """
+
+    return self._digest_cache.digests(filenames)
+
+  def action_key(self, hash: str, inputs: Iterable[str]) -> Optional[str]:
+    """
+    Returns the key of the action with the build set *hash* and the input
+    files *inputs*, or #None if an input file does not exist.
+    """
+
+    inputs = list(inputs)
+    digests = self.digests(inputs)
+    if any(digests[x] is None for x in inputs):
+      return None
+    data = json.dumps([VERSION, hash, [[x, digests[x]] for x in inputs]])
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+  def _count(self, name):
+    with self._conn:
+      self._conn.execute('UPDATE stats SET value = value + 1 WHERE name = ?', (name,))
+
+  def lookup(self, key: str) -> Optional[CacheEntry]:
+    """
+    Returns the #CacheEntry of the action with the specified *key*, or
+    #None if it is not in the cache.
+    """
+
+    row = self._conn.execute('SELECT outputs, deps, output, duration FROM actions '
+                             'WHERE key = ?', (key,)).fetchone()
+    if row is None:
+      return None
+    return CacheEntry(json.loads(row[0]), json.loads(row[1]), row[2], row[3])
+
+  def restore(self, key: str, outputs: List[str]) -> Optional[CacheEntry]:
+    """
+    Restores the *outputs* of the action with the specified *key* from the
+    cache. Returns the #CacheEntry, or #None if the action is not in the
+    cache, produced other outputs, its discovered dependencies changed or
+    one of its files has been evicted. Output files may have been replaced
+    even if the action could not be restored.
+    """
+
+    entry = self.lookup(key)
+    if entry is not None and sorted(entry.outputs) != sorted(outputs):
+      entry = None
+    if entry is not None:
+      digests = self.digests(entry.deps)
+      if any(digests[k] != v for k, v in entry.deps.items()):
+        entry = None
+    if entry is not None:
+      try:
+        for filename, digest in entry.outputs.items():
+          self._restore_file(self._blob_path(digest), filename)
+      except FileNotFoundError:
+        with self._conn:
+          self._conn.execute('DELETE FROM actions WHERE key = ?', (key,))
+        entry = None
+    if entry is None:
+      self.misses += 1
+      self._count('misses')
+      return None
+    with self._conn:
+      self._conn.executemany('UPDATE blobs SET last_used = ? WHERE digest = ?',
+                             ((time.time(), x) for x in set(entry.outputs.values())))
+      self._conn.execute("UPDATE stats SET value = value + 1 WHERE name = 'hits'")
+    self.hits += 1
+    return entry
+
+  def _restore_file(self, blob, filename):
+    if os.path.lexists(filename):
+      os.remove(filename)
+    else:
+      os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    if self.hardlinks:
+      try:
+        os.link(blob, filename)
+      except OSError as exc:
+        if exc.errno == errno.ENOENT:
+          raise
+      else:
+        # The restored file must be newer than the inputs of the action.
+        os.utime(filename)
+        return
+    if not _reflink(blob, filename):
+      shutil.copyfile(blob, filename)
+    shutil.copymode(blob, filename)
+    os.chmod(filename, os.stat(filename).st_mode | 0o200)
+
+  def _store_file(self, filename, digest):
+    blob = self._blob_path(digest)
+    if os.path.exists(blob):
+      return 0
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(blob))
+    os.close(fd)
+    os.remove(tmp)
+    try:
+      linked = False
+      if self.hardlinks:
+        try:
+          os.link(filename, tmp)
+          linked = True
+        except OSError:
+          pass
+      if not linked:
+        if not _reflink(filename, tmp):
+          shutil.copyfile(filename, tmp)
+        shutil.copymode(filename, tmp)
+        os.chmod(tmp, os.stat(tmp).st_mode & ~0o222)
+      os.replace(tmp, blob)
+    except BaseException:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+      raise
+    return os.path.getsize(blob)
+
+  def store(self, key: str, outputs: List[str], deps: Iterable[str] = (),
+            output: bytes = b'', duration: float = 0.0):
+    """
+    Stores the *outputs* of the action with the specified *key*, with the
+    discovered dependencies *deps* and the *output* of its commands.
+    Nothing is stored if an output or a dependency does not exist.
+    """
+
+    outputs = self.digests(outputs)
+    deps = self.digests(deps)
+    if any(x is None for x in outputs.values()) or any(x is None for x in deps.values()):
+      return
+    now = time.time()
+    blobs = []
+    for filename, digest in outputs.items():
+      blobs.append((digest, self._store_file(filename, digest), now))
+    with self._conn:
+      for digest, size, now in blobs:
+        cursor = self._conn.execute('UPDATE blobs SET last_used = ? WHERE digest = ?', (now, digest))
+        if cursor.rowcount == 0:
+          if size == 0:
+            size = os.path.getsize(self._blob_path(digest))
+          self._conn.execute('INSERT INTO blobs VALUES (?, ?, ?)', (digest, size, now))
+          self._conn.execute("UPDATE stats SET value = value + ? WHERE name = 'size'", (size,))
+      self._conn.execute('INSERT OR REPLACE INTO actions VALUES (?, ?, ?, ?, ?)',
+        (key, json.dumps(outputs), json.dumps(deps), bytes(output), duration))
+    if self.size() > self.max_size:
+      self.evict()
+
+  def size(self) -> int:
+    """
+    Returns the total size of the stored files.
+    """
+
+    return self._conn.execute("SELECT value FROM stats WHERE name = 'size'").fetchone()[0]
+
+  def stats(self) -> Dict[str, int]:
+    """
+    Returns the total number of `hits` and `misses` of all processes that
+    used the cache, and its `size`.
+    """
+
+    return dict(self._conn.execute('SELECT name, value FROM stats'))
+
+  def evict(self, target: int = None):
+    """
+    Removes the least recently used files until the stored files are
+    smaller than *target* bytes, which defaults to the #EVICTION_TARGET
+    fraction of the size limit. Actions whose files are removed are
+    restored no more.
+    """
+
+    if target is None:
+      target = int(self.max_size * EVICTION_TARGET)
+    removed = []
+    with self._conn:
+      self._conn.execute('BEGIN IMMEDIATE')
+      size = self.size()
+      for digest, blob_size in self._conn.execute(
+          'SELECT digest, size FROM blobs ORDER BY last_used').fetchall():
+        if size <= target:
+          break
+        removed.append(digest)
+        size -= blob_size
+      self._conn.executemany('DELETE FROM blobs WHERE digest = ?', ((x,) for x in removed))
+      self._conn.execute("UPDATE stats SET value = ? WHERE name = 'size'", (size,))
+    for digest in removed:
+      try:
+        os.remove(self._blob_path(digest))
+      except FileNotFoundError:
+        pass
+
+
+def run_cached(cache: ActionCache, action, run) -> int:
+  """
+  Restores the outputs of the #protocol.Action *action* from the *cache*
+  and writes the stored output of its commands to stdout. If it is not in
+  the cache, *run* is called with a `bytearray` to which it must append the
+  output of the commands, and must return their exit code. The outputs of
+  the action are stored if the commands succeed. The working directory of
+  the action must be the current directory.
+  """
+
+  from craftr.core.depslog import parse_depfile, parse_show_includes
+
+  outputs = list(action.outputs)
+  depfile = os.path.abspath(action.depfile) if action.depfile else None
+  if depfile and depfile not in outputs:
+    # The depfile is restored with the outputs so that Ninja can read it.
+    outputs.append(depfile)
+
+  key = cache.action_key(action.hash, action.inputs)
+  if key is not None:
+    entry = cache.restore(key, outputs)
+    if entry is not None:
+      sys.stdout.buffer.write(entry.output)
+      sys.stdout.flush()
+      return 0
+
+  output = bytearray()
+  tstart = time.perf_counter()
+  code = run(output)
+  if code == 0 and key is not None:
+    if action.deps_prefix:
+      deps = parse_show_includes(output.decode('utf8', 'replace'), action.deps_prefix)[0]
+    elif depfile and os.path.isfile(depfile):
+      with open(depfile) as fp:
+        deps = parse_depfile(fp.read())
+    else:
+      deps = []
+    deps = [os.path.abspath(x) for x in deps]
+    cache.store(key, outputs, deps, bytes(output), time.perf_counter() - tstart)
+  return code
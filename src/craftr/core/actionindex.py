@@ -0,0 +1,150 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The action index is a file that maps the build sets of a graph, identified
+by the target ID, the operator name and the index of the build set, to
+their rendered #protocol.Action. It is written when the build files are
+exported, so that the build client can look up the commands of a build
+set without asking the build server.
+
+The file is memory-mapped by the #ActionIndex and looked up with a binary
+search. All integers are little-endian, except for the build set index in
+the keys, which is big-endian so that keys sort in numerical order.
+
+* The header: the #MAGIC bytes, the format version (u32) and the number of
+  records (u32).
+* The records, sorted by their key: the offset of the key (u64), the size
+  of the key (u32) and the size of the value (u32). The value follows the
+  key in the file.
+* The keys and values. A key is the UTF-8 encoded target ID and operator
+  name, each terminated by a zero byte, and the build set index (u32). The
+  value is the action encoded with #protocol.encode_action().
+
+Like #protocol, this module depends only on the standard library.
+"""
+
+__all__ = ['MAGIC', 'ActionIndex', 'write']
+
+import mmap
+import os
+import struct
+
+from craftr.core import protocol
+from typing import Iterable, Optional, Tuple
+
+MAGIC = b'CRAFTRAX'
+VERSION = 2
+
+_header = struct.Struct('<8sII')
+_record = struct.Struct('<QII')
+_index = struct.Struct('>I')
+
+
+def make_key(target: str, operator: str, build_set: int) -> bytes:
+  return b''.join([target.encode('utf8'), b'\0', operator.encode('utf8'),
+                   b'\0', _index.pack(build_set)])
+
+
+def write(filename: str, actions: Iterable[Tuple[str, str, int, protocol.Action]]):
+  """
+  Writes an action index with the *actions* to *filename*. Every item is a
+  tuple of the target ID, the operator name, the build set index and the
+  #protocol.Action. The file is replaced atomically, so that a concurrent
+  reader sees either the old or the new index.
+  """
+
+  items = sorted((make_key(t, o, i), protocol.encode_action(a)) for t, o, i, a in actions)
+  offset = _header.size + _record.size * len(items)
+  records = []
+  for key, value in items:
+    records.append(_record.pack(offset, len(key), len(value)))
+    offset += len(key) + len(value)
+
+  tmp = filename + '.tmp'
+  with open(tmp, 'wb') as fp:
+    fp.write(_header.pack(MAGIC, VERSION, len(items)))
+    fp.write(b''.join(records))
+    for key, value in items:
+      fp.write(key)
+      fp.write(value)
+  os.replace(tmp, filename)
+
+
+class ActionIndex:
+  """
+  Reads an action index that was written with #write().
+  """
+
+  def __init__(self, filename: str):
+    self.filename = filename
+    with open(filename, 'rb') as fp:
+      size = os.fstat(fp.fileno()).st_size
+      # An empty file can not be memory-mapped.
+      self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+    if len(self._mm) < _header.size:
+      raise ValueError('{!r} is not an action index'.format(filename))
+    magic, version, self._count = _header.unpack_from(self._mm, 0)
+    if magic != MAGIC:
+      raise ValueError('{!r} is not an action index'.format(filename))
+    if version != VERSION:
+      raise ValueError('{!r}: unsupported action index version {}'
+                       .format(filename, version))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __len__(self):
+    return self._count
+
+  def close(self):
+    if isinstance(self._mm, mmap.mmap):
+      self._mm.close()
+
+  def _record(self, index):
+    return _record.unpack_from(self._mm, _header.size + _record.size * index)
+
+  def find(self, target: str, operator: str, build_set: int) -> Optional[protocol.Action]:
+    """
+    Returns the action of the specified build set or #None if it is not
+    in the index.
+    """
+
+    key = make_key(target, operator, build_set)
+    lo, hi = 0, self._count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      offset, key_size, _ = self._record(mid)
+      if self._mm[offset:offset+key_size] < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo < self._count:
+      offset, key_size, value_size = self._record(lo)
+      if self._mm[offset:offset+key_size] == key:
+        offset += key_size
+        return protocol.decode_action(self._mm[offset:offset+value_size])
+    return None
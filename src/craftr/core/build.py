@@ -37,19 +37,241 @@ import collections
 import contextlib
 import hashlib
 import io
+import itertools
 import json
 import os
 import nr.fs
 import re
 import shlex
+import struct
 import subprocess
 
 from craftr.utils.maps import ValueIterableDict
-from nr.collections import ChainDict
+from nr.collections import ChainDict, abc
 from nr.stream import Stream as stream
-from typing import Dict, Iterable, List, Union
+from typing import Dict, Iterable, List, Tuple, Union
+from . import graphfile
+from .scheduler import Schedule
 from .template import TemplateCompiler
 
+_u32 = struct.Struct('<I')
+
+#: The name of the pool that #Operator.syncio operators run in. The pool
+#: has a depth of one and is always declared.
+CONSOLE_POOL = 'console'
+
+
+def _hash_encode(value, buf: bytearray):
+  """
+  Appends a canonical binary encoding of *value* to *buf*. Supports #None,
+  booleans, numbers, strings, sequences and mappings with string keys. Every
+  value is prefixed with a type tag, strings and containers are prefixed
+  with their length, mappings are encoded in sorted key order.
+  """
+
+  if value is None:
+    buf += b'N'
+  elif value is True:
+    buf += b'T'
+  elif value is False:
+    buf += b'F'
+  elif isinstance(value, str):
+    data = value.encode('utf8')
+    buf += b's'
+    buf += _u32.pack(len(data))
+    buf += data
+  elif isinstance(value, (int, float)):
+    buf += b'i' if isinstance(value, int) else b'f'
+    buf += repr(value).encode('ascii')
+    buf += b';'
+  elif isinstance(value, (list, tuple)):
+    buf += b'l'
+    buf += _u32.pack(len(value))
+    if all(type(x) is str for x in value):
+      # Fast path for the most common case, a list of filenames.
+      data = [x.encode('utf8') for x in value]
+      buf += b'S'
+      buf += struct.pack('<{}I'.format(len(data)), *map(len, data))
+      buf += b''.join(data)
+    else:
+      for x in value:
+        _hash_encode(x, buf)
+  elif isinstance(value, abc.Mapping):
+    keys = sorted(value.keys())
+    buf += b'd'
+    buf += _u32.pack(len(keys))
+    for key in keys:
+      _hash_encode(key, buf)
+      _hash_encode(value[key], buf)
+  else:
+    raise TypeError('unable to hash value of type {}'.format(type(value).__name__))
+
+
+def hash_values(*values) -> str:
+  """
+  Returns the SHA-1 hex digest of the canonical binary encoding of the
+  specified *values*.
+  """
+
+  buf = bytearray()
+  _hash_encode(values, buf)
+  return hashlib.sha1(buf).hexdigest()
+
+
+def content_hashes(data: Dict) -> Tuple[str, Dict[str, str]]:
+  """
+  Returns the hash of the JSON representation of a target (as returned by
+  #Target.to_json()) and a dictionary that maps the names of its operators
+  to the hashes of their JSON representation. Used by #Master.reload() to
+  find the targets and operators that changed.
+  """
+
+  operators = {x['name']: hash_values(x) for x in data['operators']}
+  return hash_values(data['id'], operators), operators
+
+
+class _TrackedDict(dict):
+  """
+  A dictionary that calls the `_invalidate_hash()` method of its *owner*
+  when it is modified. Used for the variables and the environment of build
+  sets and operators.
+  """
+
+  __slots__ = ('_owner',)
+
+  def __init__(self, owner, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self._owner = owner
+
+  def _on_change(self):
+    self._owner._invalidate_hash()
+
+  def __setitem__(self, key, value):
+    super().__setitem__(key, value)
+    self._on_change()
+
+  def __delitem__(self, key):
+    super().__delitem__(key)
+    self._on_change()
+
+  def clear(self):
+    super().clear()
+    self._on_change()
+
+  def pop(self, *args):
+    result = super().pop(*args)
+    self._on_change()
+    return result
+
+  def popitem(self):
+    result = super().popitem()
+    self._on_change()
+    return result
+
+  def setdefault(self, key, default=None):
+    if key not in self:
+      self[key] = default
+    return self[key]
+
+  def update(self, *args, **kwargs):
+    super().update(*args, **kwargs)
+    self._on_change()
+
+
+class _TrackedList(list):
+  """
+  A list that calls the `_invalidate_hash()` method of its *owner* when it
+  is modified. Used for the file lists of build sets.
+  """
+
+  __slots__ = ('_owner',)
+
+  def __init__(self, owner, *args):
+    super().__init__(*args)
+    self._owner = owner
+
+  def _on_change(self):
+    self._owner._invalidate_hash()
+
+  def __setitem__(self, index, value):
+    super().__setitem__(index, value)
+    self._on_change()
+
+  def __delitem__(self, index):
+    super().__delitem__(index)
+    self._on_change()
+
+  def __iadd__(self, other):
+    result = super().__iadd__(other)
+    self._on_change()
+    return result
+
+  def __imul__(self, n):
+    result = super().__imul__(n)
+    self._on_change()
+    return result
+
+  def append(self, value):
+    super().append(value)
+    self._on_change()
+
+  def extend(self, values):
+    super().extend(values)
+    self._on_change()
+
+  def insert(self, index, value):
+    super().insert(index, value)
+    self._on_change()
+
+  def pop(self, *args):
+    result = super().pop(*args)
+    self._on_change()
+    return result
+
+  def remove(self, value):
+    super().remove(value)
+    self._on_change()
+
+  def clear(self):
+    super().clear()
+    self._on_change()
+
+  def sort(self, *args, **kwargs):
+    super().sort(*args, **kwargs)
+    self._on_change()
+
+  def reverse(self):
+    super().reverse()
+    self._on_change()
+
+
+class _FileSets(_TrackedDict):
+  """
+  The input or output file sets of a build set. The file lists are stored
+  as #_TrackedList objects, thus modifying them in place also invalidates
+  the hash of the build set.
+  """
+
+  __slots__ = ()
+
+  def __init__(self, owner, file_sets=None):
+    super().__init__(owner)
+    for key, files in (file_sets or {}).items():
+      dict.__setitem__(self, key, _TrackedList(owner, files))
+
+  def __setitem__(self, key, value):
+    super().__setitem__(key, _TrackedList(self._owner, value))
+
+  def setdefault(self, key, default=None):
+    if key not in self:
+      self[key] = default if default is not None else []
+    return self[key]
+
+  def update(self, *args, **kwargs):
+    for key, value in dict(*args, **kwargs).items():
+      dict.__setitem__(self, key, _TrackedList(self._owner, value))
+    self._on_change()
+
 
 class BuildSet:
   """
@@ -60,6 +282,10 @@ class BuildSet:
   This is done automatically when adding files to the set.
   """
 
+  __slots__ = ('_master', '_description', '_environ', '_cwd', '_depfile',
+               '_inputs', '_outputs', '_variables', '_operator', '_hash',
+               '_deep_hash', '_description_template', 'additional_args')
+
   def __init__(self, master: 'Master', description: str = None,
                environ: Dict[str, str] = None, cwd: str = None,
                depfile: str = None):
@@ -70,25 +296,48 @@ class BuildSet:
     if depfile is not None and not isinstance(depfile, str):
       raise TypeError('expected str, got {}'.format(type(depfile).__name__))
     self._master = master
-    self.description = description
-    self._environ = environ
+    self._description = description
+    self._description_template = None  # Compiled on demand by get_description()
+    self._environ = _TrackedDict(self, environ) if environ is not None else None
     self._cwd = cwd or None  # empty string is invalid, fallback to None
-    self.depfile = depfile
-    self._inputs = {}
-    self._outputs = {}
-    self._variables = {}
+    self._depfile = depfile
+    # Modifying the files or the environment in place invalidates the hash.
+    self._inputs = _FileSets(self)
+    self._outputs = _FileSets(self)
+    self._variables = None  # Created on demand, see the variables property
     self._operator = None
+    self._hash = None  # A tuple of the operator hash and the build set hash
+    self._deep_hash = None  # A tuple of the master's hash generation and the deep hash
     self.additional_args = None
 
   def __repr__(self):
     return '{}(operator={}, inputs={}, outputs={}, variables={})'\
       .format(type(self).__name__, self.operator, set(self._inputs.keys()),
-              set(self._outputs.keys()), set(self._variables.keys()))
+              set(self._outputs.keys()), set(self._variables or ()))
 
   @property
   def master(self):
     return self._master
 
+  @property
+  def description(self):
+    return self._description
+
+  @description.setter
+  def description(self, description):
+    self._description = description
+    self._description_template = None
+    self._invalidate_hash()
+
+  @property
+  def depfile(self):
+    return self._depfile
+
+  @depfile.setter
+  def depfile(self, depfile):
+    self._depfile = depfile
+    self._invalidate_hash()
+
   @property
   def environ(self):
     return self._environ
@@ -107,6 +356,8 @@ class BuildSet:
 
   @property
   def variables(self):
+    if self._variables is None:
+      self._variables = _TrackedDict(self)
     return self._variables
 
   @property
@@ -114,28 +365,26 @@ class BuildSet:
     return self._operator
 
   def add_input_files(self, set_name: str, files: List[str]):
-    result = []
-    dest = self._inputs.setdefault(set_name, [])
-    for x in files:
-      x = self._master.canonicalize_path(x)
-      result.append(x)
-      dest.append(x)
+    result = self._master.canonicalize_paths(files)
+    self._inputs.setdefault(set_name, []).extend(result)
+    for x in result:
+      self._master._declare_input(self, x)
+    self._invalidate_hash()
     return result
 
   def add_output_files(self, set_name: str, files: List[str]):
-    result = []
+    result = self._master.canonicalize_paths(files)
     dest = self._outputs.setdefault(set_name, [])
-    for x in files:
-      x = self._master.canonicalize_path(x)
+    for x in result:
       self._master._declare_output(self, x)
-      result.append(x)
       dest.append(x)
+    self._invalidate_hash()
     return result
 
   def get_input_build_sets(self) -> set:
     inputs = set()
     for fname in stream.concat(self.inputs.values()):
-      bset = self._master._output_files.get(fname, None)
+      bset = self._master.get_output_build_set(fname)
       if bset is not None:
         inputs.add(bset)
     return inputs
@@ -149,7 +398,7 @@ class BuildSet:
 
     if not self._operator:
       raise TypeError('build set is not attached to an operator')
-    variables = ChainDict(self._variables, self._operator._variables)
+    variables = ChainDict(self._variables or {}, self._operator._variables)
     return self._operator.commands.render(self._inputs, self._outputs, variables)
 
   def get_description(self):
@@ -161,8 +410,11 @@ class BuildSet:
       return ' && '.join(' '.join(map(shlex.quote, x)) for x in self.get_commands())
     if not self._operator:
       return self.description
-    template = TemplateCompiler().compile_list(shlex.split(self.description))
-    variables = ChainDict(self._variables, self._operator._variables)
+    template = self._description_template
+    if template is None:
+      template = TemplateCompiler().compile_list(shlex.split(self.description))
+      self._description_template = template
+    variables = ChainDict(self._variables or {}, self._operator._variables)
     return ' '.join(template.render(self._inputs, self._outputs, variables))
 
   def get_environ(self):
@@ -175,34 +427,88 @@ class BuildSet:
     return {'description': self.description, 'environ': self._environ,
             'cwd': self._cwd, 'depfile': self.depfile,
             'inputs': self._inputs, 'outputs': self._outputs,
-            'variables': self._variables}
+            'variables': self._variables or {}}
 
   @classmethod
   def from_json(cls, master: 'Master', operator: 'Operator', data: Dict):
     self = object.__new__(cls)
     self._master = master
-    self.description = data['description']
-    self._environ = data['environ']
+    self._description = data['description']
+    self._description_template = None
+    self._environ = _TrackedDict(self, data['environ']) if data['environ'] is not None else None
     self._cwd = data['cwd']
-    self.depfile = data['depfile']
-    self._inputs = data['inputs']
-    self._outputs = data['outputs']
-    self._variables = data['variables']
+    self._depfile = data['depfile']
+    self._inputs = _FileSets(self, master._intern_file_sets(data['inputs']))
+    self._outputs = _FileSets(self, master._intern_file_sets(data['outputs']))
+    self._variables = _TrackedDict(self, data['variables']) if data['variables'] else None
     self._operator = operator
+    self._hash = None
+    self._deep_hash = None
     self.additional_args = None
-    [master._declare_output(self, x) for x in stream.concat(self.outputs.values())]
+    for files in self._inputs.values():
+      for x in files:
+        master._declare_input(self, x)
+    for files in self._outputs.values():
+      for x in files:
+        master._declare_output(self, x)
     return self
 
-  def compute_hash(self):
+  def _invalidate_hash(self):
+    self._hash = None
+    self._master._hash_generation += 1
+
+  def compute_hash(self, deep=False):
     """
-    Computes a hash for the build set.
+    Computes a hash for the build set. The hash covers the build set's files,
+    variables and the hash of its operator (see #Operator.compute_hash()).
+    It is cached until the build set or its operator changes.
+
+    If *deep* is #True, the hashes of all build sets that produce the input
+    files of this build set are folded in recursively, so the hash identifies
+    the whole chain of actions that lead up to this build set.
     """
 
-    data = self.to_json()
-    data['commands'] = self.operator.commands.to_json()
-    data['environ'] = dict(self.get_environ())
-    data['cwd'] = self.get_cwd()
-    return hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf8')).hexdigest()
+    if deep:
+      return self._compute_deep_hash()
+    op_hash = self._operator.compute_hash()
+    if self._hash is None or self._hash[0] != op_hash:
+      data = (self._description, self._environ, self._cwd, self._depfile,
+              self._inputs, self._outputs, self._variables or {})
+      self._hash = (op_hash, hash_values(op_hash, data))
+    return self._hash[1]
+
+  def _has_deep_hash(self):
+    return self._deep_hash is not None and \
+        self._deep_hash[0] == self._master._hash_generation
+
+  def _compute_deep_hash(self):
+    if self._has_deep_hash():
+      return self._deep_hash[1]
+
+    # Compute the deep hashes of the input build sets iteratively to not
+    # run into the recursion limit with long chains of build sets. Note
+    # that the hash generation may change while we go if targets are
+    # loaded lazily by get_input_build_sets().
+    stack = [(self, False)]
+    visiting = set()
+    while stack:
+      bset, expanded = stack.pop()
+      if bset._has_deep_hash():
+        continue
+      inputs = bset.get_input_build_sets()
+      if not expanded:
+        if bset in visiting:
+          raise RuntimeError('dependency cycle at {!r}'.format(bset))
+        visiting.add(bset)
+        stack.append((bset, True))
+        stack.extend((x, False) for x in inputs)
+        continue
+      visiting.discard(bset)
+      input_hashes = sorted(x._deep_hash[1] for x in inputs)
+      deep_hash = hash_values(bset.compute_hash(), input_hashes)
+      bset._deep_hash = (self._master._hash_generation, deep_hash)
+
+    return self._deep_hash[1]
 
 
 class Command:
@@ -210,6 +516,9 @@ class Command:
   Represents a single command.
   """
 
+  __slots__ = ('_command', '_compiled', '_inputs', '_outputs', '_variables',
+               '_supports_response_file', '_response_args_begin', '_hash')
+
   def __init__(self, command: Union[List[str], str],
                supports_response_file: bool = False,
                response_args_begin: int = 1):
@@ -221,6 +530,7 @@ class Command:
         self._compiled.occurences(set(), set(), set())
     self._supports_response_file = supports_response_file
     self._response_args_begin = response_args_begin
+    self._hash = None
 
   def __repr__(self):
     return 'Command({!r})'.format(self._command)
@@ -259,6 +569,12 @@ class Command:
   def render(self, inputs, outputs, variables):
     return self._compiled.render(inputs, outputs, variables)
 
+  def compute_hash(self):
+    if self._hash is None:
+      self._hash = hash_values(self._command, self._supports_response_file,
+                               self._response_args_begin)
+    return self._hash
+
   @contextlib.contextmanager
   def with_response_file(self, commands):
     """
@@ -302,6 +618,8 @@ class Commands:
   A commands object is immutable after construction.
   """
 
+  __slots__ = ('_commands', '_inputs', '_outputs', '_variables', '_hash')
+
   def __init__(self, commands: List[Union[Command, List[str]]]):
     self._commands = []
     for x in commands:
@@ -311,6 +629,7 @@ class Commands:
     self._inputs, self._outputs, self._variables = set(), set(), set()
     [x.compiled.occurences(self._inputs, self._outputs, self._variables)
      for x in self._commands]
+    self._hash = None
 
   def __repr__(self):
     return 'Commands({!r})'.format(self._commands)
@@ -340,6 +659,16 @@ class Commands:
   def render(self, inputs, outputs, variables):
     return [x.render(inputs, outputs, variables) for x in self._commands]
 
+  def compute_hash(self):
+    """
+    Returns a hash of the commands. Commands are immutable, the hash is
+    computed only once.
+    """
+
+    if self._hash is None:
+      self._hash = hash_values([x.compute_hash() for x in self._commands])
+    return self._hash
+
   def to_json(self) -> List:
     return [x.to_json() for x in self._commands]
 
@@ -355,11 +684,15 @@ class Operator:
   must be attached to the operator.
   """
 
+  __slots__ = ('_name', '_master', '_commands', '_target', '_build_sets',
+               '_variables', '_environ', '_cwd', '_explicit', '_syncio',
+               '_deps_prefix', '_restat', '_run_always', '_pool', '_hash')
+
   def __init__(self, master: 'Master', name: str, commands: Commands,
                environ: Dict[str, str] = None, cwd: str = None,
                explicit: bool = False, syncio: bool = False,
                deps_prefix: str = None, restat: bool = False,
-               run_always: bool = False):
+               run_always: bool = False, pool: str = None):
 
     if not isinstance(master, Master):
       raise TypeError('expected Master, got {}'.format(type(master).__name__))
@@ -371,23 +704,45 @@ class Operator:
       raise TypeError('expected Commands, got {}'.format(type(commands).__name__))
     if deps_prefix is not None and not isinstance(deps_prefix, str):
       raise TypeError('expected str, got {}'.format(type(deps_prefix).__name__))
+    if pool is not None and not isinstance(pool, str):
+      raise TypeError('expected str, got {}'.format(type(pool).__name__))
+    if pool and syncio and pool != CONSOLE_POOL:
+      raise ValueError('syncio operators always run in the {!r} pool'.format(CONSOLE_POOL))
     self._name = name
     self._master = master
-    self._commands = commands
+    self._commands = master.intern_commands(commands)
     self._target = None
     self._build_sets = []
-    self._variables = {}
-    self._environ = environ
+    self._variables = _TrackedDict(self)
+    self._environ = _TrackedDict(self, environ) if environ is not None else None
     self._cwd = cwd or None  # empty string is invalid, fallback to None
     self._explicit = explicit
     self._syncio = syncio
     self._deps_prefix = deps_prefix
     self._restat = restat
     self._run_always = run_always
+    self._pool = pool or None
+    self._hash = None
 
   def __repr__(self):
     return 'Operator(target={!r}, name={!r}))'.format(self._target, self._name)
 
+  def _invalidate_hash(self):
+    self._hash = None
+    self._master._hash_generation += 1
+
+  def compute_hash(self):
+    """
+    Computes a hash of the operator's commands, variables, environment and
+    working directory. The hash is cached until the operator's variables or
+    environment change. Build sets fold this hash into their own.
+    """
+
+    if self._hash is None:
+      self._hash = hash_values(self._commands.compute_hash(), self._variables,
+                               self._environ, self._cwd)
+    return self._hash
+
   @property
   def master(self):
     return self._master
@@ -440,6 +795,24 @@ class Operator:
   def run_always(self):
     return self._run_always
 
+  @property
+  def pool(self):
+    """
+    The name of the pool that limits how many build sets of this operator
+    and other operators in the same pool run in parallel, or #None. See
+    #Master.declare_pool().
+    """
+
+    return self._pool
+
+  def get_pool(self):
+    """
+    Returns the pool that the build sets of the operator are run in, which
+    is the #CONSOLE_POOL for #syncio operators.
+    """
+
+    return CONSOLE_POOL if self._syncio else self._pool
+
   @property
   def build_sets(self):
     return self._build_sets[:]
@@ -451,6 +824,7 @@ class Operator:
       raise ValueError('add_build_set(): BuildSet belongs to another Operator')
     if build_set in self._build_sets:
       raise RuntimeError('add_build_set(): BuildSet is already added')
+    build_set._invalidate_hash()
     for set_name in self._commands.inputs:
       if set_name not in build_set.inputs:
         raise RuntimeError('operator requires ${{<{}}} which is not '
@@ -460,7 +834,7 @@ class Operator:
         raise RuntimeError('operator requires ${{@{}}} which is not '
                            'provided by this build set'.format(set_name))
     for var_name in self._commands.variables:
-      if var_name not in self._variables and var_name not in build_set._variables:
+      if var_name not in self._variables and var_name not in (build_set._variables or ()):
         raise RuntimeError('operator requires ${{{}}} which is not provided '
                            'by this build set'.format(var_name))
     if build_set.depfile and self.deps_prefix:
@@ -472,11 +846,12 @@ class Operator:
   def to_json(self, *, build_sets: List[BuildSet] = None) -> Dict:
     if build_sets is None:
       build_sets = self._build_sets
-    return {'name': self._name, 'commands': self._commands.to_json(),
+    return {'name': self._name, 'commands': self._commands.compute_hash(),
             'build_sets': [x.to_json() for x in build_sets],
             'variables': self._variables, 'environ': self._environ,
             'cwd': self._cwd, 'explicit': self._explicit,
-            'syncio': self._syncio, 'deps_prefix': self._deps_prefix}
+            'syncio': self._syncio, 'deps_prefix': self._deps_prefix,
+            'pool': self._pool}
 
   @classmethod
   def from_json(cls, master: 'Master', target: 'Target', data: Dict):
@@ -484,14 +859,16 @@ class Operator:
     self._master = master
     self._target = target
     self._name = data['name']
-    self._commands = Commands.from_json(data['commands'])
+    self._commands = master.get_commands(data['commands'])
     self._build_sets = [BuildSet.from_json(master, self, x) for x in data['build_sets']]
-    self._variables = data['variables']
-    self._environ = data['environ']
+    self._variables = _TrackedDict(self, data['variables'])
+    self._hash = None
+    self._environ = _TrackedDict(self, data['environ']) if data['environ'] is not None else None
     self._cwd = data['cwd']
     self._explicit = data['explicit']
     self._syncio = data['syncio']
     self._deps_prefix = data['deps_prefix']
+    self._pool = data.get('pool')
     return self
 
 
@@ -500,6 +877,8 @@ class Target:
   A target is a collection of operators.
   """
 
+  __slots__ = ('_id', '_master', '_operators')
+
   def __init__(self, master: 'Master', id: str):
     if not isinstance(master, Master):
       raise TypeError('expected Master, got {}'.format(type(master).__name__))
@@ -567,24 +946,335 @@ class Master:
     self._template_compiler = template_compiler or TemplateCompiler()
     self._targets = {}
     self._output_files = {}  # Maps from the canonical filename to a BuildSet
+    self._input_files = {}  # Maps from the canonical filename to a dict of the consuming BuildSets
+    self._reader = None  # A graph reader to load targets on demand
+    self._all_loaded = True
+    self._hash_generation = 0  # Incremented when any build set hash may change
+    self._paths = {}  # The path table, see intern_path()
+    self._canonical_paths = {}  # Maps (cwd, raw path) to the interned canonical path
+    self._commands = {}  # The command table, see intern_commands()
+    self._command_data = {}  # JSON of commands that have not been decoded yet
+    self._pools = {}  # Maps pool names to their depth, see declare_pool()
+    # Check that paths passed to _declare_output() are canonical.
+    self.debug_paths = os.environ.get('CRAFTR_DEBUG_PATHS') == 'true'
 
   @property
   def template_compiler(self):
     return self._template_compiler
 
-  def canonicalize_path(self, path):
+  def canonicalize_path(self, path, parent=None):
     """
     Canonicalize the specified *path*, turning it absolute and reducing it
     to the most relevant and normalized form. The default implementation
     acts as an alias to #nr.fs.canonical().
     """
 
-    return nr.fs.canonical(path)
+    return nr.fs.canonical(path, parent)
+
+  def canonicalize_paths(self, paths: Iterable[str], parent: str = None) -> List[str]:
+    """
+    Canonicalizes a list of *paths* with #canonicalize_path() and returns the
+    interned results (see #intern_path()). Results are cached by the raw path
+    and the directory that relative paths are resolved against, which is
+    *parent* or the current working directory.
+    """
+
+    cache = self._canonical_paths
+    cwd = None
+    result = []
+    for path in paths:
+      if os.path.isabs(path):
+        key = (None, path)
+      else:
+        if cwd is None:
+          cwd = os.path.abspath(parent) if parent else os.getcwd()
+        key = (cwd, path)
+      try:
+        result.append(cache[key])
+      except KeyError:
+        value = cache[key] = self.intern_path(self.canonicalize_path(path, parent))
+        result.append(value)
+    return result
+
+  def intern_path(self, path: str) -> str:
+    """
+    Returns the instance of the canonical *path* that is stored in the path
+    table of the master, adding it to the table if necessary. Build sets only
+    reference interned paths, thus every path exists only once in memory no
+    matter how many build sets reference it.
+    """
+
+    return self._paths.setdefault(path, path)
+
+  def _intern_file_sets(self, file_sets: Dict[str, List[str]]):
+    intern = self.intern_path
+    return {k: [intern(x) for x in v] for k, v in file_sets.items()}
+
+  def intern_commands(self, commands: Commands) -> Commands:
+    """
+    Returns the #Commands object in the command table of the master that is
+    equal to *commands*, adding *commands* to the table if there is none.
+    Operators with equal commands share the same object and reference it by
+    its hash in the serialized graph (see #command_table()).
+    """
+
+    return self._commands.setdefault(commands.compute_hash(), commands)
+
+  def get_commands(self, command_id: str) -> Commands:
+    """
+    Returns the #Commands with the specified *command_id* from the command
+    table. Raises a #KeyError if the commands are unknown.
+    """
+
+    try:
+      return self._commands[command_id]
+    except KeyError:
+      commands = Commands.from_json(self._command_data[command_id])
+    return self._commands.setdefault(command_id, commands)
+
+  def command_table(self, operators: Iterable[Operator] = None) -> Dict[str, List]:
+    """
+    Returns the JSON representation of the commands of all *operators*
+    (defaults to all operators in the graph), keyed by the command ID that
+    #Operator.to_json() references.
+    """
+
+    if operators is None:
+      operators = self.all_operators()
+    table = {}
+    for op in operators:
+      command_id = op.commands.compute_hash()
+      if command_id not in table:
+        table[command_id] = op.commands.to_json()
+    return table
+
+  def load_command_table(self, table: Dict[str, List]):
+    """
+    Adds the commands in *table* (as returned by #command_table()) to the
+    commands that can be resolved with #get_commands(). The commands are
+    decoded when they are first used.
+    """
+
+    self._command_data.update(table)
 
   @property
   def targets(self):
+    self.load_all()
     return ValueIterableDict(map=self._targets)
 
+  def target_ids(self) -> Iterable[str]:
+    """
+    Returns the IDs of all targets in the graph without loading targets
+    that have not been loaded yet.
+    """
+
+    if self._reader:
+      return list(self._reader.target_ids())
+    return list(self._targets.keys())
+
+  def get_target(self, target_id: str) -> Target:
+    """
+    Returns the #Target with the specified *target_id*, loading it from the
+    graph file if necessary. Raises a #KeyError if the target does not exist.
+    """
+
+    try:
+      return self._targets[target_id]
+    except KeyError:
+      if not self._reader or not self._reader.has_target(target_id):
+        raise
+    data = self._reader.read_target(target_id)
+    target = Target.from_json(self, data)
+    self._targets[target_id] = target
+    return target
+
+  def output_files(self) -> Iterable[str]:
+    """
+    Returns the canonical filenames of all output files in the graph without
+    loading targets that have not been loaded yet.
+    """
+
+    if self._reader:
+      return list(self._reader.output_files())
+    return list(self._output_files.keys())
+
+  def get_output_build_set(self, filename: str) -> BuildSet:
+    """
+    Returns the #BuildSet that produces the canonical *filename*, or #None.
+    The target that contains the build set is loaded if necessary.
+    """
+
+    bset = self._output_files.get(filename)
+    if bset is None and self._reader:
+      target_id = self._reader.find_output(filename)
+      if target_id is not None and target_id not in self._targets:
+        self.get_target(target_id)
+        bset = self._output_files.get(filename)
+    return bset
+
+  def load_all(self):
+    """
+    Loads all targets that have not been loaded from the graph file, yet.
+    """
+
+    if self._reader and not self._all_loaded:
+      for target_id in self._reader.target_ids():
+        if target_id not in self._targets:
+          self.get_target(target_id)
+      self._all_loaded = True
+
+  def shard_key(self, target_id: str) -> str:
+    """
+    Returns the key of the shard that the target with the specified
+    *target_id* is saved to when the graph is saved with `sharded=True`.
+    The default implementation groups targets by their scope.
+    """
+
+    return target_id.partition('@')[0]
+
+  def reload_shard(self, key: str):
+    """
+    Discards all loaded targets of the shard with the specified *key* and
+    re-reads the manifest of the sharded graph file. The targets of the
+    shard are loaded again from the graph file when they are accessed.
+    """
+
+    if not isinstance(self._reader, graphfile.ShardedGraphReader):
+      raise RuntimeError('the graph was not loaded from a sharded graph file')
+    for target_id in [x for x in self._targets if self.shard_key(x) == key]:
+      target = self._targets.pop(target_id)
+      for op in target.operators:
+        self._forget_operator(op)
+    self._reader.reload_shard(key)
+    self.load_command_table(self._reader.commands())
+    self._all_loaded = False
+    # Deep hashes of build sets that depend on the shard may have changed.
+    self._hash_generation += 1
+
+  def reload(self, filename: str) -> List[str]:
+    """
+    Updates the graph from *filename*, replacing only what changed. The
+    content hashes (see #content_hashes()) of the loaded targets are computed
+    from their JSON representation and compared against the targets in the
+    file. Of a changed target, only the operators
+    (and with them, their build sets) that changed are replaced, the #Target
+    object itself is kept. Targets that are not loaded yet will be loaded
+    from the new file on demand. If both graphs are sharded, targets in
+    shards with an unchanged hash are not even read.
+
+    All changes are computed before the graph is modified. If the new graph
+    is invalid (eg. if it declares an output file that is also produced by
+    an unchanged build set), an exception is raised and the graph is left
+    untouched.
+
+    Returns the IDs of the loaded targets that have been changed or removed
+    and of the targets that have been added.
+    """
+
+    format = graphfile.detect_format(filename)
+    if format == 'json':
+      with open(filename) as fp:
+        metadata, data = self.unpack_json(json.load(fp))
+      self._check_json(data)
+      reader = None
+      commands = data['commands']
+      new_targets = {x['id']: x for x in data['targets']}
+    else:
+      if format == 'binary':
+        reader = graphfile.BinaryGraphReader(filename)
+      else:
+        reader = graphfile.ShardedGraphReader(filename)
+      metadata, commands = reader.metadata(), reader.commands()
+      new_targets = {}
+
+    old_reader = self._reader
+    compare_shards = isinstance(old_reader, graphfile.ShardedGraphReader) and \
+        isinstance(reader, graphfile.ShardedGraphReader)
+
+    # Find the changes: (target ID, old target, new data, stale operators).
+    changes = []
+    for target_id, target in self._targets.items():
+      if reader is None:
+        data = new_targets.pop(target_id, None)
+      else:
+        if compare_shards:
+          key = old_reader.shard_of(target_id)
+          if key is not None and key == reader.shard_of(target_id) and \
+              old_reader.shard_hash(key) == reader.shard_hash(key):
+            continue
+        data = reader.read_target(target_id) if reader.has_target(target_id) else None
+      if data is None:
+        changes.append((target_id, target, None, list(target._operators.values())))
+        continue
+      old_hashes = content_hashes(target.to_json())
+      hashes = content_hashes(data)
+      if hashes[0] != old_hashes[0]:
+        names = set(x['name'] for x in data['operators'])
+        stale = [op for name, op in target._operators.items()
+                 if name not in names or hashes[1][name] != old_hashes[1].get(name)]
+        changes.append((target_id, target, data, stale))
+    for target_id, data in new_targets.items():
+      changes.append((target_id, None, data, []))
+
+    # Make sure that the new build sets do not produce files that are still
+    # produced by build sets that are kept.
+    stale_ops = set(op for change in changes for op in change[3])
+    outputs = set()
+    for target_id, target, data, stale in changes:
+      if data is None:
+        continue
+      for op_data in data['operators']:
+        op = target._operators.get(op_data['name']) if target else None
+        if op is not None and op not in stale_ops:
+          continue
+        for bset_data in op_data['build_sets']:
+          for filename in stream.concat(bset_data['outputs'].values()):
+            bset = self._output_files.get(filename)
+            if filename in outputs or (bset and bset._operator not in stale_ops):
+              if reader:
+                reader.close()
+              raise ValueError(
+                'Two build sets with the same output file can not co-exist.\n'
+                '  Filename: {}\n  Target: {}'.format(filename, target_id))
+            outputs.add(filename)
+
+    # Apply the changes.
+    self.load_metadata(metadata)
+    self.load_command_table(commands)
+    for op in stale_ops:
+      self._forget_operator(op)
+    for target_id, target, data, stale in changes:
+      if data is None:
+        del self._targets[target_id]
+      elif target is None:
+        self._targets[target_id] = Target.from_json(self, data)
+      else:
+        operators = {}
+        for op_data in data['operators']:
+          op = target._operators.get(op_data['name'])
+          if op is None or op in stale_ops:
+            op = Operator.from_json(self, target, op_data)
+          operators[op._name] = op
+        target._operators = operators
+    self._reader = reader
+    self._all_loaded = reader is None
+    self._hash_generation += 1
+    if old_reader:
+      old_reader.close()
+
+    return [x[0] for x in changes]
+
+  def _forget_operator(self, op: Operator):
+    # Removes the files of the operator's build sets from the file tables.
+    for bset in op._build_sets:
+      for filename in stream.concat(bset._outputs.values()):
+        if self._output_files.get(filename) is bset:
+          del self._output_files[filename]
+      for filename in stream.concat(bset._inputs.values()):
+        consumers = self._input_files.get(filename)
+        if consumers is not None:
+          consumers.pop(bset, None)
+
   def add_target(self, target):
     if not isinstance(target, Target):
       raise TypeError('expected Target, got {}'.format(type(target).__name__))
@@ -595,13 +1285,60 @@ class Master:
 
   def _declare_output(self, build_set:BuildSet, filename:str):
     # Note: filename must be canonicalized
-    assert self.canonicalize_path(filename) == filename
+    if self.debug_paths:
+      assert self.canonicalize_path(filename) == filename
     if filename in self._output_files:
       raise ValueError(
         'Two build sets with the same output file can not co-exist.\n'
         '  Filename: {}\n  Incoming Buildset: {}\n  Existing Buildset: {}'
         .format(filename, build_set, self._output_files[filename]))
     self._output_files[filename] = build_set
+    # Deep hashes of build sets that consume this file are invalidated.
+    self._hash_generation += 1
+
+  def _declare_input(self, build_set: BuildSet, filename: str):
+    # An insertion-ordered dict keeps the order of the consumers and makes
+    # inserts O(1) for files that are consumed by many build sets.
+    self._input_files.setdefault(filename, {})[build_set] = None
+
+  def get_consumer_build_sets(self, filename: str) -> List[BuildSet]:
+    """
+    Returns a list of the build sets that have the canonical *filename* as
+    an input file. All targets are loaded if the graph is loaded lazily.
+    """
+
+    self.load_all()
+    return list(self._input_files.get(filename, ()))
+
+  def get_affected_build_sets(self, filenames: Iterable[str],
+                              discovered: Dict[str, List[BuildSet]] = None) -> List[BuildSet]:
+    """
+    Returns the build sets that need to be rebuilt when the files in the
+    list of canonical *filenames* change. These are the build sets that
+    consume any of the files, plus everything downstream of them. Only the
+    affected part of the graph is visited. All targets are loaded if the
+    graph is loaded lazily.
+
+    *discovered* maps the dependencies that the backend discovered when
+    it built the build sets (eg. headers listed in a depfile) to the build
+    sets that depend on them. They are treated like input files.
+    """
+
+    self.load_all()
+    discovered = discovered or {}
+    result = []
+    seen = set()
+    queue = collections.deque(filenames)
+    while queue:
+      filename = queue.popleft()
+      consumers = itertools.chain(self._input_files.get(filename, ()),
+                                  discovered.get(filename, ()))
+      for bset in consumers:
+        if bset not in seen:
+          seen.add(bset)
+          result.append(bset)
+          queue.extend(stream.concat(bset._outputs.values()))
+    return result
 
   def all_operators(self) -> Iterable[Operator]:
     for target in self.targets:
@@ -611,20 +1348,121 @@ class Master:
     for op in self.all_operators():
       yield from op.build_sets
 
+  @property
+  def pools(self) -> Dict[str, int]:
+    """
+    A copy of the pools declared with #declare_pool(), mapping their names
+    to their depth. The #CONSOLE_POOL is not included.
+    """
+
+    return dict(self._pools)
+
+  def declare_pool(self, name: str, depth: int):
+    """
+    Declares a pool in which at most *depth* build sets run at the same
+    time. Operators are assigned to a pool with #Operator.pool. Declaring
+    a pool again changes its depth.
+    """
+
+    if not isinstance(name, str):
+      raise TypeError('expected str, got {}'.format(type(name).__name__))
+    if not name or name == CONSOLE_POOL:
+      raise ValueError('invalid pool name: {!r}'.format(name))
+    if not isinstance(depth, int) or isinstance(depth, bool):
+      raise TypeError('expected int, got {}'.format(type(depth).__name__))
+    if depth < 1:
+      raise ValueError('pool depth must be at least 1, got {}'.format(depth))
+    self._pools[name] = depth
+
+  def get_pool_depths(self) -> Dict[str, int]:
+    """
+    Returns the depths of all pools that limit the parallelism of a build,
+    including the #CONSOLE_POOL.
+    """
+
+    result = dict(self._pools)
+    result[CONSOLE_POOL] = 1
+    return result
+
+  def get_metadata(self) -> Dict:
+    """
+    Returns additional information that is stored alongside the targets in
+    the serialized graph. Subclasses may override this method, but must
+    include the data returned by the parent implementation.
+    """
+
+    return {'pools': dict(self._pools)}
+
+  def load_metadata(self, metadata: Dict):
+    self._pools = dict(metadata.get('pools') or {})
+
   def to_json(self):
-    return [x.to_json() for x in self._targets.values()]
+    targets = [x.to_json() for x in self.targets]
+    return {'commands': self.command_table(), 'targets': targets}
+
+  def unpack_json(self, data: Dict) -> Tuple[Dict, Dict]:
+    """
+    Splits the JSON representation of the graph as returned by #to_json()
+    into the metadata and the data that #Master.load_json() accepts.
+    Subclasses that embed metadata in #to_json() override this method.
+    """
+
+    return {}, data
+
+  def _check_json(self, data):
+    # Before the command table was added, the graph was a list of targets.
+    if not isinstance(data, dict) or 'targets' not in data:
+      raise graphfile.GraphVersionError(
+        'the graph file was written by an older version of craftr')
 
   def load_json(self, data: Dict):
-    self._targets = {x['id']: Target.from_json(self, x) for x in data}
+    self._check_json(data)
+    self.load_command_table(data['commands'])
+    self._targets = {x['id']: Target.from_json(self, x) for x in data['targets']}
 
-  def save(self, filename: str):
-    with open(filename, 'w') as fp:
-      json.dump(self.to_json(), fp, sort_keys=True)
+  def save(self, filename: str, format: str = 'json', sharded: bool = False):
+    """
+    Serialize the build graph to *filename* in the specified *format*, which
+    must be either `'json'` or `'binary'`. If *sharded* is #True, the targets
+    are saved into separate files per #shard_key() and *filename* will be
+    the manifest (see #graphfile.write_sharded()) and the keys of the
+    shards that changed are returned.
+    """
+
+    if sharded:
+      targets = [x.to_json() for x in self.targets]
+      return graphfile.write_sharded(filename, targets, self.get_metadata(),
+                                     self.shard_key, format, self.command_table())
+    elif format == 'json':
+      with open(filename, 'w') as fp:
+        json.dump(self.to_json(), fp, sort_keys=True)
+    elif format == 'binary':
+      targets = [x.to_json() for x in self.targets]
+      with open(filename, 'wb') as fp:
+        graphfile.BinaryGraphWriter().write(fp, targets, self.get_metadata(),
+                                            self.command_table())
+    else:
+      raise ValueError('invalid graph format: {!r}'.format(format))
 
   def load(self, filename: str):
-    with open(filename) as fp:
-      data = json.load(fp)
-    self.load_json(data)
+    """
+    Load the build graph from *filename*. The format of the file is detected
+    automatically. Binary and sharded graphs are loaded lazily.
+    """
+
+    format = graphfile.detect_format(filename)
+    if format in ('binary', 'sharded'):
+      if format == 'binary':
+        self._reader = graphfile.BinaryGraphReader(filename)
+      else:
+        self._reader = graphfile.ShardedGraphReader(filename)
+      self._all_loaded = False
+      self.load_metadata(self._reader.metadata())
+      self.load_command_table(self._reader.commands())
+    else:
+      with open(filename) as fp:
+        data = json.load(fp)
+      self.load_json(data)
 
 
 def to_graph(master):
@@ -696,7 +1534,9 @@ def to_graph(master):
 
 def topo_sort(build_sets: Union[Master, List[BuildSet]]):
   """
-  Topologically sort the build sets in the specified list.
+  Topologically sort the build sets in the specified list and the build sets
+  that they depend on. Raises a #CycleError if the build sets
+  contain a dependency cycle.
 
   If a #Master is specified, all build sets of that build master that are
   not explicit are used.
@@ -705,36 +1545,4 @@ def topo_sort(build_sets: Union[Master, List[BuildSet]]):
   if isinstance(build_sets, Master):
     build_sets = [x for x in build_sets.all_build_sets()
                   if not x.operator.explicit]
-
-  # A mirror of the inputs for every build set, allowing us to remove
-  # edge for this algorithm without actually modifying the graph.
-  bset_inputs = {}
-
-  # A dictionary that reverses the dependencies between build sets.
-  bset_reverse = {}
-
-  # A set of build sets that have no input.
-  bset_start = set()
-
-  queue = collections.deque(build_sets)
-  while queue:
-    bset = queue.pop()
-    if bset in bset_inputs:
-      continue
-    bset_inputs[bset] = bset.get_input_build_sets()
-    bset_reverse.setdefault(bset, set())
-    for x in bset_inputs[bset]:
-      bset_reverse.setdefault(x, set()).add(bset)
-    if not bset_inputs[bset]:
-      bset_start.add(bset)
-    else:
-      queue += bset_inputs[bset]
-
-  while bset_start:
-    bset = bset_start.pop()
-    yield bset
-    for x in bset_reverse[bset]:
-      bset_inputs[x].remove(bset)
-      if not bset_inputs[x]:
-        bset_start.add(x)
-    bset_reverse[bset] = set()
+  yield from Schedule(build_sets).order
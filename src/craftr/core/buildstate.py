@@ -0,0 +1,301 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The persistent state of the builds of a backend that runs the commands
+itself, stored in an SQLite database. It records the hash of the build set
+that produced each output file and, for every build set, the duration and
+exit code of its last run, the digest of its inputs and the dependencies
+that were discovered when it was built (see #craftr.core.depslog). It is
+also the #DigestStore for the content digests of the files, when the
+backend compares the contents of files instead of their timestamps.
+
+Build sets are identified by a key chosen by the backend, usually their
+first output file. Paths of dependencies are stored only once and are
+referenced by their ID.
+
+The database is opened in WAL mode. Changes are collected and written in
+one transaction when enough of them are pending or some time has passed,
+and when the state is flushed or closed. Thus a build that is interrupted
+keeps the state of the build sets that finished before the last write.
+"""
+
+__all__ = ['BuildState', 'BuildSetState']
+
+import array
+import collections
+import os
+import sqlite3
+import sys
+import time
+
+from craftr.core.digests import DigestStore
+from typing import Dict, Iterable, List, Optional
+
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE paths (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE);
+CREATE TABLE outputs (path TEXT PRIMARY KEY, hash TEXT NOT NULL) WITHOUT ROWID;
+CREATE TABLE build_sets (
+  key TEXT PRIMARY KEY,
+  duration REAL,
+  exit_code INTEGER,
+  inputs_digest TEXT,
+  deps_mtime INTEGER,
+  deps BLOB
+) WITHOUT ROWID;
+CREATE TABLE digests (
+  path TEXT PRIMARY KEY,
+  size INTEGER NOT NULL,
+  mtime_ns INTEGER NOT NULL,
+  ino INTEGER NOT NULL,
+  digest TEXT NOT NULL
+) WITHOUT ROWID;
+'''
+
+#: The state of a build set when it was last built. *deps* is a list of
+#: the discovered dependencies or #None, *deps_mtime* is the modification
+#: time of the output in nanoseconds when they were recorded.
+BuildSetState = collections.namedtuple('BuildSetState',
+  'duration exit_code inputs_digest deps_mtime deps')
+
+
+def _pack_ids(ids):
+  ids = array.array('I', ids)
+  if sys.byteorder != 'little':
+    ids.byteswap()
+  return ids.tobytes()
+
+
+def _unpack_ids(data):
+  ids = array.array('I', data)
+  if sys.byteorder != 'little':
+    ids.byteswap()
+  return ids
+
+
+class BuildState(DigestStore):
+  """
+  The build state database in the file *filename*. Pending changes are
+  written when *batch_size* build sets or file digests are pending or
+  *batch_interval* seconds passed since the last write.
+  """
+
+  def __init__(self, filename: str, batch_size: int = 1000, batch_interval: float = 1.0):
+    self.filename = filename
+    self.batch_size = batch_size
+    self.batch_interval = batch_interval
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    self._conn = sqlite3.connect(filename)
+    self._conn.execute('PRAGMA journal_mode=WAL')
+    self._conn.execute('PRAGMA synchronous=NORMAL')
+    self.created = False
+    if self._conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+      self._create()
+    self._path_ids = {}
+    self._paths = {}
+    self._outputs = {}  # Pending output hashes, None for deleted outputs
+    self._build_sets = {}  # Pending build set states
+    self._digests = {}  # Pending file digests, None for removed files
+    self._last_write = time.perf_counter()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _create(self):
+    with self._conn:
+      for (name,) in self._conn.execute(
+          "SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+        self._conn.execute('DROP TABLE {}'.format(name))
+      self._conn.executescript(SCHEMA)
+      self._conn.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+    self.created = True
+
+  def get_output_hash(self, output: str) -> Optional[str]:
+    """
+    Returns the hash of the build set that last produced *output*.
+    """
+
+    try:
+      return self._outputs[output]
+    except KeyError:
+      pass
+    row = self._conn.execute('SELECT hash FROM outputs WHERE path = ?', (output,)).fetchone()
+    return row[0] if row else None
+
+  def get_build_set(self, key: str) -> Optional[BuildSetState]:
+    """
+    Returns the #BuildSetState of the build set with the specified *key*, or
+    #None if it has never been built.
+    """
+
+    try:
+      return self._build_sets[key]
+    except KeyError:
+      pass
+    row = self._conn.execute(
+      'SELECT duration, exit_code, inputs_digest, deps_mtime, deps '
+      'FROM build_sets WHERE key = ?', (key,)).fetchone()
+    if row is None:
+      return None
+    deps = row[4]
+    if deps is not None:
+      deps = self._get_paths(_unpack_ids(deps))
+    return BuildSetState(row[0], row[1], row[2], row[3], deps)
+
+  def all_deps(self) -> Dict[str, List[str]]:
+    """
+    Returns the discovered dependencies of all build sets that have them by
+    their key.
+    """
+
+    rows = [(key, _unpack_ids(deps)) for key, deps in self._conn.execute(
+      'SELECT key, deps FROM build_sets WHERE deps IS NOT NULL')]
+    self._get_paths([x for _, ids in rows for x in ids])
+    result = {key: [self._paths[x] for x in ids] for key, ids in rows}
+    for key, state in self._build_sets.items():
+      if state.deps is None:
+        result.pop(key, None)
+      else:
+        result[key] = state.deps
+    return result
+
+  def durations(self) -> Dict[str, float]:
+    """
+    Returns the durations of the last runs of all build sets by their key.
+    """
+
+    result = dict(self._conn.execute(
+      'SELECT key, duration FROM build_sets WHERE duration IS NOT NULL'))
+    result.update((k, v.duration) for k, v in self._build_sets.items())
+    return result
+
+  def load_digests(self, filenames: List[str]) -> Dict[str, tuple]:
+    result = {}
+    missing = []
+    for filename in filenames:
+      if filename in self._digests:
+        if self._digests[filename] is not None:
+          result[filename] = self._digests[filename]
+      else:
+        missing.append(filename)
+    for i in range(0, len(missing), 500):
+      chunk = missing[i:i+500]
+      query = 'SELECT path, size, mtime_ns, ino, digest FROM digests WHERE path IN ({})'
+      for row in self._conn.execute(query.format(','.join('?' * len(chunk))), chunk):
+        result[row[0]] = tuple(row[1:])
+    return result
+
+  def store_digests(self, entries: Dict[str, Optional[tuple]]):
+    self._digests.update(entries)
+    self._changed()
+
+  def _get_paths(self, ids):
+    paths = self._paths
+    missing = [x for x in set(ids) if x not in paths]
+    for i in range(0, len(missing), 500):
+      chunk = missing[i:i+500]
+      query = 'SELECT id, path FROM paths WHERE id IN ({})'.format(','.join('?' * len(chunk)))
+      for id, path in self._conn.execute(query, chunk):
+        paths[id] = path
+        self._path_ids[path] = id
+    return [paths[x] for x in ids]
+
+  def _get_path_ids(self, paths):
+    path_ids = self._path_ids
+    missing = [x for x in set(paths) if x not in path_ids]
+    if missing:
+      self._conn.executemany('INSERT OR IGNORE INTO paths (path) VALUES (?)',
+                             ((x,) for x in missing))
+      for path in missing:
+        id = self._conn.execute('SELECT id FROM paths WHERE path = ?', (path,)).fetchone()[0]
+        path_ids[path] = id
+        self._paths[id] = path
+    return [path_ids[x] for x in paths]
+
+  def record(self, key: str, outputs: Iterable[str], hash: str, duration: float,
+             inputs_digest: str = None, deps: List[str] = None, deps_mtime: int = None):
+    """
+    Records that the build set with the specified *key* and *hash* produced
+    the *outputs* successfully.
+    """
+
+    for output in outputs:
+      self._outputs[output] = hash
+    self._build_sets[key] = BuildSetState(duration, 0, inputs_digest, deps_mtime,
+                                          list(deps) if deps is not None else None)
+    self._changed()
+
+  def record_failure(self, key: str, outputs: Iterable[str], duration: float, exit_code: int):
+    """
+    Records that the build set with the specified *key* failed. Its outputs
+    are no longer considered to be up to date.
+    """
+
+    for output in outputs:
+      self._outputs[output] = None
+    self._build_sets[key] = BuildSetState(duration, exit_code, None, None, None)
+    self._changed()
+
+  def _changed(self):
+    if len(self._build_sets) + len(self._digests) >= self.batch_size or \
+        time.perf_counter() - self._last_write >= self.batch_interval:
+      self.flush()
+
+  def flush(self):
+    """
+    Writes all pending changes in one transaction.
+    """
+
+    if self._outputs or self._build_sets or self._digests:
+      with self._conn:
+        self._conn.executemany('DELETE FROM outputs WHERE path = ?',
+          ((k,) for k, v in self._outputs.items() if v is None))
+        self._conn.executemany('INSERT OR REPLACE INTO outputs (path, hash) VALUES (?, ?)',
+          ((k, v) for k, v in self._outputs.items() if v is not None))
+        rows = []
+        for key, state in self._build_sets.items():
+          deps = _pack_ids(self._get_path_ids(state.deps)) if state.deps is not None else None
+          rows.append((key, state.duration, state.exit_code, state.inputs_digest,
+                       state.deps_mtime, deps))
+        self._conn.executemany(
+          'INSERT OR REPLACE INTO build_sets (key, duration, exit_code, '
+          'inputs_digest, deps_mtime, deps) VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self._conn.executemany('DELETE FROM digests WHERE path = ?',
+          ((k,) for k, v in self._digests.items() if v is None))
+        self._conn.executemany('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)',
+          ((k,) + v for k, v in self._digests.items() if v is not None))
+      self._outputs = {}
+      self._build_sets = {}
+      self._digests = {}
+    self._last_write = time.perf_counter()
+
+  def close(self):
+    if self._conn is not None:
+      self.flush()
+      self._conn.close()
+      self._conn = None
@@ -0,0 +1,114 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Parses the dependencies that are discovered while building, like the
+headers included by a C source file, from GCC style depfiles (see
+#parse_depfile()) or from the `/showIncludes` output of MSVC (see
+#parse_show_includes()). The Python backend stores them in its
+#craftr.core.buildstate.BuildState.
+"""
+
+__all__ = ['parse_depfile', 'parse_show_includes']
+
+from typing import List, Tuple
+
+
+def parse_depfile(text: str) -> List[str]:
+  """
+  Parses the contents of a Makefile style depfile as written by GCC and
+  Clang (`-MD`) and returns the dependencies of all rules in it. Escaped
+  spaces, hashes and dollar signs as well as line continuations are
+  supported.
+  """
+
+  words = []
+  word = []
+  i, n = 0, len(text)
+  while i < n:
+    c = text[i]
+    if c == '\\' and i + 1 < n:
+      nxt = text[i + 1]
+      if nxt in ' #':
+        word.append(nxt)
+        i += 2
+        continue
+      if nxt == '\n' or (nxt == '\r' and text[i+2:i+3] == '\n'):
+        i += 2 if nxt == '\n' else 3
+        c = ' '
+      else:
+        word.append(c)
+        i += 1
+        continue
+    elif c == '$' and text[i+1:i+2] == '$':
+      word.append('$')
+      i += 2
+      continue
+    else:
+      i += 1
+    if c in ' \t\r\n':
+      if word:
+        words.append(''.join(word))
+        word = []
+      if c == '\n':
+        words.append('\n')
+    else:
+      word.append(c)
+  if word:
+    words.append(''.join(word))
+
+  deps = []
+  in_targets = True
+  for word in words:
+    if word == '\n':
+      in_targets = True
+    elif in_targets:
+      if word.endswith(':'):
+        in_targets = False
+    else:
+      deps.append(word)
+  return deps
+
+
+def _is_input_filename(line):
+  # MSVC prints the name of the source file that it compiles.
+  return line.lower().endswith(('.c', '.cc', '.cxx', '.cpp', '.c++'))
+
+
+def parse_show_includes(output: str, prefix: str) -> Tuple[List[str], str]:
+  """
+  Extracts the included files from the *output* of MSVC with the
+  `/showIncludes` option, where every include is printed on a line that
+  starts with the *prefix*. Returns the included files and the output
+  without these lines and without the name of the compiled source file.
+  """
+
+  deps = []
+  lines = []
+  for line in output.splitlines(True):
+    if line.startswith(prefix):
+      deps.append(line[len(prefix):].strip())
+    elif not _is_input_filename(line.strip()):
+      lines.append(line)
+  return deps, ''.join(lines)
+
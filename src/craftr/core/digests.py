@@ -0,0 +1,183 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Computes the content digests of files for up-to-date checks that do not
+depend on modification times. The #DigestCache remembers the digest of a
+file together with its size, modification time and inode, thus a file is
+only read again when any of them changed. The entries can be kept in a
+#DigestStore, like the build state database, to keep them between builds.
+"""
+
+__all__ = ['DigestCache', 'DigestStore']
+
+import hashlib
+import os
+import time
+
+from typing import Dict, Iterable, List, Optional
+
+#: Files of at least this size are hashed in parallel by #DigestCache.digests().
+PARALLEL_THRESHOLD = 1 << 20
+
+#: Files that were modified less than this many seconds before they are
+#: hashed are not cached, as they may be modified again without changing
+#: their modification time on filesystems with a coarse resolution.
+RACY_SECONDS = 2.0
+
+_CHUNK_SIZE = 1 << 16
+
+
+def hash_file(filename: str) -> str:
+  """
+  Returns the SHA-1 hex digest of the contents of *filename*.
+  """
+
+  hasher = hashlib.sha1()
+  with open(filename, 'rb') as fp:
+    for chunk in iter(lambda: fp.read(_CHUNK_SIZE), b''):
+      hasher.update(chunk)
+  return hasher.hexdigest()
+
+
+class DigestStore:
+  """
+  The interface of the persistent storage of a #DigestCache. An entry is a
+  tuple of the size, the modification time in nanoseconds, the inode and
+  the digest of a file.
+  """
+
+  def load_digests(self, filenames: List[str]) -> Dict[str, tuple]:
+    """
+    Returns the stored entries of those *filenames* that have one.
+    """
+
+    raise NotImplementedError
+
+  def store_digests(self, entries: Dict[str, Optional[tuple]]):
+    """
+    Stores the *entries*. Files that map to #None are removed.
+    """
+
+    raise NotImplementedError
+
+
+class DigestCache:
+  """
+  Computes and caches the content digests of files. If a #DigestStore is
+  specified as *store*, the entries are loaded from it when they are
+  needed and changed entries are passed to it after every call to
+  #digests(). Large files are hashed in up to *workers* threads.
+  """
+
+  def __init__(self, store: DigestStore = None, workers: int = None,
+               parallel_threshold: int = PARALLEL_THRESHOLD):
+    self.workers = workers or os.cpu_count() or 1
+    self.parallel_threshold = parallel_threshold
+    self.store = store
+    self._entries = {}  # Maps filenames to (size, mtime_ns, inode, digest)
+    self._changes = {}  # The changed entries, None for removed entries
+
+  def __len__(self):
+    return len(self._entries)
+
+  def _stat(self, filename):
+    try:
+      st = os.stat(filename)
+    except FileNotFoundError:
+      return None
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+  def _store(self, filename, key, digest, now):
+    if key[1] < now - RACY_SECONDS * 1e9:
+      self._entries[filename] = self._changes[filename] = key + (digest,)
+    elif self._entries.pop(filename, None) is not None:
+      self._changes[filename] = None
+
+  def digest(self, filename: str) -> Optional[str]:
+    """
+    Returns the digest of the file, or #None if it does not exist.
+    """
+
+    return self.digests([filename])[filename]
+
+  def digests(self, filenames: Iterable[str]) -> Dict[str, Optional[str]]:
+    """
+    Returns a dictionary that maps the *filenames* to their digests, or to
+    #None for files that do not exist. Only files that changed since they
+    were last hashed are read, large files are hashed in parallel.
+    """
+
+    filenames = list(filenames)
+    if self.store is not None:
+      missing = [x for x in set(filenames) if x not in self._entries]
+      if missing:
+        self._entries.update(self.store.load_digests(missing))
+
+    result = {}
+    small, large = [], []
+    for filename in filenames:
+      if filename in result:
+        continue
+      key = self._stat(filename)
+      if key is None:
+        result[filename] = None
+        continue
+      entry = self._entries.get(filename)
+      if entry is not None and entry[:3] == key:
+        result[filename] = entry[3]
+        continue
+      result[filename] = None
+      (large if key[0] >= self.parallel_threshold else small).append((filename, key))
+
+    now = int(time.time() * 1e9)  # time.time_ns() requires Python 3.7
+    if len(large) > 1 and self.workers > 1:
+      from concurrent.futures import ThreadPoolExecutor
+      with ThreadPoolExecutor(min(self.workers, len(large))) as executor:
+        futures = [(x, executor.submit(hash_file, x[0])) for x in large]
+        for filename, key in small:
+          result[filename] = self._hash(filename, key, now)
+        for (filename, key), future in futures:
+          try:
+            digest = future.result()
+          except FileNotFoundError:
+            continue
+          self._store(filename, key, digest, now)
+          result[filename] = digest
+    else:
+      for filename, key in small + large:
+        result[filename] = self._hash(filename, key, now)
+
+    if self._changes:
+      if self.store is not None:
+        self.store.store_digests(self._changes)
+      self._changes = {}
+    return result
+
+  def _hash(self, filename, key, now):
+    try:
+      digest = hash_file(filename)
+    except FileNotFoundError:
+      return None
+    self._store(filename, key, digest, now)
+    return digest
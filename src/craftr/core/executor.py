@@ -0,0 +1,280 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Runs the rendered commands of a build set (see #protocol.Action). The build
+client uses #run_action() to run an action in its own process. Alternatively,
+the build server runs actions on behalf of the build clients in a
+#WorkerPool of processes that are started once with the server.
+
+This module depends only on the standard library, modules that are not
+needed by the build client are imported when they are used.
+"""
+
+__all__ = ['run_action', 'spawn', 'spawn_captured', 'WorkerPool']
+
+import os
+import socket
+import sys
+
+from craftr.core import protocol
+
+
+def quote(s):
+  if os.name == 'nt':
+    return '"' + s + '"' if (' ' in s or '\t' in s) else s
+  import shlex
+  return shlex.quote(s)
+
+
+def spawn(command):
+  """
+  Runs the *command* in the environment and working directory of the
+  current process and returns its exit code.
+  """
+
+  if os.name == 'nt':
+    import subprocess
+    try:
+      return subprocess.call(command)
+    except OSError as e:
+      print(e, file=sys.stderr)
+      return 127
+  # Avoid importing the subprocess module, os.spawnvp() exits the child
+  # process with code 127 if the command can not be executed.
+  sys.stdout.flush()
+  return os.spawnvp(os.P_WAIT, command[0], command)
+
+
+def spawn_captured(command, output: bytearray):
+  """
+  Like #spawn(), but the output of the command (stdout and stderr combined)
+  is also appended to *output* before it is written to stdout.
+  """
+
+  import subprocess
+  try:
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  except OSError as e:
+    print(e, file=sys.stderr)
+    return 127
+  output += process.stdout
+  sys.stdout.buffer.write(process.stdout)
+  sys.stdout.flush()
+  return process.returncode
+
+
+def _call_with_response_file(call, command, begin, additional_args):
+  # On Windows, the arguments of the command starting from the index *begin*
+  # are moved into a response file if the command line would be too long
+  # (see #craftr.core.build.Command.with_response_file()).
+  if begin < 0 or os.name != 'nt' or sum(len(x)+1 for x in command) <= 8192:
+    return call(command + additional_args)
+  import tempfile
+  fd, filename = tempfile.mkstemp(text=True)
+  try:
+    with os.fdopen(fd, 'w', encoding='utf8') as fp:
+      for x in command[begin:]:
+        fp.write('"{}"\n'.format(x))
+    return call(command[:begin] + ['@' + filename] + additional_args)
+  finally:
+    os.remove(filename)
+
+
+def run_action(action: protocol.Action, call=spawn, error=None, verbose=False) -> int:
+  """
+  Runs the commands of the *action* and returns the exit code. The output
+  directories are created before the commands are run and the command list
+  is printed with the *error* function if a command fails or an output
+  file is missing.
+
+  The commands are run with the *call* function, which must return the exit
+  code of the command. The default (#spawn()) expects that the environment
+  and working directory of the action have been applied to the current
+  process. *error* is called like #print() and defaults to printing to
+  #sys.stderr.
+  """
+
+  if error is None:
+    error = lambda *args: print(*args, file=sys.stderr)
+
+  # Ensure that the output directories exist.
+  created_dirs = set()
+  for f in action.outputs:
+    d = os.path.dirname(f)
+    if d and d not in created_dirs:
+      os.makedirs(d, exist_ok=True)
+      created_dirs.add(d)
+
+  # Used to print the command-list on failure.
+  def print_command_list(current=-1):
+    if action.cwd:
+      error('Working directory:', action.cwd)
+    error('Command list:')
+    for i, cmd in enumerate(action.commands):
+      error('>' if current == i else ' ', '$', ' '.join(map(quote, cmd)))
+
+  if verbose:
+    print_command_list()
+
+  # Execute the subcommands, the additional_args are added to the last one.
+  last = len(action.commands) - 1
+  for i, (cmd, begin) in enumerate(zip(action.commands, action.response_args)):
+    args = action.additional_args if i == last else []
+    code = _call_with_response_file(call, cmd, begin, args)
+    if code != 0:
+      error('\n' + '-'*60)
+      error('fatal: "{}" exited with code {}.'.format(action.operator, code))
+      print_command_list(i)
+      error('-'*60 + '\n')
+      return code
+
+  # Check if all output files have been produced by the commands.
+  missing_files = [x for x in action.outputs if not os.path.exists(x)]
+  if missing_files:
+    error('\n' + '-'*60)
+    error('fatal: "{}" produced only {} of {} listed output files.'
+      .format(action.operator, len(action.outputs) - len(missing_files),
+        len(action.outputs)))
+    error('The missing files are:')
+    for x in missing_files:
+      error('  -', x)
+    print_command_list()
+    error('-'*60 + '\n')
+    return 1
+
+  return 0
+
+
+class Worker:
+  """
+  A worker process of a #WorkerPool. The #sock is connected to the worker
+  process. The build server keeps track of the connection that the worker
+  currently runs an action for in #client.
+  """
+
+  __slots__ = ('process', 'sock', 'inbuf', 'client')
+
+  def __init__(self, process, sock):
+    self.process = process
+    self.sock = sock
+    self.inbuf = bytearray()
+    self.client = None
+
+
+class WorkerPool:
+  """
+  Starts *num_workers* worker processes that run actions sent to them with
+  an #protocol.OP_RUN_ACTION frame. The processes are started with the
+  `'forkserver'` method if it is available, so that they are not forked
+  from the (possibly large) process that owns the pool, and `'spawn'`
+  otherwise.
+  """
+
+  def __init__(self, num_workers: int, verbose: bool = False, start_method: str = None):
+    import multiprocessing
+    if start_method is None:
+      methods = multiprocessing.get_all_start_methods()
+      start_method = 'forkserver' if 'forkserver' in methods else 'spawn'
+    context = multiprocessing.get_context(start_method)
+    self.workers = []
+    try:
+      for _ in range(num_workers):
+        parent, child = socket.socketpair()
+        process = context.Process(target=_worker_main, args=(child, verbose), daemon=True)
+        process.start()
+        child.close()
+        self.workers.append(Worker(process, parent))
+    except BaseException:
+      self.close()
+      raise
+
+  def close(self, timeout=5):
+    """
+    Closes the connections to the workers, which makes them exit, and waits
+    for them to terminate.
+    """
+
+    for worker in self.workers:
+      worker.sock.close()
+    for worker in self.workers:
+      worker.process.join(timeout)
+      if worker.process.is_alive():
+        worker.process.terminate()
+    self.workers = []
+
+
+def _run_streaming(command, env, cwd, send):
+  # Runs the *command* and sends its output with *send* as it is produced.
+  import subprocess
+  import threading
+  try:
+    proc = subprocess.Popen(command, env=env, cwd=cwd, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  except OSError as e:
+    send(protocol.STATUS_STDERR, '{}\n'.format(e).encode('utf8'))
+    return 127
+  def pump(fp, status):
+    with fp:
+      for data in iter(lambda: os.read(fp.fileno(), 65536), b''):
+        send(status, data)
+  thread = threading.Thread(target=pump, args=(proc.stderr, protocol.STATUS_STDERR))
+  thread.start()
+  pump(proc.stdout, protocol.STATUS_STDOUT)
+  thread.join()
+  return proc.wait()
+
+
+def _worker_main(sock, verbose):
+  import threading
+  lock = threading.Lock()
+
+  def send(status, body=b''):
+    with lock:
+      sock.sendall(protocol.encode_frame(status, body))
+
+  def error(*args):
+    send(protocol.STATUS_STDERR, (' '.join(map(str, args)) + '\n').encode('utf8'))
+
+  try:
+    while True:
+      try:
+        code, body = protocol.recv_frame(sock)
+      except (protocol.ProtocolError, OSError):
+        return  # The pool has been closed.
+      try:
+        if code != protocol.OP_RUN_ACTION:
+          raise protocol.ProtocolError('unexpected opcode: {}'.format(code))
+        action = protocol.decode_action(body)
+        env = os.environ.copy()
+        env.update(action.environ)
+        call = lambda cmd: _run_streaming(cmd, env, action.cwd, send)
+        exit_code = run_action(action, call, error, verbose)
+      except Exception as exc:
+        send(protocol.STATUS_ERROR, '{}: {}'.format(type(exc).__name__, exc).encode('utf8'))
+      else:
+        send(protocol.STATUS_OK, protocol.encode_exit_code(exit_code))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    sock.close()
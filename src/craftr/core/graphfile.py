@@ -0,0 +1,577 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This module implements the compact binary build graph format. The binary
+format contains exactly the same information as the JSON representation
+produced by #Master.to_json(), but it can be memory-mapped and decoded
+lazily, one target at a time.
+
+All integers are little-endian. The file starts with a fixed header that
+contains the magic bytes, the format version and a table of sections. Every
+section is described by its offset in the file and the number of items in it.
+
+* `STRINGS` - The end offsets (u64) of every string in the string blob.
+* `BLOB` - The UTF-8 encoded strings, back to back. Every string (including
+  filenames and JSON encoded values like commands and variables) is stored
+  only once.
+* `TARGETS` - Fixed-width target records, sorted by the target ID.
+* `OPERATORS` - Fixed-width operator records.
+* `BUILD_SETS` - Fixed-width build set records.
+* `FILE_SETS` - Fixed-width records of named input/output file lists.
+* `PATHS` - String IDs (u32) referenced by the file set records.
+* `OUTPUTS` - The offset index that maps output files to the index of the
+  producing target, sorted by the filename.
+* `COMMANDS` - The command table (see #Master.command_table()), records of
+  the command ID and its JSON encoded commands, sorted by the ID. Operator
+  records reference their commands by the ID.
+
+The item count of the `META` section is the string ID of the JSON encoded
+metadata of the graph (see #Master.get_metadata()).
+
+A graph can also be split into shards with #write_sharded(), grouping the
+targets by a shard key (the scope name). Every shard is saved to a separate
+file in the JSON or binary format and a small manifest maps target IDs and
+output files to the shards. The #ShardedGraphReader loads shards only when
+a target in them is accessed. The command table of all shards is stored in
+the manifest.
+"""
+
+__all__ = ['MAGIC', 'GraphVersionError', 'BinaryGraphWriter', 'BinaryGraphReader',
+           'ShardedGraphReader', 'detect_format', 'write_sharded']
+
+import collections
+import hashlib
+import json
+import mmap
+import nr.fs
+import os
+import re
+import struct
+
+from typing import Callable, Dict, Iterable, List, Optional
+
+MAGIC = b'CRAFTRGB'
+VERSION = 3
+NONE = 0xffffffff
+
+(STRINGS, BLOB, TARGETS, OPERATORS, BUILD_SETS, FILE_SETS, PATHS, OUTPUTS,
+ META, COMMANDS) = range(10)
+NUM_SECTIONS = 10
+
+_header = struct.Struct('<8sII')
+_section = struct.Struct('<QQ')
+_u32 = struct.Struct('<I')
+_u64 = struct.Struct('<Q')
+
+# (id, operators_begin, operators_count)
+_target = struct.Struct('<III')
+# (name, commands, variables, environ, cwd, deps_prefix, pool, flags,
+#  build_sets_begin, build_sets_count)
+_operator = struct.Struct('<IIIIIIIIII')
+# (description, environ, cwd, depfile, variables, inputs_begin, inputs_count,
+#  outputs_begin, outputs_count)
+_build_set = struct.Struct('<IIIIIIIII')
+# (name, paths_begin, paths_count)
+_file_set = struct.Struct('<III')
+# (filename, target_index)
+_output = struct.Struct('<II')
+# (command_id, commands)
+_command = struct.Struct('<II')
+
+FLAG_EXPLICIT = 1 << 0
+FLAG_SYNCIO = 1 << 1
+
+MANIFEST_MAGIC = b'{"craftr_graph_manifest": 1'
+
+
+class GraphVersionError(ValueError):
+  """
+  Raised when a graph file was written in a format that this version of
+  Craftr can not read. The graph must be configured again.
+  """
+
+
+def detect_format(filename: str) -> str:
+  """
+  Returns `'binary'` if the file starts with the binary graph #MAGIC bytes,
+  `'sharded'` if it is a manifest written by #write_sharded() and `'json'`
+  otherwise.
+  """
+
+  with open(filename, 'rb') as fp:
+    head = fp.read(len(MANIFEST_MAGIC))
+  if head.startswith(MAGIC):
+    return 'binary'
+  if head == MANIFEST_MAGIC:
+    return 'sharded'
+  return 'json'
+
+
+def _dump_value(value) -> str:
+  return json.dumps(value, sort_keys=True)
+
+
+class BinaryGraphWriter:
+  """
+  Serializes the JSON representation of a list of targets and the command
+  table (as returned by #Master.to_json()) into the binary graph format.
+  """
+
+  def __init__(self):
+    self._strings = {}
+    self._string_list = []
+
+  def _str(self, s: Optional[str]) -> int:
+    if s is None:
+      return NONE
+    index = self._strings.get(s)
+    if index is None:
+      index = self._strings[s] = len(self._string_list)
+      self._string_list.append(s)
+    return index
+
+  def _file_sets(self, file_sets: Dict[str, List[str]], records, paths):
+    begin = len(records)
+    for name in sorted(file_sets):
+      files = file_sets[name]
+      records.append(_file_set.pack(self._str(name), len(paths), len(files)))
+      paths.extend(self._str(x) for x in files)
+    return begin, len(records) - begin
+
+  def write(self, fp, targets: List[Dict], metadata: Dict = None,
+            commands: Dict[str, List] = None):
+    targets = sorted(targets, key=lambda x: x['id'])
+    target_records = []
+    operator_records = []
+    bset_records = []
+    file_set_records = []
+    paths = []
+    outputs = []
+
+    meta_id = self._str(_dump_value(metadata or {}))
+
+    for target_index, target in enumerate(targets):
+      target_records.append(_target.pack(
+        self._str(target['id']), len(operator_records), len(target['operators'])))
+      for op in target['operators']:
+        bsets_begin = len(bset_records)
+        for bset in op['build_sets']:
+          inputs = self._file_sets(bset['inputs'], file_set_records, paths)
+          outputs_range = self._file_sets(bset['outputs'], file_set_records, paths)
+          for files in bset['outputs'].values():
+            outputs.extend((x, target_index) for x in files)
+          bset_records.append(_build_set.pack(
+            self._str(bset['description']),
+            self._str(_dump_value(bset['environ'])),
+            self._str(bset['cwd']),
+            self._str(bset['depfile']),
+            self._str(_dump_value(bset['variables'])),
+            inputs[0], inputs[1], outputs_range[0], outputs_range[1]))
+        flags = (FLAG_EXPLICIT if op['explicit'] else 0) | \
+                (FLAG_SYNCIO if op['syncio'] else 0)
+        operator_records.append(_operator.pack(
+          self._str(op['name']),
+          self._str(op['commands']),
+          self._str(_dump_value(op['variables'])),
+          self._str(_dump_value(op['environ'])),
+          self._str(op['cwd']),
+          self._str(op['deps_prefix']),
+          self._str(op.get('pool')),
+          flags, bsets_begin, len(bset_records) - bsets_begin))
+
+    outputs.sort(key=lambda x: x[0])
+    output_records = [_output.pack(self._str(f), t) for f, t in outputs]
+    commands = commands or {}
+    command_records = [_command.pack(self._str(k), self._str(_dump_value(commands[k])))
+                       for k in sorted(commands)]
+
+    blob = bytearray()
+    string_offsets = []
+    for s in self._string_list:
+      blob += s.encode('utf8')
+      string_offsets.append(_u64.pack(len(blob)))
+
+    sections = [
+      (b''.join(string_offsets), len(string_offsets)),
+      (bytes(blob), len(blob)),
+      (b''.join(target_records), len(target_records)),
+      (b''.join(operator_records), len(operator_records)),
+      (b''.join(bset_records), len(bset_records)),
+      (b''.join(file_set_records), len(file_set_records)),
+      (struct.pack('<{}I'.format(len(paths)), *paths), len(paths)),
+      (b''.join(output_records), len(output_records)),
+      (b'', meta_id),
+      (b''.join(command_records), len(command_records)),
+    ]
+    assert len(sections) == NUM_SECTIONS
+
+    offset = _header.size + _section.size * NUM_SECTIONS
+    fp.write(_header.pack(MAGIC, VERSION, NUM_SECTIONS))
+    for data, count in sections:
+      fp.write(_section.pack(offset, count))
+      offset += len(data)
+    for data, count in sections:
+      fp.write(data)
+
+
+class BinaryGraphReader:
+  """
+  Reads a graph file in the binary format. The file is memory-mapped and
+  only the header is decoded when the reader is created. Targets are decoded
+  on demand with #read_target(), returning the same JSON representation that
+  #Target.from_json() accepts.
+  """
+
+  def __init__(self, filename: str):
+    self.filename = filename
+    with open(filename, 'rb') as fp:
+      self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, num_sections = _header.unpack_from(self._mm, 0)
+    if magic != MAGIC:
+      raise ValueError('{!r} is not a binary graph file'.format(filename))
+    if version != VERSION or num_sections != NUM_SECTIONS:
+      raise GraphVersionError('{!r}: unsupported binary graph version {}'
+                              .format(filename, version))
+    self._sections = [_section.unpack_from(self._mm, _header.size + _section.size * i)
+                      for i in range(NUM_SECTIONS)]
+
+  def close(self):
+    self._mm.close()
+
+  def _count(self, section: int) -> int:
+    return self._sections[section][1]
+
+  def _record(self, section: int, st: struct.Struct, index: int):
+    return st.unpack_from(self._mm, self._sections[section][0] + st.size * index)
+
+  def _str(self, index: int) -> Optional[str]:
+    if index == NONE:
+      return None
+    offsets = self._sections[STRINGS][0]
+    begin = _u64.unpack_from(self._mm, offsets + 8 * (index - 1))[0] if index else 0
+    end = _u64.unpack_from(self._mm, offsets + 8 * index)[0]
+    blob = self._sections[BLOB][0]
+    return self._mm[blob + begin:blob + end].decode('utf8')
+
+  def _value(self, index: int):
+    return json.loads(self._str(index))
+
+  def _bisect(self, section: int, st: struct.Struct, key: str) -> int:
+    lo, hi = 0, self._count(section)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._str(self._record(section, st, mid)[0]) < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def _file_sets(self, begin: int, count: int) -> Dict[str, List[str]]:
+    result = {}
+    paths_offset = self._sections[PATHS][0]
+    for i in range(begin, begin + count):
+      name, paths_begin, paths_count = self._record(FILE_SETS, _file_set, i)
+      ids = struct.unpack_from('<{}I'.format(paths_count), self._mm,
+                               paths_offset + 4 * paths_begin)
+      result[self._str(name)] = [self._str(x) for x in ids]
+    return result
+
+  def metadata(self) -> Dict:
+    return self._value(self._sections[META][1])
+
+  def commands(self) -> Dict[str, List]:
+    """
+    Returns the command table of the graph. The commands of an operator
+    returned by #read_target() are an ID in this table.
+    """
+
+    result = {}
+    for i in range(self._count(COMMANDS)):
+      command_id, commands = self._record(COMMANDS, _command, i)
+      result[self._str(command_id)] = self._value(commands)
+    return result
+
+  def target_ids(self) -> Iterable[str]:
+    for i in range(self._count(TARGETS)):
+      yield self._str(self._record(TARGETS, _target, i)[0])
+
+  def has_target(self, target_id: str) -> bool:
+    return self._find_target(target_id) is not None
+
+  def _find_target(self, target_id: str) -> Optional[int]:
+    index = self._bisect(TARGETS, _target, target_id)
+    if index < self._count(TARGETS):
+      if self._str(self._record(TARGETS, _target, index)[0]) == target_id:
+        return index
+    return None
+
+  def output_files(self) -> Iterable[str]:
+    for i in range(self._count(OUTPUTS)):
+      yield self._str(self._record(OUTPUTS, _output, i)[0])
+
+  def find_output(self, filename: str) -> Optional[str]:
+    """
+    Returns the ID of the target that produces the specified output
+    *filename*, or #None.
+    """
+
+    index = self._bisect(OUTPUTS, _output, filename)
+    if index < self._count(OUTPUTS):
+      name, target_index = self._record(OUTPUTS, _output, index)
+      if self._str(name) == filename:
+        return self._str(self._record(TARGETS, _target, target_index)[0])
+    return None
+
+  def read_target(self, target_id: str) -> Dict:
+    index = self._find_target(target_id)
+    if index is None:
+      raise KeyError(target_id)
+    return self._read_target(index)
+
+  def read_all(self) -> List[Dict]:
+    return [self._read_target(i) for i in range(self._count(TARGETS))]
+
+  def _read_target(self, index: int) -> Dict:
+    target_id, ops_begin, ops_count = self._record(TARGETS, _target, index)
+    operators = []
+    for i in range(ops_begin, ops_begin + ops_count):
+      (name, commands, variables, environ, cwd, deps_prefix, pool, flags,
+       bsets_begin, bsets_count) = self._record(OPERATORS, _operator, i)
+      build_sets = []
+      for j in range(bsets_begin, bsets_begin + bsets_count):
+        (description, bset_environ, bset_cwd, depfile, bset_variables,
+         inputs_begin, inputs_count, outputs_begin, outputs_count) = \
+            self._record(BUILD_SETS, _build_set, j)
+        build_sets.append({
+          'description': self._str(description),
+          'environ': self._value(bset_environ),
+          'cwd': self._str(bset_cwd),
+          'depfile': self._str(depfile),
+          'inputs': self._file_sets(inputs_begin, inputs_count),
+          'outputs': self._file_sets(outputs_begin, outputs_count),
+          'variables': self._value(bset_variables)})
+      operators.append({
+        'name': self._str(name),
+        'commands': self._str(commands),
+        'build_sets': build_sets,
+        'variables': self._value(variables),
+        'environ': self._value(environ),
+        'cwd': self._str(cwd),
+        'explicit': bool(flags & FLAG_EXPLICIT),
+        'syncio': bool(flags & FLAG_SYNCIO),
+        'deps_prefix': self._str(deps_prefix),
+        'pool': self._str(pool)})
+    return {'id': self._str(target_id), 'operators': operators}
+
+
+def _shard_filename(key: str, used: set) -> str:
+  name = re.sub(r'[^\w\.\-]+', '_', key) or '_'
+  result, index = name, 1
+  while result.lower() in used:
+    index += 1
+    result = '{}-{}'.format(name, index)
+  used.add(result.lower())
+  return result
+
+
+def write_sharded(filename: str, targets: List[Dict], metadata: Dict,
+                  shard_key: Callable[[str], str], format: str = 'json',
+                  commands: Dict[str, List] = None):
+  """
+  Writes the JSON representation of the *targets* into one file per shard
+  and a manifest with the *commands* table to *filename*. The shard files are saved in a directory
+  next to the manifest. A shard file is only rewritten if its contents
+  changed, and shard files that are no longer referenced are removed.
+
+  Returns the keys of the shards that have been written or removed.
+  """
+
+  if format not in ('json', 'binary'):
+    raise ValueError('invalid shard format: {!r}'.format(format))
+
+  shard_dir = filename + '.d'
+  try:
+    with open(filename) as fp:
+      old_manifest = json.load(fp)
+  except (FileNotFoundError, ValueError):
+    old_manifest = {}
+  old_hashes = {}
+  if old_manifest.get('format') == format:
+    old_hashes = dict(zip(old_manifest['shards'], old_manifest['hashes']))
+
+  groups = collections.OrderedDict()
+  for data in sorted(targets, key=lambda x: x['id']):
+    groups.setdefault(shard_key(data['id']), []).append(data)
+  changed = [x for x in old_manifest.get('keys', []) if x not in groups]
+
+  used = set()
+  shard_files, shard_hashes = [], []
+  target_list, output_map = [], {}
+  nr.fs.makedirs(shard_dir)
+  for index, (key, shard) in enumerate(groups.items()):
+    shard_file = _shard_filename(key, used) + ('.json' if format == 'json' else '.bin')
+    encoded = json.dumps(shard, sort_keys=True)
+    shard_hash = hashlib.sha1(encoded.encode('utf8')).hexdigest()
+    shard_files.append(shard_file)
+    shard_hashes.append(shard_hash)
+    for data in shard:
+      target_index = len(target_list)
+      target_list.append([data['id'], index])
+      for op in data['operators']:
+        for bset in op['build_sets']:
+          for files in bset['outputs'].values():
+            output_map.update((x, target_index) for x in files)
+    path = os.path.join(shard_dir, shard_file)
+    if old_hashes.get(shard_file) == shard_hash and os.path.isfile(path):
+      continue
+    changed.append(key)
+    if format == 'json':
+      with open(path, 'w') as fp:
+        fp.write(encoded)
+    else:
+      with open(path, 'wb') as fp:
+        BinaryGraphWriter().write(fp, shard)
+
+  for name in os.listdir(shard_dir):
+    if name not in shard_files:
+      os.remove(os.path.join(shard_dir, name))
+
+  # Keep the magic key first, it is used by detect_format().
+  manifest = collections.OrderedDict()
+  manifest['craftr_graph_manifest'] = 1
+  manifest['format'] = format
+  manifest['metadata'] = metadata
+  manifest['shards'] = shard_files
+  manifest['hashes'] = shard_hashes
+  manifest['keys'] = list(groups.keys())
+  manifest['targets'] = target_list
+  manifest['outputs'] = output_map
+  manifest['commands'] = commands or {}
+  with open(filename, 'w') as fp:
+    json.dump(manifest, fp)
+  return changed
+
+
+class ShardedGraphReader:
+  """
+  Reads a graph that was written with #write_sharded(). Only the manifest
+  is parsed when the reader is created, shards are loaded when a target in
+  them is read. This class provides the same interface as the
+  #BinaryGraphReader.
+  """
+
+  def __init__(self, filename: str):
+    self.filename = filename
+    self._shards = {}
+    self._load_manifest()
+
+  def _load_manifest(self):
+    with open(self.filename) as fp:
+      self._manifest = json.load(fp)
+    self._keys = {k: i for i, k in enumerate(self._manifest['keys'])}
+    self._targets = dict(self._manifest['targets'])
+
+  def _shard(self, index: int):
+    shard = self._shards.get(index)
+    if shard is None:
+      path = os.path.join(self.filename + '.d', self._manifest['shards'][index])
+      if self._manifest['format'] == 'binary':
+        shard = BinaryGraphReader(path)
+      else:
+        with open(path) as fp:
+          shard = {x['id']: x for x in json.load(fp)}
+      self._shards[index] = shard
+    return shard
+
+  def close(self):
+    for shard in self._shards.values():
+      if isinstance(shard, BinaryGraphReader):
+        shard.close()
+    self._shards = {}
+
+  def metadata(self) -> Dict:
+    return self._manifest['metadata']
+
+  def commands(self) -> Dict[str, List]:
+    return self._manifest['commands']
+
+  def target_ids(self) -> Iterable[str]:
+    return iter(self._targets)
+
+  def has_target(self, target_id: str) -> bool:
+    return target_id in self._targets
+
+  def output_files(self) -> Iterable[str]:
+    return iter(self._manifest['outputs'])
+
+  def find_output(self, filename: str) -> Optional[str]:
+    index = self._manifest['outputs'].get(filename)
+    if index is None:
+      return None
+    return self._manifest['targets'][index][0]
+
+  def read_target(self, target_id: str) -> Dict:
+    shard = self._shard(self._targets[target_id])
+    if isinstance(shard, BinaryGraphReader):
+      return shard.read_target(target_id)
+    return shard[target_id]
+
+  def read_all(self) -> List[Dict]:
+    return [self.read_target(x) for x in self._targets]
+
+  def shard_keys(self) -> List[str]:
+    return list(self._manifest['keys'])
+
+  def shard_of(self, target_id: str) -> Optional[str]:
+    index = self._targets.get(target_id)
+    return None if index is None else self._manifest['keys'][index]
+
+  def shard_hash(self, key: str) -> Optional[str]:
+    """
+    Returns the hash of the contents of the shard with the specified *key*,
+    or #None if there is no such shard.
+    """
+
+    index = self._keys.get(key)
+    return None if index is None else self._manifest['hashes'][index]
+
+  def shard_target_ids(self, key: str) -> List[str]:
+    index = self._keys.get(key)
+    return [k for k, v in self._targets.items() if v == index]
+
+  def reload_shard(self, key: str):
+    """
+    Re-reads the manifest and discards the cached contents of the shard
+    with the specified *key*, so it is read again when it is accessed.
+    """
+
+    index = self._keys.get(key)
+    shard = self._shards.pop(index, None)
+    if isinstance(shard, BinaryGraphReader):
+      shard.close()
+    old_files = self._manifest['shards']
+    self._load_manifest()
+    # Shard indices may have changed if shards were added or removed.
+    if old_files != self._manifest['shards']:
+      self.close()
@@ -0,0 +1,361 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The binary protocol that is spoken between the build server and the build
+client of the Ninja backend. This module depends only on the standard
+library so that it can be imported cheaply by the client processes.
+
+Every message is a frame that consists of the length of the payload as an
+unsigned 32-bit integer (big-endian) and the payload. A request payload
+starts with an opcode byte followed by the arguments of the request, a
+response payload starts with a status byte followed by the response body.
+Strings are encoded as their length (u32) followed by the UTF-8 bytes.
+
+* #OP_GET_BUILD_SET - Arguments: target ID, operator name (strings) and the
+  build set index (u32). The body is the JSON encoded build set information.
+* #OP_RELOAD - Arguments: the shard key (string, empty to reload the whole
+  graph). The body is empty.
+* #OP_GET_ACTION - Arguments: like #OP_GET_BUILD_SET. The body is the
+  #Action of the build set, encoded with #encode_action().
+* #OP_RUN - Arguments: like #OP_GET_BUILD_SET, followed by the expected
+  hash of the build set (string). The server runs the action and responds
+  with any number of #STATUS_STDOUT and #STATUS_STDERR frames that contain
+  the output of the commands, followed by a #STATUS_OK frame whose body is
+  the exit code (see #encode_exit_code()).
+* #OP_RUN_ACTION - Sent by the build server to its worker processes. The
+  body is an encoded #Action, the responses are the same as for #OP_RUN.
+
+If the status is #STATUS_ERROR, the body is a UTF-8 encoded error message.
+
+The address of a build server is a string in the form `unix:<path>` for a
+Unix domain socket or `<host>:<port>` for a TCP socket.
+"""
+
+__all__ = ['ProtocolError', 'Action', 'encode_frame', 'split_frame',
+           'recv_frame', 'encode_str', 'decode_str', 'encode_list',
+           'decode_list', 'get_build_set_request', 'get_action_request',
+           'run_request', 'reload_request', 'encode_exit_code',
+           'decode_exit_code', 'parse_request', 'encode_action',
+           'decode_action', 'request', 'parse_address', 'connect']
+
+import socket
+import struct
+
+OP_GET_BUILD_SET = 1
+OP_RELOAD = 2
+OP_GET_ACTION = 3
+OP_RUN = 4
+OP_RUN_ACTION = 5
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_STDOUT = 2
+STATUS_STDERR = 3
+
+NONE = 0xffffffff
+
+_u32 = struct.Struct('!I')
+_i32 = struct.Struct('!i')
+_header = struct.Struct('!IB')  # (payload size, opcode or status)
+
+
+class ProtocolError(Exception):
+  pass
+
+
+class Action:
+  """
+  The rendered commands of a build set and everything else that is needed
+  to run them, without a reference to the build graph.
+
+  # Attributes
+  operator (str): The ID of the operator, used in error messages.
+  hash (str): The hash of the build set.
+  cwd (str): The working directory or #None.
+  environ (Dict[str, str]): The environment variables to set.
+  commands (List[List[str]]): The rendered commands.
+  response_args (List[int]): For every command, the index of the first
+    argument that may be moved into a response file, or -1 if the command
+    does not support response files.
+  additional_args (List[str]): Arguments to append to the last command.
+  outputs (List[str]): The output files of the build set.
+  inputs (List[str]): The input files of the build set.
+  depfile (str): The depfile written by the commands or #None.
+  deps_prefix (str): The prefix of the lines in the output of the commands
+    that name included files (see #craftr.core.depslog) or #None.
+  """
+
+  __slots__ = ('operator', 'hash', 'cwd', 'environ', 'commands',
+               'response_args', 'additional_args', 'outputs', 'inputs',
+               'depfile', 'deps_prefix')
+
+  def __init__(self, operator, hash, cwd, environ, commands, response_args,
+               additional_args, outputs, inputs=None, depfile=None, deps_prefix=None):
+    self.operator = operator
+    self.hash = hash
+    self.cwd = cwd
+    self.environ = environ
+    self.commands = commands
+    self.response_args = response_args
+    self.additional_args = additional_args
+    self.outputs = outputs
+    self.inputs = inputs or []
+    self.depfile = depfile
+    self.deps_prefix = deps_prefix
+
+  @classmethod
+  def from_build_set(cls, bset, additional_args=None) -> 'Action':
+    """
+    Renders the #craftr.core.build.BuildSet *bset* into an action.
+    """
+
+    operator = bset.operator
+    return cls(
+      operator = operator.id,
+      hash = bset.compute_hash(),
+      cwd = bset.get_cwd(),
+      environ = dict(bset.get_environ()),
+      commands = bset.get_commands(),
+      response_args = [x.response_args_begin if x.supports_response_file else -1
+                       for x in operator.commands],
+      additional_args = additional_args or [],
+      outputs = [x for files in bset.outputs.values() for x in files],
+      inputs = [x for files in bset.inputs.values() for x in files],
+      depfile = bset.depfile,
+      deps_prefix = operator.deps_prefix)
+
+  def __eq__(self, other):
+    if not isinstance(other, Action):
+      return NotImplemented
+    return all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+
+def encode_frame(code: int, body: bytes = b'') -> bytes:
+  """
+  Encodes a frame with the opcode or status *code* and the *body*.
+  """
+
+  return _header.pack(len(body) + 1, code) + body
+
+
+def encode_str(s: str) -> bytes:
+  data = s.encode('utf8')
+  return _u32.pack(len(data)) + data
+
+
+def decode_str(data: bytes, offset: int):
+  """
+  Decodes a string at *offset* in *data*. Returns the string and the offset
+  after the string.
+  """
+
+  size = _u32.unpack_from(data, offset)[0]
+  offset += 4
+  if offset + size > len(data):
+    raise ProtocolError('truncated string')
+  return data[offset:offset+size].decode('utf8'), offset + size
+
+
+def encode_list(strings) -> bytes:
+  return _u32.pack(len(strings)) + b''.join(encode_str(x) for x in strings)
+
+
+def decode_list(data: bytes, offset: int):
+  count = _u32.unpack_from(data, offset)[0]
+  offset += 4
+  result = []
+  for _ in range(count):
+    value, offset = decode_str(data, offset)
+    result.append(value)
+  return result, offset
+
+
+def get_build_set_request(target: str, operator: str, build_set: int) -> bytes:
+  body = encode_str(target) + encode_str(operator) + _u32.pack(build_set)
+  return encode_frame(OP_GET_BUILD_SET, body)
+
+
+def get_action_request(target: str, operator: str, build_set: int) -> bytes:
+  body = encode_str(target) + encode_str(operator) + _u32.pack(build_set)
+  return encode_frame(OP_GET_ACTION, body)
+
+
+def run_request(target: str, operator: str, build_set: int, hash: str) -> bytes:
+  body = encode_str(target) + encode_str(operator) + _u32.pack(build_set) + encode_str(hash)
+  return encode_frame(OP_RUN, body)
+
+
+def encode_exit_code(code: int) -> bytes:
+  return _i32.pack(code)
+
+
+def decode_exit_code(data: bytes) -> int:
+  return _i32.unpack(data)[0]
+
+
+def reload_request(shard: str = None) -> bytes:
+  return encode_frame(OP_RELOAD, encode_str(shard or ''))
+
+
+def parse_request(code: int, body: bytes):
+  """
+  Decodes the arguments of a request with the opcode *code*. Returns a
+  tuple of the arguments. Raises a #ProtocolError for malformed requests.
+  """
+
+  try:
+    if code in (OP_GET_BUILD_SET, OP_GET_ACTION, OP_RUN):
+      target, offset = decode_str(body, 0)
+      operator, offset = decode_str(body, offset)
+      build_set = _u32.unpack_from(body, offset)[0]
+      if code == OP_RUN:
+        return (target, operator, build_set, decode_str(body, offset + 4)[0])
+      return (target, operator, build_set)
+    elif code == OP_RELOAD:
+      return (decode_str(body, 0)[0] or None,)
+  except (struct.error, UnicodeDecodeError) as exc:
+    raise ProtocolError('malformed request: {}'.format(exc))
+  raise ProtocolError('unknown opcode: {}'.format(code))
+
+
+def encode_action(action: Action) -> bytes:
+  parts = [encode_str(action.operator), encode_str(action.hash),
+           encode_str(action.cwd or '')]
+  parts.append(encode_list([x for item in sorted(action.environ.items()) for x in item]))
+  parts.append(_u32.pack(len(action.commands)))
+  for command, begin in zip(action.commands, action.response_args):
+    parts.append(_u32.pack(NONE if begin < 0 else begin))
+    parts.append(encode_list(command))
+  parts.append(encode_list(action.additional_args))
+  parts.append(encode_list(action.outputs))
+  parts.append(encode_list(action.inputs))
+  parts.append(encode_str(action.depfile or ''))
+  parts.append(encode_str(action.deps_prefix or ''))
+  return b''.join(parts)
+
+
+def decode_action(data: bytes) -> Action:
+  try:
+    operator, offset = decode_str(data, 0)
+    hash, offset = decode_str(data, offset)
+    cwd, offset = decode_str(data, offset)
+    environ, offset = decode_list(data, offset)
+    count = _u32.unpack_from(data, offset)[0]
+    offset += 4
+    commands, response_args = [], []
+    for _ in range(count):
+      begin = _u32.unpack_from(data, offset)[0]
+      command, offset = decode_list(data, offset + 4)
+      commands.append(command)
+      response_args.append(-1 if begin == NONE else begin)
+    additional_args, offset = decode_list(data, offset)
+    outputs, offset = decode_list(data, offset)
+    inputs, offset = decode_list(data, offset)
+    depfile, offset = decode_str(data, offset)
+    deps_prefix, offset = decode_str(data, offset)
+  except (struct.error, UnicodeDecodeError) as exc:
+    raise ProtocolError('malformed action: {}'.format(exc))
+  environ = dict(zip(environ[::2], environ[1::2]))
+  return Action(operator, hash, cwd or None, environ, commands, response_args,
+                additional_args, outputs, inputs, depfile or None, deps_prefix or None)
+
+
+def split_frame(buffer: bytearray):
+  """
+  Removes the first complete frame from *buffer* and returns the code and
+  the body of the frame, or #None if the buffer does not contain a complete
+  frame yet.
+  """
+
+  if len(buffer) < _header.size:
+    return None
+  size, code = _header.unpack_from(buffer, 0)
+  if len(buffer) < 4 + size:
+    return None
+  body = bytes(buffer[_header.size:4+size])
+  del buffer[:4+size]
+  return code, body
+
+
+def recv_frame(sock: socket.socket):
+  """
+  Receives a frame from the blocking socket *sock*. Returns the code and
+  the body of the frame. Raises a #ProtocolError if the connection is
+  closed before the frame is complete.
+  """
+
+  header = _recvall(sock, _header.size)
+  size, code = _header.unpack(header)
+  return code, _recvall(sock, size - 1)
+
+
+def _recvall(sock, size):
+  chunks = []
+  while size > 0:
+    data = sock.recv(size)
+    if not data:
+      raise ProtocolError('connection closed')
+    chunks.append(data)
+    size -= len(data)
+  return b''.join(chunks)
+
+
+def request(sock: socket.socket, frame: bytes) -> bytes:
+  """
+  Sends the request *frame* over *sock* and returns the body of the
+  response. Raises a #RuntimeError if the server responds with an error.
+  """
+
+  sock.sendall(frame)
+  status, body = recv_frame(sock)
+  if status != STATUS_OK:
+    raise RuntimeError(body.decode('utf8'))
+  return body
+
+
+def parse_address(address: str):
+  """
+  Parses a build server *address* and returns a tuple of the socket family
+  and the address that can be passed to #socket.socket.connect().
+  """
+
+  if address.startswith('unix:'):
+    if not hasattr(socket, 'AF_UNIX'):
+      raise ValueError('Unix domain sockets are not supported on this platform')
+    return socket.AF_UNIX, address[5:]
+  host, sep, port = address.rpartition(':')
+  if not sep or not host or not port.isdigit():
+    raise ValueError('invalid build server address: {!r}'.format(address))
+  return socket.AF_INET, (host, int(port))
+
+
+def connect(address: str) -> socket.socket:
+  family, address = parse_address(address)
+  sock = socket.socket(family, socket.SOCK_STREAM)
+  try:
+    sock.connect(address)
+  except BaseException:
+    sock.close()
+    raise
+  return sock
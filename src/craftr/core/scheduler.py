@@ -0,0 +1,355 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Analyzes the dependencies between build sets for scheduling. A #Schedule
+computes the dependency level of every build set, the critical path through
+the graph and the slack of every build set, all in linear time. Cycles are
+reported with the chain of build sets that form the cycle.
+
+Backends drive the build with a #ReadyQueue, which hands out build sets
+whose inputs are all done. The build sets on the longest remaining path
+are handed out first. The queue also enforces the depth of the pools that
+operators are assigned to (see #Master.declare_pool()).
+"""
+
+__all__ = ['CycleError', 'Schedule', 'ReadyQueue']
+
+import collections
+import heapq
+
+from nr.collections import abc
+from typing import Callable, Iterable, List, Mapping, Union
+
+#: The weight of build sets for which no duration is known.
+DEFAULT_DURATION = 1.0
+
+
+class CycleError(RuntimeError):
+  """
+  Raised when the build sets contain a dependency cycle. The #chain is a
+  list of the build sets that form the cycle, where every build set depends
+  on the previous one and the first depends on the last.
+  """
+
+  def __init__(self, chain):
+    self.chain = chain
+
+  def __str__(self):
+    names = [x.operator.id if x.operator else repr(x) for x in self.chain]
+    return 'dependency cycle: ' + ' -> '.join(names + names[:1])
+
+
+class _Node:
+
+  __slots__ = ('build_set', 'inputs', 'consumers', 'duration', 'level',
+               'earliest_finish', 'latest_finish', 'remaining')
+
+  def __init__(self, build_set):
+    self.build_set = build_set
+    self.inputs = []
+    self.consumers = []
+    self.duration = DEFAULT_DURATION
+    self.level = 0
+    self.earliest_finish = 0.0
+    self.latest_finish = 0.0
+    self.remaining = 0.0  # Longest path from the start of this node to the end
+
+
+class Schedule:
+  """
+  Computes scheduling information for the specified *build_sets* and all
+  build sets that they depend on.
+
+  *durations* can be a mapping or a function that returns the expected
+  duration of a build set in seconds, or #None if it is unknown, for
+  example from the durations of previous builds. Build sets with unknown
+  durations are weighted with #DEFAULT_DURATION.
+
+  Raises a #CycleError if the build sets contain a dependency cycle.
+  """
+
+  def __init__(self, build_sets: Iterable['BuildSet'],
+               durations: Union[Mapping, Callable] = None):
+    if isinstance(durations, abc.Mapping):
+      durations = durations.get
+    self._nodes = {}
+
+    queue = collections.deque(build_sets)
+    while queue:
+      bset = queue.popleft()
+      if bset in self._nodes:
+        continue
+      node = self._nodes[bset] = _Node(bset)
+      if durations is not None:
+        duration = durations(bset)
+        if duration is not None:
+          node.duration = duration
+      node.inputs = list(bset.get_input_build_sets())
+      queue.extend(node.inputs)
+
+    for node in self._nodes.values():
+      node.inputs = [self._nodes[x] for x in node.inputs]
+      for x in node.inputs:
+        x.consumers.append(node)
+
+    self._order = self._topo_sort()
+
+    # Forward pass: dependency levels and earliest finish times.
+    for node in self._order:
+      start = 0.0
+      for x in node.inputs:
+        node.level = max(node.level, x.level + 1)
+        start = max(start, x.earliest_finish)
+      node.earliest_finish = start + node.duration
+
+    self._makespan = max((x.earliest_finish for x in self._order), default=0.0)
+
+    # Backward pass: latest finish times and the longest remaining paths.
+    for node in reversed(self._order):
+      finish = self._makespan
+      remaining = 0.0
+      for x in node.consumers:
+        finish = min(finish, x.latest_finish - x.duration)
+        remaining = max(remaining, x.remaining)
+      node.latest_finish = finish
+      node.remaining = remaining + node.duration
+
+  def _topo_sort(self) -> List[_Node]:
+    in_degree = {node: len(node.inputs) for node in self._nodes.values()}
+    queue = collections.deque(k for k, v in in_degree.items() if v == 0)
+    order = []
+    while queue:
+      node = queue.popleft()
+      order.append(node)
+      for x in node.consumers:
+        in_degree[x] -= 1
+        if in_degree[x] == 0:
+          queue.append(x)
+
+    if len(order) != len(self._nodes):
+      # Every node that was not reached has an input that was not reached
+      # either. Following these inputs must eventually lead into a cycle.
+      node = next(k for k, v in in_degree.items() if v > 0)
+      visited = {}
+      chain = []
+      while node not in visited:
+        visited[node] = len(chain)
+        chain.append(node)
+        node = next(x for x in node.inputs if in_degree[x] > 0)
+      chain = chain[visited[node]:]
+      chain.reverse()
+      raise CycleError([x.build_set for x in chain])
+
+    return order
+
+  def __len__(self):
+    return len(self._nodes)
+
+  def __contains__(self, build_set):
+    return build_set in self._nodes
+
+  @property
+  def order(self) -> List['BuildSet']:
+    """
+    The build sets in topological order, ordered by their dependency level.
+    """
+
+    return [x.build_set for x in self._order]
+
+  @property
+  def makespan(self) -> float:
+    """
+    The total duration of the build with unlimited parallelism, which is
+    the duration of the #critical_path().
+    """
+
+    return self._makespan
+
+  def levels(self) -> List[List['BuildSet']]:
+    """
+    Returns the build sets grouped by their dependency level. Build sets
+    without inputs have level 0, every other build set has a level one
+    higher than its highest input. Build sets of the same level never
+    depend on each other.
+    """
+
+    result = []
+    for node in self._order:
+      if node.level == len(result):
+        result.append([])
+      result[node.level].append(node.build_set)
+    return result
+
+  def level(self, build_set: 'BuildSet') -> int:
+    return self._nodes[build_set].level
+
+  def duration(self, build_set: 'BuildSet') -> float:
+    return self._nodes[build_set].duration
+
+  def slack(self, build_set: 'BuildSet') -> float:
+    """
+    Returns how much the build set can be delayed without delaying the
+    build, assuming unlimited parallelism. Build sets on the critical path
+    have no slack.
+    """
+
+    node = self._nodes[build_set]
+    return node.latest_finish - node.earliest_finish
+
+  def remaining(self, build_set: 'BuildSet') -> float:
+    """
+    Returns the duration of the longest path from the start of the build
+    set to the end of the build. The #ReadyQueue uses it as priority.
+    """
+
+    return self._nodes[build_set].remaining
+
+  def critical_path(self) -> List['BuildSet']:
+    """
+    Returns the longest chain of build sets by duration, in the order in
+    which they have to be built.
+    """
+
+    if not self._order:
+      return []
+    node = max((x for x in self._order if not x.inputs), key=lambda x: x.remaining)
+    path = [node.build_set]
+    while node.consumers:
+      node = max(node.consumers, key=lambda x: x.remaining)
+      path.append(node.build_set)
+    return path
+
+  def ready_queue(self, pools: Mapping[str, int] = None) -> 'ReadyQueue':
+    return ReadyQueue(self, pools)
+
+
+class ReadyQueue:
+  """
+  Hands out the build sets of a #Schedule as soon as all of their inputs
+  are done. Use #pop() to retrieve the next build set and #done() when it
+  is finished. Multiple build sets can be in progress at the same time.
+  The queue is true-ish as long as not all build sets are done.
+
+  Build sets with the longest remaining path are returned first, which
+  keeps the critical path busy when building in parallel.
+
+  *pools* maps pool names to their depth (see #Master.get_pool_depths()).
+  A build set whose operator is in a pool is not handed out while as many
+  build sets of the pool are in progress as its depth allows. Pools that
+  are not listed in *pools* are not limited.
+  """
+
+  def __init__(self, schedule: Schedule, pools: Mapping[str, int] = None):
+    self._schedule = schedule
+    self._pending = {}
+    self._ready = []
+    self._counter = 0
+    self._running = set()
+    self._pools = dict(pools or {})
+    self._pool_usage = collections.Counter()
+    self._waiting = collections.defaultdict(list)  # Ready nodes of full pools
+    for node in schedule._order:
+      if node.inputs:
+        self._pending[node] = len(node.inputs)
+      else:
+        self._push(node)
+
+  def _push(self, node):
+    # The counter keeps the order stable for nodes of equal priority.
+    heapq.heappush(self._ready, (-node.remaining, self._counter, node))
+    self._counter += 1
+
+  def _pool(self, node):
+    operator = node.build_set.operator
+    pool = operator.get_pool() if operator is not None else None
+    return pool if pool in self._pools else None
+
+  def _settle(self):
+    # Move ready nodes whose pool is full out of the way, they are pushed
+    # back when a build set of the pool is done.
+    while self._ready:
+      node = self._ready[0][2]
+      pool = self._pool(node)
+      if pool is None or self._pool_usage[pool] < self._pools[pool]:
+        break
+      heapq.heappush(self._waiting[pool], heapq.heappop(self._ready))
+
+  def __bool__(self):
+    return bool(self._ready or self._pending or self._running or
+                any(self._waiting.values()))
+
+  def has_ready(self) -> bool:
+    self._settle()
+    return bool(self._ready)
+
+  @property
+  def running(self) -> int:
+    return len(self._running)
+
+  def pop(self) -> 'BuildSet':
+    """
+    Returns the next build set whose inputs are all done, or #None if no
+    build set is ready at the moment.
+    """
+
+    self._settle()
+    if not self._ready:
+      return None
+    node = heapq.heappop(self._ready)[2]
+    pool = self._pool(node)
+    if pool is not None:
+      self._pool_usage[pool] += 1
+    self._running.add(node)
+    return node.build_set
+
+  def _release(self, build_set):
+    node = self._schedule._nodes[build_set]
+    self._running.remove(node)
+    pool = self._pool(node)
+    if pool is not None:
+      self._pool_usage[pool] -= 1
+      if self._waiting[pool]:
+        heapq.heappush(self._ready, heapq.heappop(self._waiting[pool]))
+    return node
+
+  def failed(self, build_set: 'BuildSet'):
+    """
+    Marks a build set that was returned by #pop() as failed. The build sets
+    that depend on it never become ready, thus the queue stays true-ish.
+    """
+
+    self._release(build_set)
+
+  def done(self, build_set: 'BuildSet'):
+    """
+    Marks a build set that was returned by #pop() as done. Build sets that
+    only waited for this build set become ready.
+    """
+
+    node = self._release(build_set)
+    for x in node.consumers:
+      self._pending[x] -= 1
+      if self._pending[x] == 0:
+        del self._pending[x]
+        self._push(x)
@@ -37,10 +37,10 @@ list of values, however that can only be determined at render time.
 
 __all__ = ['TemplateCompiler']
 
-import collections
+import functools
 import re
 
-from nr.stream import Stream as stream
+from nr.collections import abc
 from nr.sumtype import Constructor, Sumtype, add_constructor_tests
 from typing import List
 
@@ -64,6 +64,35 @@ class _Part(Sumtype):
     return self.val
 
 
+def _is_seq(value):
+  return isinstance(value, abc.Sequence) and not isinstance(value, str)
+
+
+def _join_expr(exprs):
+  if not exprs:
+    return "''"
+  if len(exprs) == 1:
+    return exprs[0]
+  return "''.join(({}))".format(', '.join(exprs))
+
+
+def _emit_expand(lines, indent, before, name, after):
+  # Appends the lines that return the list of the elements of the sequence
+  # *name*, each surrounded with the expressions in *before* and *after*.
+  item = []
+  if before:
+    lines.append('{}p = {}'.format(indent, _join_expr(before)))
+    item.append('p')
+  item.append('str(x)')
+  if after:
+    lines.append('{}s = {}'.format(indent, _join_expr(after)))
+    item.append('s')
+  if len(item) == 1:
+    lines.append('{}return list(map(str, {}))'.format(indent, name))
+  else:
+    lines.append('{}return [{} for x in {}]'.format(indent, ' + '.join(item), name))
+
+
 class _Template:
 
   def __init__(self, parts):
@@ -80,6 +109,7 @@ class _Template:
       raise ValueError('multiple file references in the same string not '
                        'allowed, got [{}]'.format(names))
     self._has_file_set = len(file_sets) != 0
+    self._render_fast = None  # Generated on the first call to render()
 
   def __str__(self):
     return ''.join(x.to_str() for x in self._parts)
@@ -99,6 +129,77 @@ class _Template:
     return [x for x in self._parts if x.is_var()]
 
   def render(self, inputs, outputs, variables, safe=False):
+    """
+    Renders the template and returns a list of strings. If *safe* is #True,
+    missing variables and file sets are substituted by empty values rather
+    than raising a #KeyError.
+
+    The template is compiled to a specialized Python function on the first
+    render. The generic implementation is used in safe mode and for values
+    that the generated function does not handle (see #_generate()).
+    """
+
+    if safe:
+      return self._render_generic(inputs, outputs, variables, True)
+    return self._get_render_fast()(inputs, outputs, variables)
+
+  def _get_render_fast(self):
+    if self._render_fast is None:
+      self._render_fast = self._generate()
+    return self._render_fast
+
+  def _generate(self):
+    """
+    Generates a Python function that renders this template and returns it.
+    The function concatenates the constant strings and the values of the
+    template in a single join and expands the file set (if any) in a list
+    comprehension. If a variable contains a sequence, the function falls
+    back to #_render_generic(), unless it is the only variable and the
+    template does not reference a file set.
+
+    The values are looked up and checked in the order of the parts, so that
+    the generated function raises the same errors as #_render_generic().
+    """
+
+    lines = ['def render(inputs, outputs, variables):']
+    before, after = [], []  # Expressions before and after the expanded part
+    expand = None  # The name of the local that holds the expanded sequence
+    single_var = len(self.vars()) == 1 and not self._has_file_set
+    for index, x in enumerate(self._parts):
+      dest = before if expand is None else after
+      if x.is_str():
+        dest.append(repr(str(x.val)))
+      elif x.is_file_set():
+        expand = 'f{}'.format(index)
+        source = 'inputs' if x.type == '<' else 'outputs'
+        lines.append('  {} = {}[{!r}]'.format(expand, source, x.name))
+      else:
+        var = 'v{}'.format(index)
+        lines.append('  {} = variables[{!r}]'.format(var, x.name))
+        dest.append('str({})'.format(var))
+        if not single_var:
+          lines.append('  if type({0}) is not str and _is_seq({0}):'.format(var))
+          lines.append('    return generic(inputs, outputs, variables)')
+
+    if single_var:
+      # The other parts are constant strings, thus the sequence can be
+      # checked after all of them have been collected.
+      var = 'v{}'.format(next(i for i, x in enumerate(self._parts) if x.is_var()))
+      index = before.index('str({})'.format(var))
+      lines.append('  if type({0}) is not str and _is_seq({0}):'.format(var))
+      _emit_expand(lines, '    ', before[:index], var, before[index+1:])
+
+    if expand is None:
+      lines.append('  return [{}]'.format(_join_expr(before)))
+    else:
+      _emit_expand(lines, '  ', before, expand, after)
+
+    code = compile('\n'.join(lines), '<template {!r}>'.format(str(self)), 'exec')
+    scope = {'_is_seq': _is_seq, 'generic': self._render_generic}
+    exec(code, scope)
+    return scope['render']
+
+  def _render_generic(self, inputs, outputs, variables, safe=False):
     prefix = ''
     expandable = None
     suffix = ''
@@ -108,7 +209,7 @@ class _Template:
           value = variables.get(x.name, '')
         else:
           value = variables[x.name]
-        is_seq = isinstance(value, collections.Sequence) and \
+        is_seq = isinstance(value, abc.Sequence) and \
                  not isinstance(value, str)
         if is_seq and self._has_file_set:
           raise ValueError('variable {} can not be expanded as it contains '
@@ -157,12 +258,21 @@ class _TemplateList:
   def __init__(self, templates, concat=True):
     self._templates = templates
     self._concat = concat
+    self._render_fast = None  # The generated functions of the templates
 
   def render(self, inputs, outputs, variables, safe=False):
-    items = (x.render(inputs, outputs, variables, safe) for x in self._templates)
-    if self._concat:
-      items = stream.concat(items)
-    return list(items)
+    if not self._concat:
+      return [x.render(inputs, outputs, variables, safe) for x in self._templates]
+    result = []
+    if safe:
+      for x in self._templates:
+        result += x.render(inputs, outputs, variables, True)
+      return result
+    if self._render_fast is None:
+      self._render_fast = [x._get_render_fast() for x in self._templates]
+    for func in self._render_fast:
+      result += func(inputs, outputs, variables)
+    return result
 
   def occurences(self, inputs, outputs, variables):
     for x in self._templates:
@@ -170,15 +280,40 @@ class _TemplateList:
     return inputs, outputs, variables
 
 
+#: The maximum number of compiled templates that are cached.
+CACHE_SIZE = 8192
+
+
+@functools.lru_cache(CACHE_SIZE)
+def _compile_cached(compiler_type, arg):
+  return compiler_type._compile(arg)
+
+
+@functools.lru_cache(CACHE_SIZE)
+def _compile_list_cached(compiler_type, arg):
+  return _TemplateList([_compile_cached(compiler_type, x) for x in arg], concat=True)
+
+
 class TemplateCompiler:
+  """
+  Compiles strings to templates. Compiled templates are immutable and cached
+  process-wide in a bounded LRU cache keyed by the source string, so they are
+  shared between all commands and build sets that use the same string.
+  """
 
   _regex = re.compile(r'\$([@<]?\w+)|\$\{([@<]?.*?)\}')
 
   def compile(self, arg:str):
+    if not isinstance(arg, str):
+      raise TypeError('expected str, got {}'.format(type(arg).__name__))
+    return _compile_cached(type(self), arg)
+
+  @classmethod
+  def _compile(cls, arg):
     offset = 0
     parts = []
     while True:
-      match = self._regex.search(arg, offset)
+      match = cls._regex.search(arg, offset)
       if not match: break
       if offset < match.start():
         parts.append(_Part.Str(arg[offset:match.start()]))
@@ -198,7 +333,7 @@ class TemplateCompiler:
     concatenates its results.
     """
 
-    return _TemplateList([self.compile(x) for x in arg], concat=True)
+    return _compile_list_cached(type(self), tuple(arg))
 
   def compile_commands(self, arg:List[List[str]]):
     """
@@ -0,0 +1,497 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The Craftr daemon keeps the session of a build directory alive between
+invokations of the command-line. It loads the build graph and the backend
+once, prepares the build server of the backend (if it has one) and serves
+the `--build`, `--clean` and `--show` steps of subsequent invokations,
+which only need to parse their arguments and forward them to the daemon.
+The build server is only started in the process that is forked for an
+invokation, so it serves the build sets as modified by the arguments of
+the invokation (eg. `craftr -b target@=args`). Invokations with different
+options are not forwarded to the daemon (see #get_config_key()).
+
+The daemon listens on a Unix domain socket that is derived from the build
+directory (see #get_address()). It speaks the frame format of
+#craftr.core.protocol with the following requests:
+
+* #OP_STATUS - The body of the response is a JSON object that describes
+  the state of the daemon.
+* #OP_STOP - Stops the daemon after it responded.
+* #OP_RUN - Arguments: the configuration key (list), the working directory
+  (string), the environment (list of alternating keys and values) and the
+  command-line arguments (list). The standard input, output and error of
+  the client are sent along as ancillary data (`SCM_RIGHTS`). The daemon
+  forks a process that runs the invokation on its copy of the session and
+  that responds with a #STATUS_OK frame containing its process ID, followed
+  by a #STATUS_OK frame with the exit code (see #protocol.encode_exit_code()).
+
+A daemon only serves invokations that were run from the same directory with
+the same configuration options as the daemon itself, otherwise the client
+falls back to running the invokation in-process. The daemon watches the
+build graph file and reloads it when it changes, and it shuts down when it
+has been idle for the timeout specified with `--daemon-timeout`.
+
+This module must only import the standard library and #craftr.core.protocol
+at the module level, as it is imported for every invokation.
+"""
+
+import array
+import hashlib
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from craftr.core import protocol
+
+OP_STATUS = 1
+OP_STOP = 2
+OP_RUN = 3
+
+#: The number of seconds that #control() waits for a started daemon to
+#: accept connections.
+START_TIMEOUT = 120
+
+#: The number of seconds between two checks of the build graph file.
+POLL_INTERVAL = 1.0
+
+
+def is_supported():
+  return os.name == 'posix' and hasattr(socket, 'AF_UNIX') and \
+      hasattr(socket, 'SCM_RIGHTS')
+
+
+def get_address(build_directory):
+  """
+  Returns the path of the Unix domain socket of the daemon for the
+  *build_directory*. The socket is placed in the temporary directory as
+  the path of a Unix domain socket is limited to about 100 characters.
+  """
+
+  directory = os.path.normcase(os.path.abspath(build_directory))
+  digest = hashlib.sha1(directory.encode('utf8')).hexdigest()[:16]
+  name = 'craftr-daemon-{}-{}.sock'.format(os.getuid(), digest)
+  return os.path.join(tempfile.gettempdir(), name)
+
+
+def get_config_key(args):
+  """
+  Returns the list of strings that identifies the configuration of the
+  session from the parsed command-line *args*.
+  """
+
+  return [os.getcwd()] + args.config_options
+
+
+def _connect(address):
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(address)
+  except OSError:
+    sock.close()
+    return None
+  return sock
+
+
+def _get_status(sock):
+  return json.loads(protocol.request(sock, protocol.encode_frame(OP_STATUS)).decode('utf8'))
+
+
+def forward(args, argv):
+  """
+  Forwards the invokation with the command-line arguments *argv* (parsed
+  into *args*) to the daemon of the build directory. Returns the exit code
+  of the invokation, or #None if no daemon is running for the build
+  directory or if it serves a different configuration.
+  """
+
+  if not is_supported():
+    return None
+  sock = _connect(get_address(args.build_directory))
+  if sock is None:
+    return None
+
+  with sock:
+    environ = [x for item in sorted(os.environ.items()) for x in item]
+    body = protocol.encode_list(get_config_key(args)) + \
+        protocol.encode_str(os.getcwd()) + protocol.encode_list(environ) + \
+        protocol.encode_list(argv)
+    fds = array.array('i', [0, 1, 2])
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+      sock.sendmsg([protocol.encode_frame(OP_RUN, body)],
+                   [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+      status, body = protocol.recv_frame(sock)
+    except (OSError, protocol.ProtocolError) as exc:
+      if args.verbose:
+        print('note: can not use the craftr daemon ({})'.format(exc), file=sys.stderr)
+      return None
+    if status != protocol.STATUS_OK:
+      if args.verbose:
+        print('note: not using the craftr daemon ({})'.format(body.decode('utf8')), file=sys.stderr)
+      return None
+
+    # The invokation runs in its own process group, pass interrupts on.
+    pid = protocol.decode_exit_code(body)
+    def interrupt(signum, frame):
+      try:
+        os.killpg(pid, signum)
+      except OSError:
+        pass
+    previous = signal.signal(signal.SIGINT, interrupt)
+    try:
+      status, body = protocol.recv_frame(sock)
+    except protocol.ProtocolError:
+      print('fatal: lost the connection to the craftr daemon', file=sys.stderr)
+      return 1
+    finally:
+      signal.signal(signal.SIGINT, previous)
+    return protocol.decode_exit_code(body)
+
+
+def control(command, args, argv):
+  """
+  Implements `craftr --daemon start|stop|status`. The daemon is started
+  with the command-line arguments *argv*.
+  """
+
+  if not is_supported():
+    print('fatal: the craftr daemon is not supported on this platform', file=sys.stderr)
+    return 1
+
+  address = get_address(args.build_directory)
+  sock = _connect(address)
+  if sock is not None:
+    with sock:
+      status = _get_status(sock)
+    if command == 'stop':
+      with _connect(address) as sock:
+        protocol.request(sock, protocol.encode_frame(OP_STOP))
+    if command == 'start':
+      if status['config'] != get_config_key(args):
+        print('fatal: a craftr daemon with a different configuration is running '
+              '(pid {}), stop it first'.format(status['pid']), file=sys.stderr)
+        return 1
+      print('note: craftr daemon is already running (pid {})'.format(status['pid']))
+    elif command == 'stop':
+      print('note: stopped craftr daemon (pid {})'.format(status['pid']))
+    else:
+      print('craftr daemon is running (pid {})'.format(status['pid']))
+      print('  build directory: {}'.format(status['build_directory']))
+      print('  build graph:     {}'.format(status['graph']))
+      print('  build server:    {}'.format(
+        'started per invokation' if status['build_server'] else 'none'))
+      print('  uptime:          {:.0f}s (idle for {:.0f}s, timeout {:.0f}s)'.format(
+        status['uptime'], status['idle'], status['timeout']))
+      print('  requests:        {} ({} running)'.format(status['requests'], status['running']))
+      if status['config'] != get_config_key(args):
+        print('note: the daemon was started with a different configuration and does')
+        print('      not serve this invokation. Its configuration is:')
+        print('      {}'.format(' '.join(status['config'])))
+    return 0
+
+  if command == 'stop':
+    print('note: craftr daemon is not running')
+    return 0
+  elif command == 'status':
+    print('craftr daemon is not running')
+    return 1
+
+  # Remove the socket of a daemon that did not shut down cleanly.
+  if os.path.exists(address):
+    os.remove(address)
+
+  logfile = os.path.join(args.build_directory, 'craftr-daemon.log')
+  os.makedirs(args.build_directory, exist_ok=True)
+  command = [sys.executable, '-m', 'craftr.main'] + argv + ['--daemon', 'run']
+  with open(logfile, 'w') as fp:
+    proc = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=fp,
+                            stderr=subprocess.STDOUT, start_new_session=True)
+
+  deadline = time.time() + START_TIMEOUT
+  while time.time() < deadline:
+    if proc.poll() is not None:
+      print('fatal: craftr daemon exited with code {}, see "{}"'.format(
+        proc.returncode, logfile), file=sys.stderr)
+      return 1
+    sock = _connect(address)
+    if sock is not None:
+      sock.close()
+      print('note: started craftr daemon (pid {})'.format(proc.pid))
+      return 0
+    time.sleep(0.05)
+
+  print('fatal: craftr daemon did not start within {}s, see "{}"'.format(
+    START_TIMEOUT, logfile), file=sys.stderr)
+  return 1
+
+
+def serve(args, session, backend):
+  """
+  Runs the daemon for the loaded *session* in the foreground until it is
+  stopped or idle for `--daemon-timeout` seconds.
+  """
+
+  if not is_supported():
+    print('fatal: the craftr daemon is not supported on this platform', file=sys.stderr)
+    return 1
+  daemon = Daemon(get_address(args.build_directory), get_config_key(args),
+                  session, backend, args.daemon_timeout, args.verbose)
+  daemon.run()
+  return 0
+
+
+def _exit_code(code):
+  # Converts the code of a #SystemExit exception to an exit code.
+  if code is None:
+    return 0
+  if isinstance(code, int):
+    return code
+  print(code, file=sys.stderr)
+  return 1
+
+
+class Daemon:
+  """
+  Serves the invokations of the command-line for the *session*. Every
+  invokation is run in a forked process, so it can not alter the state
+  of the daemon.
+  """
+
+  def __init__(self, address, config_key, session, backend, timeout, verbose=False):
+    self._address = address
+    self._config_key = config_key
+    self._session = session
+    self._backend = backend
+    self._timeout = timeout
+    self._verbose = verbose
+    self._server = None
+    self._listener = None
+    self._children = set()
+    self._requests = 0
+    self._stopped = False
+    self._started = time.time()
+    self._last_active = self._started
+    self._graph_stamp = None
+
+  def run(self):
+    self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      if os.path.exists(self._address):
+        os.remove(self._address)
+      self._listener.bind(self._address)
+      self._listener.listen(16)
+      self._listener.settimeout(POLL_INTERVAL)
+
+      self._graph_stamp = self._get_graph_stamp()
+      self._session.load_all()
+      create_build_server = getattr(self._backend, 'create_build_server', None)
+      if create_build_server:
+        # The server is started by the backend in the forked process.
+        self._server = create_build_server(self._verbose)
+        self._server.precompute()
+        self._session.build_server = self._server
+
+      print('note: craftr daemon (pid {}) listening at "{}"'.format(os.getpid(), self._address))
+      sys.stdout.flush()
+      while not self._stopped:
+        try:
+          conn, _ = self._listener.accept()
+        except socket.timeout:
+          pass
+        else:
+          with conn:
+            self._accept(conn)
+        self._reap()
+        self._check_graph()
+        if not self._children and time.time() - self._last_active > self._timeout:
+          print('note: craftr daemon idle for {:.0f}s, shutting down'.format(self._timeout))
+          break
+    finally:
+      self._listener.close()
+      if os.path.exists(self._address):
+        os.remove(self._address)
+      if self._server:
+        self._session.build_server = None
+
+  def _get_graph_stamp(self):
+    filename = self._session.find_graph_filename()
+    try:
+      st = os.stat(filename)
+    except FileNotFoundError:
+      return (filename, None, None)
+    return (filename, st.st_mtime_ns, st.st_size)
+
+  def _check_graph(self):
+    # Reloads the build graph if the file has changed since it was loaded.
+    stamp = self._get_graph_stamp()
+    if stamp == self._graph_stamp:
+      return
+    self._graph_stamp = stamp
+    if stamp[1] is None:
+      return
+    print('note: reloading "{}"'.format(stamp[0]))
+    sys.stdout.flush()
+    try:
+      if self._server:
+        # Only discards the responses of the targets that changed.
+        self._server.reload()
+      else:
+        self._session.reload()
+      self._session.load_all()
+    except Exception:
+      traceback.print_exc()
+
+  def _reap(self):
+    for pid in list(self._children):
+      if os.waitpid(pid, os.WNOHANG)[0] == pid:
+        self._children.discard(pid)
+        self._last_active = time.time()
+
+  def _recv_request(self, conn):
+    # Receives a request frame and the file descriptors sent along with it.
+    fds = array.array('i')
+    buffer = bytearray()
+    while True:
+      frame = protocol.split_frame(buffer)
+      if frame is not None:
+        return frame + (list(fds),)
+      data, ancdata, _, _ = conn.recvmsg(65536, socket.CMSG_SPACE(3 * fds.itemsize))
+      for level, type, cdata in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+          fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+      if not data:
+        if not buffer:
+          return None  # The client only checked if the daemon is running.
+        raise protocol.ProtocolError('connection closed')
+      buffer += data
+
+  def _accept(self, conn):
+    conn.settimeout(10)
+    fds = []
+    try:
+      request = self._recv_request(conn)
+      if request is None:
+        return
+      code, body, fds = request
+      if code == OP_STATUS:
+        data = json.dumps(self._status()).encode('utf8')
+        conn.sendall(protocol.encode_frame(protocol.STATUS_OK, data))
+      elif code == OP_STOP:
+        self._stopped = True
+        conn.sendall(protocol.encode_frame(protocol.STATUS_OK))
+      elif code == OP_RUN:
+        self._run(conn, body, fds)
+      else:
+        raise protocol.ProtocolError('unknown opcode: {}'.format(code))
+    except Exception as exc:
+      traceback.print_exc()
+      try:
+        conn.sendall(protocol.encode_frame(protocol.STATUS_ERROR, str(exc).encode('utf8')))
+      except OSError:
+        pass
+    finally:
+      for fd in fds:
+        os.close(fd)
+
+  def _status(self):
+    now = time.time()
+    return {
+      'pid': os.getpid(),
+      'config': self._config_key,
+      'build_directory': self._session.build_directory,
+      'graph': self._graph_stamp[0],
+      'build_server': self._server is not None,
+      'uptime': now - self._started,
+      'idle': 0 if self._children else now - self._last_active,
+      'timeout': self._timeout,
+      'requests': self._requests,
+      'running': len(self._children)
+    }
+
+  def _run(self, conn, body, fds):
+    config_key, offset = protocol.decode_list(body, 0)
+    cwd, offset = protocol.decode_str(body, offset)
+    environ, offset = protocol.decode_list(body, offset)
+    argv, offset = protocol.decode_list(body, offset)
+    if config_key != self._config_key:
+      raise ValueError('the daemon serves a different configuration')
+    if len(fds) != 3:
+      raise ValueError('expected 3 file descriptors, got {}'.format(len(fds)))
+
+    # Make sure that the invokation sees the latest build graph.
+    self._check_graph()
+
+    pid = os.fork()
+    if pid == 0:
+      self._child(conn, cwd, dict(zip(environ[::2], environ[1::2])), argv, fds)
+    self._children.add(pid)
+    self._requests += 1
+    self._last_active = time.time()
+
+  def _child(self, conn, cwd, environ, argv, fds):
+    # Runs the invokation in the forked process. Never returns.
+    code = 1
+    try:
+      os.setpgid(0, 0)
+      signal.signal(signal.SIGINT, signal.default_int_handler)
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      self._listener.close()
+      conn.settimeout(None)
+      conn.sendall(protocol.encode_frame(protocol.STATUS_OK, protocol.encode_exit_code(os.getpid())))
+
+      # Take over the standard streams of the client.
+      for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+      for fd in fds:
+        os.close(fd)
+      fds[:] = []
+      sys.stdin = open(0, 'r', closefd=False)
+      sys.stdout = open(1, 'w', buffering=1, closefd=False)
+      sys.stderr = open(2, 'w', buffering=1, closefd=False)
+      os.chdir(cwd)
+      os.environ.clear()
+      os.environ.update(environ)
+
+      from craftr import main
+      _, args = main.parse_args(argv)
+      code = _exit_code(main.execute(args, self._session, self._backend))
+    except SystemExit as exc:
+      code = _exit_code(exc.code)
+    except BaseException:
+      traceback.print_exc()
+    finally:
+      try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.sendall(protocol.encode_frame(protocol.STATUS_OK, protocol.encode_exit_code(code)))
+      finally:
+        os._exit(0)
@@ -12,8 +12,6 @@ import warnings
 try: import ntfy
 except ImportError: ntfy = None
 
-from craftr import api
-from craftr.core.build import to_graph
 from nr.stream import groupby
 from termcolor import colored
 
@@ -41,6 +39,7 @@ def open_cli_file(filename, mode):
 def notify(message, title):
   if not ntfy:
     return
+  from craftr import api
   # On OSX, even if a virtualenv is created with --system-site-packages
   # and ntfy was installed into the system Python, it won't work. On
   # Linux, it will work that way, btw (and it works any way on Windows).
@@ -66,9 +65,9 @@ def resolve_build_sets(session, target_specifiers):
   """
 
   basename_map = {}
-  for k, v in session._output_files.items():
+  for k in session.output_files():
     base = nr.fs.base(k).lower()
-    basename_map.setdefault(base, set()).add(v)
+    basename_map.setdefault(base, set()).add(k)
 
   build_sets = []
   def add_build_set(bset, add_args):
@@ -80,11 +79,12 @@ def resolve_build_sets(session, target_specifiers):
   for spec in target_specifiers:
     spec, add_args = spec.partition('@=')[::2]
     if spec.lower() in basename_map:
-      [add_build_set(x, add_args) for x in basename_map[spec.lower()]]
+      bsets = set(map(session.get_output_build_set, basename_map[spec.lower()]))
+      [add_build_set(x, add_args) for x in bsets]
       continue
-    abs_spec = nr.fs.canonical(spec)
-    if abs_spec in session._output_files:
-      add_build_set(session._output_files[abs_spec], add_args)
+    bset = session.get_output_build_set(nr.fs.canonical(spec))
+    if bset is not None:
+      add_build_set(bset, add_args)
       continue
 
     name = spec
@@ -101,9 +101,9 @@ def resolve_build_sets(session, target_specifiers):
     full_name = scope + '@' + target_name
     prefix = full_name + '/'
     targets = []
-    for target in session.targets:
-      if target.id == full_name or target.id.startswith(prefix):
-        targets.append(target)
+    for target_id in session.target_ids():
+      if target_id == full_name or target_id.startswith(prefix):
+        targets.append(session.get_target(target_id))
 
     if not targets:
       raise ValueError('no targets matched {!r}'.format(spec))
@@ -188,6 +188,21 @@ def get_argument_parser(prog=None):
          'name rather than using a relative path. This is the same as calling '
          'link_module() from a build script.')
 
+  group.add_argument(
+    '--graph-format',
+    choices=('json', 'binary'),
+    default=None,
+    help='The format in which the build graph is serialized in the configure '
+         'step. The binary format is loaded lazily, making it faster to load '
+         'large build graphs. Defaults to "json".')
+
+  group.add_argument(
+    '--shard-graph',
+    action='store_true',
+    help='Serialize the build graph into one file per scope and a manifest '
+         'in the configure step. Only the files that contain the targets '
+         'required for a build are loaded in subsequent invocations.')
+
   group.add_argument(
     '--notify',
     action='store_true',
@@ -249,6 +264,49 @@ def get_argument_parser(prog=None):
     action='store_true',
     help='Disable parallel builds. Useful for debugging.')
 
+  group.add_argument(
+    '-j', '--jobs',
+    type=int,
+    metavar='N',
+    help='Run up to N build sets in parallel. Defaults to the number of '
+         'CPUs.')
+
+  group.add_argument(
+    '-k', '--keep-going',
+    action='store_true',
+    help='Keep building the build sets that do not depend on a failed '
+         'build set.')
+
+  group.add_argument(
+    '--affected',
+    nargs='+',
+    default=None,
+    metavar='FILE',
+    help='Select only the build sets that are affected by changes to the '
+         'specified files, that is the build sets that consume any of the '
+         'files (or discovered them as dependencies in the last build) and '
+         'everything downstream of them. Prints the IDs of the affected '
+         'targets unless used with --build, --clean or --show.')
+
+  group = parser.add_argument_group('Daemon')
+
+  group.add_argument(
+    '--daemon',
+    choices=('start', 'stop', 'status', 'run'),
+    default=None,
+    help='Start, stop or query the daemon for the build directory. The '
+         'daemon keeps the build graph loaded and serves the --build, '
+         '--clean and --show steps of subsequent invokations. "run" runs '
+         'the daemon in the foreground.')
+
+  group.add_argument(
+    '--daemon-timeout',
+    type=float,
+    default=900,
+    metavar='SECONDS',
+    help='The number of seconds after which an idle daemon shuts down. '
+         'Defaults to 900.')
+
   group = parser.add_argument_group('Tools and debugging')
 
   group.add_argument(
@@ -257,6 +315,12 @@ def get_argument_parser(prog=None):
     metavar='TOOLNAME [ARG [...]]',
     help='Invoke a Craftr tool.')
 
+  group.add_argument(
+    '--convert-graph',
+    action='store_true',
+    help='Convert the serialized build graph into the format specified with '
+         '--graph-format and --shard-graph and exit.')
+
   group.add_argument(
     '--dump-graphviz',
     nargs='?',
@@ -285,7 +349,18 @@ def get_argument_parser(prog=None):
   return parser
 
 
-def main(argv=None, prog=None):
+def parse_args(argv=None, prog=None):
+  """
+  Parses the command-line arguments *argv* and normalizes them. This does
+  not import the Craftr API, so it can be used to forward the invokation
+  to the daemon cheaply. Returns the parser and the arguments.
+
+  Additionally to the parsed options, the returned namespace has the
+  attributes `tool_argv`, `cmdline_options` (the options specified with
+  `-O`), `config_options` (the command-line options that affect the
+  configuration of the session), `cli_options` and `build_directory`.
+  """
+
   if argv is None:
     argv = sys.argv[1:]
 
@@ -301,13 +376,10 @@ def main(argv=None, prog=None):
 
   parser = get_argument_parser(prog)
   args = parser.parse_args(argv)
+  args.tool_argv = tool_argv
 
   if args.pywarn != 'none':
     args.pywarn = args.pywarn or 'once'
-    warnings.simplefilter(args.pywarn)
-
-  if args.notify and not ntfy:
-    print('warning: ntfy module is not available, --notify is ignored.')
 
   if nr.fs.isdir(args.project):
     args.project = nr.fs.join(args.project, 'build.craftr')
@@ -325,12 +397,12 @@ def main(argv=None, prog=None):
       args.options.append(x)
       args.targets.remove(x)
 
-  cmdline_options = {}
+  args.cmdline_options = {}
   for opt in args.options or ():
       key, value = opt.partition('=')[::2]
-      cmdline_options[key] = value
-  if not args.variant and 'build:variant' in cmdline_options:
-    args.variant = cmdline_options['build:variant']
+      args.cmdline_options[key] = value
+  if not args.variant and 'build:variant' in args.cmdline_options:
+    args.variant = args.cmdline_options['build:variant']
   if not args.variant:
     args.variant = 'debug'
 
@@ -346,23 +418,42 @@ def main(argv=None, prog=None):
   if args.build_root != 'build':
     cli_options += ['--build-root', args.build_root]
   if args.pywarn != 'none':
-    cli_options += ['--pywarn', args.pywarn or 'once']
+    cli_options += ['--pywarn', args.pywarn]
   for x in args.link:
     cli_options += ['--link', x]
   if args.backend:
     cli_options += ['--backend', args.backend]
+  if args.graph_format:
+    cli_options += ['--graph-format', args.graph_format]
+  if args.shard_graph:
+    cli_options += ['--shard-graph']
+  args.config_options = list(cli_options)
   if args.verbose:
     cli_options += ['--verbose']
   if args.sequential:
     cli_options += ['--sequential']
+  args.cli_options = cli_options
 
-  # Create a new session.
-  build_directory = nr.fs.join(args.build_root, args.variant)
-  session = api.session = api.Session(args.build_root, build_directory, args.variant, cli_options)
+  args.build_directory = nr.fs.join(args.build_root, args.variant)
+  return parser, args
+
+
+def create_session(args):
+  """
+  Creates a new #api.Session from the parsed command-line *args* (see
+  #parse_args()) and loads the configuration.
+  """
+
+  from craftr import api
+  session = api.session = api.Session(args.build_root, args.build_directory,
+                                      args.variant, args.cli_options)
   session.add_module_search_path(args.module_path)
+  if args.graph_format:
+    session.graph_format = args.graph_format
+  session.graph_sharded = args.shard_graph
   if args.config_file:
     session.load_config(args.config_file)
-  session.options.update(cmdline_options)
+  session.options.update(args.cmdline_options)
 
   # Link modules as specified on the command-line or in the configuration.
   [api.link_module(nr.fs.abs(x)) for x in args.link]
@@ -371,41 +462,50 @@ def main(argv=None, prog=None):
       item = nr.fs.abs(item, nr.fs.dir(args.config_file))
     api.link_module(item)
 
-  if args.tool is not None:
-    tool_name, argv = tool_argv[0], tool_argv[1:]
-    try:
-      module = session.load_module('net.craftr.tool.' + tool_name).namespace
-    except session.ResolveError as exc:
-      if str(exc.request.string) != 'net.craftr.tool.' + tool_name:
-        raise
-      module = session.load_module(tool_name).namespace
-    return module.main(argv, 'craftr --tool {}'.format(tool_name))
+  return session
+
 
+def load_backend(session, args):
   if not args.backend:
     args.backend = session.options.get('build:backend', 'net.craftr.backend.ninja')
-
   try:
-    backend = session.load_module(args.backend).namespace
+    return session.load_module(args.backend).namespace
   except session.ResolveError as exc:
     if str(exc.request.string) != args.backend:
       raise
-    backend = session.load_module('net.craftr.backend.' + args.backend).namespace
+    return session.load_module('net.craftr.backend.' + args.backend).namespace
 
-  if args.config:
-    if not os.path.isfile(args.project):
-      print('fatal: "{}" file not found'.format(nr.fs.rel(args.project)), file=sys.stderr)
-    session.load_module_from_file(args.project, is_main=True)
-    if hasattr(backend, 'prepare'):
-      backend.prepare()
-    session.save()
-  else:
-    try:
-      session.load()
-    except FileNotFoundError as e:
-      print('fatal: "{}" file not found'.format(nr.fs.rel(e.filename)), file=sys.stderr)
-      command = 'craftr -c --variant={}'.format(args.variant)
-      print('  did you forget to run "{}"?'.format(command), file=sys.stderr)
-      return 1
+
+def load_graph(session, args):
+  """
+  Loads the serialized build graph into the *session*. Prints an error
+  and returns #False if the graph file does not exist or was written by
+  an incompatible version of Craftr.
+  """
+
+  from craftr.core.graphfile import GraphVersionError
+  command = 'craftr -c --variant={}'.format(args.variant)
+  try:
+    session.load()
+  except FileNotFoundError as e:
+    print('fatal: "{}" file not found'.format(nr.fs.rel(e.filename)), file=sys.stderr)
+    print('  did you forget to run "{}"?'.format(command), file=sys.stderr)
+    return False
+  except GraphVersionError as e:
+    print('fatal: {}'.format(e), file=sys.stderr)
+    print('  run "{}" to configure the build again'.format(command), file=sys.stderr)
+    return False
+  return True
+
+
+def execute(args, session, backend):
+  """
+  Runs the steps selected in the command-line *args* on the configured or
+  loaded *session*. This is also used by the daemon to serve the requests
+  of the clients (see #craftr.daemon).
+  """
+
+  from craftr.core.build import to_graph
 
   # Determine the build sets that are supposed to be built.
   if args.targets:
@@ -413,6 +513,33 @@ def main(argv=None, prog=None):
   else:
     build_sets = None
 
+  if args.affected is not None:
+    filenames = [nr.fs.canonical(x) for x in args.affected]
+    # Dependencies like headers are only known from the last build.
+    discovered = {}
+    if hasattr(backend, 'discovered_deps'):
+      discovered = backend.discovered_deps()
+    affected = session.get_affected_build_sets(filenames, discovered)
+    affected = [x for x in affected if not x.operator.explicit]
+    for filename in filenames:
+      if filename not in discovered and not session.get_consumer_build_sets(filename) \
+          and session.get_output_build_set(filename) is None:
+        print('warning: "{}" is not a file of the build graph or a dependency that '
+              'was discovered by the last build'.format(nr.fs.rel(filename)), file=sys.stderr)
+    if build_sets is not None:
+      affected = set(affected)
+      build_sets = [x for x in build_sets if x in affected]
+    else:
+      build_sets = affected
+    if not (args.build or args.clean or args.show is not NotImplemented):
+      for target_id in sorted(set(x.operator.target.id for x in build_sets)):
+        print(target_id)
+      return 0
+    if not build_sets:
+      # Backends build everything for an empty selection.
+      print('note: no build sets are affected by the specified files')
+      return 0
+
   if args.show is not NotImplemented:
     if args.show is None:
       args.show = ShowLevels.operators.name
@@ -438,12 +565,78 @@ def main(argv=None, prog=None):
   if args.clean:
     backend.clean(build_sets, recursive=args.recursive, verbose=args.verbose)
   if args.build:
-    res = backend.build(build_sets, verbose=args.verbose, sequential=args.sequential)
+    res = backend.build(build_sets, verbose=args.verbose, sequential=args.sequential,
+                        jobs=args.jobs, keep_going=args.keep_going)
     if args.notify and ntfy:
       notify('Build completed.' if res == 0 else 'Build errored.', 'Craftr')
     sys.exit(res)
 
 
+def main(argv=None, prog=None):
+  if argv is None:
+    argv = sys.argv[1:]
+  parser, args = parse_args(argv, prog)
+
+  if args.pywarn != 'none':
+    warnings.simplefilter(args.pywarn)
+
+  if args.notify and not ntfy:
+    print('warning: ntfy module is not available, --notify is ignored.')
+
+  if args.daemon in ('start', 'stop', 'status'):
+    from craftr import daemon
+    return daemon.control(args.daemon, args, argv)
+
+  # Let the daemon serve the invokation if one is running for the build
+  # directory. Configuring and the tools always run in this process.
+  if not (args.daemon or args.config or args.tool is not None or args.convert_graph):
+    from craftr import daemon
+    res = daemon.forward(args, argv)
+    if res is not None:
+      return res
+
+  # Create a new session.
+  session = create_session(args)
+
+  if args.tool is not None:
+    tool_name, argv = args.tool_argv[0], args.tool_argv[1:]
+    try:
+      module = session.load_module('net.craftr.tool.' + tool_name).namespace
+    except session.ResolveError as exc:
+      if str(exc.request.string) != 'net.craftr.tool.' + tool_name:
+        raise
+      module = session.load_module(tool_name).namespace
+    return module.main(argv, 'craftr --tool {}'.format(tool_name))
+
+  if args.convert_graph:
+    if not args.graph_format and not args.shard_graph:
+      parser.error('--convert-graph requires --graph-format and/or --shard-graph')
+    if not load_graph(session, args):
+      return 1
+    session.load_all()
+    session.save()
+    print('note: converted build graph to "{}"'.format(nr.fs.rel(session.graph_filename)))
+    return 0
+
+  backend = load_backend(session, args)
+
+  if args.config:
+    if not os.path.isfile(args.project):
+      print('fatal: "{}" file not found'.format(nr.fs.rel(args.project)), file=sys.stderr)
+    session.load_module_from_file(args.project, is_main=True)
+    if hasattr(backend, 'prepare'):
+      backend.prepare()
+    session.save()
+  elif not load_graph(session, args):
+    return 1
+
+  if args.daemon == 'run':
+    from craftr import daemon
+    return daemon.serve(args, session, backend)
+
+  return execute(args, session, backend)
+
+
 def show_buildsets_in_console(show, build_sets, main_module):
   level = ShowLevels[show]
   build_sets = list(build_sets)
@@ -0,0 +1,157 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+The lightweight build client that Ninja invokes for every build set. It
+receives the pre-rendered commands, environment and working directory of
+the build set from the build server and runs them. Unlike #build_client,
+it does not reconstruct the build graph and imports only the standard
+library (and the #craftr.core.protocol and #craftr.core.executor modules,
+which depend only on the standard library) to keep the startup time of
+the process low.
+
+If `CRAFTR_REMOTE_EXEC` is set to `true`, the client asks the build server
+to run the build set in one of its worker processes and only relays the
+output and the exit code. With `--local`, the commands are always run by
+the client, which is used for commands that need the console.
+
+If `CRAFTR_BUILD_SERVER` is not set, the action is read from the action
+index specified with `--index` (see #craftr.core.actionindex), which lets
+Ninja run the build without Craftr.
+
+If `CRAFTR_ACTION_CACHE` is set, the outputs of the build set are restored
+from the action cache if possible (see #craftr.core.actioncache). Commands
+that are run with `--local` are never cached.
+
+    $ python action_client.py [--local] [--index FILE] <target> <operator> <build_set> <hash>
+"""
+
+import os
+import sys
+
+from craftr.core import actionindex, executor, protocol
+
+USAGE = 'usage: action_client.py [--local] [--index FILE] <target> <operator> <build_set> <hash>'
+
+verbose = os.environ.get('CRAFTR_VERBOSE') == 'true'
+
+
+def error(*args):
+  print(*args, file=sys.stderr)
+
+
+def get_action(address: str, target: str, operator: str, build_set: int) -> protocol.Action:
+  with protocol.connect(address) as sock:
+    request = protocol.get_action_request(target, operator, build_set)
+    return protocol.decode_action(protocol.request(sock, request))
+
+
+def run_remote(address: str, target: str, operator: str, build_set: int, hash: str,
+               output: bytearray = None) -> int:
+  """
+  Asks the build server to run the build set, writes the output of the
+  commands to stdout and stderr as it arrives and returns the exit code.
+  The output is also appended to *output* if it is specified.
+  """
+
+  with protocol.connect(address) as sock:
+    sock.sendall(protocol.run_request(target, operator, build_set, hash))
+    while True:
+      status, body = protocol.recv_frame(sock)
+      if status in (protocol.STATUS_STDOUT, protocol.STATUS_STDERR) and output is not None:
+        output += body
+      if status == protocol.STATUS_STDOUT:
+        sys.stdout.buffer.write(body)
+        sys.stdout.flush()
+      elif status == protocol.STATUS_STDERR:
+        sys.stderr.buffer.write(body)
+        sys.stderr.flush()
+      elif status == protocol.STATUS_OK:
+        return protocol.decode_exit_code(body)
+      else:
+        error('fatal:', body.decode('utf8'))
+        return 1
+
+
+def main(argv=None):
+  if argv is None:
+    argv = sys.argv[1:]
+  local, index_file = False, None
+  while argv and argv[0] in ('--local', '--index'):
+    if argv[0] == '--local':
+      local, argv = True, argv[1:]
+    else:
+      index_file, argv = argv[1], argv[2:]
+  if len(argv) != 4 or not argv[2].isdigit():
+    error(USAGE)
+    return 2
+  target, operator, build_set, hash = argv
+  build_set = int(build_set)
+
+  address = os.environ.get('CRAFTR_BUILD_SERVER')
+  remote = address and not local and os.environ.get('CRAFTR_REMOTE_EXEC') == 'true'
+  cache = None
+  if not local and os.environ.get('CRAFTR_ACTION_CACHE'):
+    from craftr.core.actioncache import ActionCache
+    cache = ActionCache.from_environ()
+
+  if remote and not cache:
+    return run_remote(address, target, operator, build_set, hash)
+  elif address:
+    action = get_action(address, target, operator, build_set)
+  elif index_file:
+    with actionindex.ActionIndex(index_file) as index:
+      action = index.find(target, operator, build_set)
+    if action is None:
+      error('fatal: build set {}:{}[{}] not found in "{}"'.format(
+        target, operator, build_set, index_file))
+      return 1
+  else:
+    error('fatal: CRAFTR_BUILD_SERVER not set and no action index specified')
+    return 1
+
+  if action.hash != hash:
+    error('fatal: build set hash inconsistency ({!r} != {!r})'.format(
+      action.hash, hash))
+    return 1
+
+  # Update the environment and working directory.
+  os.environ.update(action.environ)
+  if action.cwd:
+    os.chdir(action.cwd)
+
+  if not cache:
+    return executor.run_action(action, verbose=verbose)
+
+  from craftr.core.actioncache import run_cached
+  if remote:
+    run = lambda output: run_remote(address, target, operator, build_set, hash, output)
+  else:
+    run = lambda output: executor.run_action(action, verbose=verbose,
+      call=lambda cmd: executor.spawn_captured(cmd, output))
+  with cache:
+    return run_cached(cache, action, run)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -26,55 +26,43 @@ This is the Python program that is invoked to run a build. It communicates
 with the Action server created by Ninja to retrieve the build commands,
 avoiding the need to read the whole build graph for every build that
 Ninja runs.
+
+This client reconstructs the #BuildSet from the server's response. The
+Ninja backend uses the lighter #action_client instead, which receives the
+rendered commands and does not import the build graph modules.
+
+Like the #action_client, the outputs of the build set are restored from
+the action cache if `CRAFTR_ACTION_CACHE` is set.
 """
 
 import argparse
 import contextlib
-import io
 import json
 import nr.fs as path
 import os
-import re
-import socket
-import shlex
-import struct
 import subprocess
 import sys
 
 from nr.stream import Stream as stream
-from craftr.core import build
+from craftr.core import actioncache, build, executor, protocol
 from craftr.utils.sh import quote
 
 verbose = os.environ.get('CRAFTR_VERBOSE') == 'true'
 
 
-def recvall(sock, size):
-  buffer = io.BytesIO()
-  bytes_read = 0
-  while bytes_read < size:
-    data = sock.recv(size - bytes_read)
-    if not data:
-      break
-    buffer.write(data)
-    bytes_read += len(data)
-  return buffer.getvalue()
-
-
 class BuildClient:
   """
-  Communicates with the build server to read build information.
+  Communicates with the build server to read build information. The
+  *server_address* defaults to the `CRAFTR_BUILD_SERVER` environment
+  variable (see #protocol.parse_address()).
   """
 
   def __init__(self, server_address=None):
     if server_address is None:
       server_address = os.environ.get('CRAFTR_BUILD_SERVER')
-      if not server_address or server_address.count(':') != 1:
-        raise ValueError('CRAFTR_BUILD_SERVER not set or invalid')
-    if isinstance(server_address, str):
-      server_address = server_address.split(':', 1)
-      server_address[1] = int(server_address[1])
-    self._client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    self._client.connect(tuple(server_address))
+      if not server_address:
+        raise ValueError('CRAFTR_BUILD_SERVER not set')
+    self._client = protocol.connect(server_address)
 
   def __enter__(self):
     return self
@@ -82,29 +70,22 @@ class BuildClient:
   def __exit__(self, *args):
     self.end_connection()
 
-  def _send_receive(self, request):
-    request = json.dumps(request).encode('utf8')
-    self._client.sendall(struct.pack('!I', len(request)))
-    self._client.sendall(request)
-    response_size = struct.unpack('!I', self._client.recv(4))[0]
-    response_data = recvall(self._client, response_size).decode('utf8')
-    response = json.loads(response_data)
-    if 'error' in response:
-      raise RuntimeError(response['error'])
-    return response
+  def reload_build_server(self, shard=None):
+    """
+    Ask the build server to reload the build graph. If *shard* is specified,
+    only the targets of that shard are reloaded if the server loaded the
+    graph from a sharded graph file.
+    """
 
-  def reload_build_server(self):
-    self._send_receive({'reload_build_server': True})
+    protocol.request(self._client, protocol.reload_request(shard))
 
   def get_build_set(self, master: build.Master, target: str, operator: str, build_set: int):
-    response = self._send_receive({
-      'target': target,
-      'operator': operator,
-      'build_set': build_set
-    })
-    target = build.Target.from_json(master, response['data']['target'])
+    request = protocol.get_build_set_request(target, operator, build_set)
+    response = json.loads(protocol.request(self._client, request).decode('utf8'))
+    master.load_command_table(response['commands'])
+    target = build.Target.from_json(master, response['target'])
     bset = next(iter(target.operators)).build_sets[0]
-    return bset, response['data']['hash'], response['data']['additional_args']
+    return bset, response['hash'], response['additional_args']
 
   def end_connection(self):
     self._client.close()
@@ -140,6 +121,7 @@ def main(argv=None, prog=None):
     d = path.dir(f)
     if d not in created_dirs:
       path.makedirs(d)
+      created_dirs.add(d)
 
   # Update the environment and working directory.
   os.environ.update(bset.get_environ())
@@ -161,6 +143,24 @@ def main(argv=None, prog=None):
   if verbose:
     print_command_list()
 
+  cache = None if operator.syncio else actioncache.ActionCache.from_environ()
+  if cache:
+    action = protocol.Action.from_build_set(bset, additional_args)
+    with cache:
+      return actioncache.run_cached(cache, action, lambda output: run(
+        bset, commands, additional_args, print_command_list, output))
+  return run(bset, commands, additional_args, print_command_list)
+
+
+def run(bset, commands, additional_args, print_command_list, output=None):
+  """
+  Runs the *commands* of the *bset* and checks that they produced all
+  output files. If *output* is specified, the output of the commands is
+  appended to it.
+  """
+
+  operator = bset.operator
+
   # Execute the subcommands.
   with contextlib.ExitStack() as stack:
     for i, (cmd, cmd_template) in enumerate(zip(commands, bset.operator.commands)):
@@ -169,11 +169,14 @@ def main(argv=None, prog=None):
       # Add the additional_args to the last command in the chain.
       if i == len(commands) - 1:
         cmd = cmd + additional_args
-      try:
-        code = subprocess.call(cmd)
-      except OSError as e:
-        error(e)
-        code = 127
+      if output is not None:
+        code = executor.spawn_captured(cmd, output)
+      else:
+        try:
+          code = subprocess.call(cmd)
+        except OSError as e:
+          error(e)
+          code = 127
       if code != 0:
         error('\n' + '-'*60)
         error('fatal: "{}" exited with code {}.'.format(operator.id, code))
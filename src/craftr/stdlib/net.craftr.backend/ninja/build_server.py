@@ -30,113 +30,392 @@ every time.
     [ Craftr Master Process ]   <- communicates with -\
     \-> [ Build Backend (eg. Ninja) ]                 |
         \-> [ Craftr Slave Process (invokes the actual build commands) ]
+
+The server listens on a Unix domain socket if the platform supports it and
+falls back to a TCP socket on localhost otherwise. It speaks the binary
+protocol implemented in #craftr.core.protocol and serves all connections
+from a single thread with a selector. The response for a build set is
+encoded when it is first requested and cached until its target changes, so
+a build that touches only a few build sets does not render the whole graph.
+The daemon renders all of them up-front with #BuildServer.precompute().
+Cached responses are keyed on the additional arguments of the build set,
+as they can differ between invokations (eg. `craftr -b target@=args`).
+When the graph is reloaded, only the changed targets are replaced (see
+#Master.reload()) and only their responses are discarded. Requests are
+served by the same thread that performs the reload, so they never see a
+half-updated graph.
+
+The socket, the worker processes and the thread only exist while the
+server is serving. The daemon keeps a #BuildServer with precomputed
+responses and starts it in the process that it forks for an invokation,
+so the daemon itself never forks with a running server.
+
+If the server is created with worker processes, it runs build sets on
+behalf of the build clients (#protocol.OP_RUN) in an #executor.WorkerPool.
+The output of the commands is forwarded to the client as it is produced.
+Requests that arrive while all workers are busy are queued.
 """
 
-import concurrent.futures
+import collections
 import json
+import os
+import selectors
 import shlex
+import shutil
 import socket
-import socketserver
-import struct
+import tempfile
 import threading
 
+from craftr.core import executor, protocol
 
-class JsonifyProxy:
-
-  def __init__(self, obj, **kwargs):
-    self._obj = obj
-    self._kwargs = kwargs
-
-  def to_json(self, *args, **kwargs):
-    kwargs.update(self._kwargs)
-    return self._obj.to_json(*args, **kwargs)
-
-
-class RequestHandler(socketserver.BaseRequestHandler):
 
-  master = None
-  additional_args = None
+class _Connection:
 
-  def handle(self):
-    try:
-      while True:
-        data = self.request.recv(4)
-        if len(data) == 0: break
-        request_size = struct.unpack('!I', data)[0]
-        request = json.loads(self.request.recv(request_size).decode('utf8'))
-
-        if 'reload_build_server' in request:
-          self.master.reload()
-          response = {'status': 'ok'}
-        elif not all(x in request for x in ('target', 'operator', 'build_set')):
-          response = {'error': 'BadRequest'}
-        else:
-          try:
-            target = self.master.targets[request['target']]
-            operator = target.operators[request['operator']]
-            bset = operator.build_sets[request['build_set']]
-          except KeyError:
-            response = {'error': 'DoesNotExist'}
-          else:
-            proxy = JsonifyProxy(operator, build_sets=[bset])
-            proxy = JsonifyProxy(target, operators=[proxy])
-            data = {
-              'target': proxy.to_json(),
-              'hash': bset.compute_hash(),
-              'additional_args': self._get_additional_args(target, operator, bset)
-            }
-            response = {'data': data}
-
-        response = json.dumps(response).encode('utf8')
-        self.request.sendall(struct.pack('!I', len(response)))
-        self.request.sendall(response)
-
-      self.request.close()
-    except ConnectionResetError:
-      pass
+  __slots__ = ('sock', 'inbuf', 'outbuf', 'closed')
 
-  def _get_additional_args(self, target: 'Target', operator: 'Operator', bset: 'BuildSet'):
-    if bset.additional_args:
-      return shlex.split(bset.additional_args)
-    return []
+  def __init__(self, sock):
+    self.sock = sock
+    self.inbuf = bytearray()
+    self.outbuf = bytearray()
+    self.closed = False
 
 
 class BuildServer:
+  """
+  Serves the build set information of the *master* to the build clients.
+  The *transport* can be `'unix'` or `'tcp'` and defaults to `'unix'` if
+  the platform supports Unix domain sockets. If *workers* is not zero, the
+  server starts that many worker processes to run build sets in.
+  """
 
-  def __init__(self, master, additional_args=None):
+  def __init__(self, master, transport=None, workers=0, verbose=False):
+    if transport is None:
+      transport = 'unix' if hasattr(socket, 'AF_UNIX') else 'tcp'
+    if transport not in ('unix', 'tcp'):
+      raise ValueError('invalid transport: {!r}'.format(transport))
     self._master = master
-    self._additional_args = additional_args or {}
-    self._server = socketserver.ThreadingTCPServer(('localhost', 0), self._request_handler)
-    self._server.timeout = 0.5
+    self._transport = transport
+    self._workers = workers
+    self._verbose = verbose
+    # Maps target IDs to {(opcode, operator, index, additional_args): encoded response}
+    self._responses = {}
+    self._pool = None
+    self._idle = []
+    self._jobs = collections.deque()  # Connections and actions waiting for a worker
+    self._tempdir = None
+    self._socket = None
+    self._address = None
+    self._wakeup = None
     self._thread = None
-    self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=10)
 
   def __enter__(self):
-    self._pool.__enter__()
     self.serve()
     return self
 
   def __exit__(self, *args):
-    self._pool.__exit__(*args)
     self.shutdown()
 
-  def _request_handler(self, *args, **kwargs):
-    handler = object.__new__(RequestHandler)
-    handler.master = self._master
-    handler.additional_args = self._additional_args
-    handler.__init__(*args, **kwargs)
-    #self._pool.submit(handler.__init__, *args, **kwargs)
-
   def address(self):
-    return self._server.server_address
+    """
+    Returns the address of the server in the format that is accepted by
+    #protocol.parse_address() and the `CRAFTR_BUILD_SERVER` variable, or
+    #None if the server is not serving.
+    """
+
+    return self._address
 
   def serve(self):
+    """
+    Opens the socket, starts the worker processes and serves requests in
+    a new thread until #shutdown() is called.
+    """
+
     if self._thread and self._thread.is_alive():
       raise RuntimeError('BuildServer already/still running.')
-    self._thread = threading.Thread(target=self._server.serve_forever)
+    try:
+      self._open()
+    except BaseException:
+      self._close_all()
+      raise
+    self._thread = threading.Thread(target=self._serve_forever)
     self._thread.start()
 
+  def _open(self):
+    if self._transport == 'unix':
+      self._tempdir = tempfile.mkdtemp(prefix='craftr-')
+      path = os.path.join(self._tempdir, 'build-server.sock')
+      self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self._socket.bind(path)
+      self._address = 'unix:' + path
+    else:
+      self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self._socket.bind(('localhost', 0))
+      self._address = '{}:{}'.format(*self._socket.getsockname()[:2])
+    self._socket.listen(128)
+    self._socket.setblocking(False)
+    self._wakeup = socket.socketpair()
+    if self._workers:
+      self._pool = executor.WorkerPool(self._workers, self._verbose)
+      self._idle = list(self._pool.workers)
+
+  def _close_all(self):
+    if self._pool:
+      self._pool.close()
+    if self._socket:
+      self._socket.close()
+    for sock in self._wakeup or ():
+      sock.close()
+    if self._tempdir:
+      shutil.rmtree(self._tempdir, ignore_errors=True)
+    self._pool = None
+    self._idle = []
+    self._jobs.clear()
+    self._tempdir = None
+    self._socket = None
+    self._address = None
+    self._wakeup = None
+
   def shutdown(self, wait=True):
-    self._server.shutdown()
+    wakeup = self._wakeup
+    if wakeup and self._thread and self._thread.is_alive():
+      wakeup[1].send(b'x')
     if wait and self._thread:
       self._thread.join()
+
+  def precompute(self):
+    """
+    Renders and caches the actions of all build sets in the graph, so they
+    do not need to be rendered when they are requested.
+    """
+
+    for operator in self._master.all_operators():
+      responses = self._responses.setdefault(operator.target.id, {})
+      for index, bset in enumerate(operator.build_sets):
+        key = (protocol.OP_GET_ACTION, operator.name, index, bset.additional_args)
+        responses[key] = self._encode_action(operator, bset)
+
+  def reload(self, shard=None):
+    """
+    Reloads the graph, or only the specified *shard*, and discards the
+    responses of the targets that changed. Must not be called while the
+    server is serving; send a #protocol.reload_request() instead.
+    """
+
+    if self._thread and self._thread.is_alive():
+      raise RuntimeError('BuildServer is running.')
+    self._reload(shard)
+
+  def _serve_forever(self):
+    selector = selectors.DefaultSelector()
+    selector.register(self._socket, selectors.EVENT_READ)
+    selector.register(self._wakeup[0], selectors.EVENT_READ)
+    for worker in self._idle:
+      selector.register(worker.sock, selectors.EVENT_READ, worker)
+    try:
+      while True:
+        for key, events in selector.select():
+          if key.fileobj is self._wakeup[0]:
+            for key in list(selector.get_map().values()):
+              if isinstance(key.data, _Connection):
+                key.data.sock.close()
+            return
+          elif key.fileobj is self._socket:
+            self._accept(selector)
+          elif isinstance(key.data, executor.Worker):
+            self._process_worker(selector, key.data)
+          else:
+            self._process(selector, key.data, events)
+    finally:
+      selector.close()
+      self._close_all()
+
+  def _accept(self, selector):
+    while True:
+      try:
+        sock, _ = self._socket.accept()
+      except (BlockingIOError, InterruptedError):
+        return
+      sock.setblocking(False)
+      selector.register(sock, selectors.EVENT_READ, _Connection(sock))
+
+  def _close(self, selector, conn):
+    selector.unregister(conn.sock)
+    conn.sock.close()
+    conn.closed = True
+
+  def _flush(self, selector, conn):
+    try:
+      if conn.outbuf:
+        del conn.outbuf[:conn.sock.send(conn.outbuf)]
+    except (BlockingIOError, InterruptedError):
+      pass
+    except OSError:
+      self._close(selector, conn)
+      return
+    mask = selectors.EVENT_READ
+    if conn.outbuf:
+      mask |= selectors.EVENT_WRITE
+    selector.modify(conn.sock, mask, conn)
+
+  def _process(self, selector, conn, events):
+    if events & selectors.EVENT_READ:
+      try:
+        data = conn.sock.recv(65536)
+      except (BlockingIOError, InterruptedError):
+        data = None
+      except OSError:
+        data = b''
+      if data == b'':
+        self._close(selector, conn)
+        return
+      if data:
+        conn.inbuf += data
+        while True:
+          frame = protocol.split_frame(conn.inbuf)
+          if frame is None:
+            break
+          response = self._handle(conn, *frame)
+          if response is not None:
+            conn.outbuf += response
+        self._start_jobs(selector)
+    self._flush(selector, conn)
+
+  def _process_worker(self, selector, worker):
+    try:
+      data = worker.sock.recv(65536)
+    except OSError:
+      data = b''
+    client = worker.client
+    if not data:
+      # The worker process terminated unexpectedly.
+      self._remove_worker(selector, worker, [client] if client else [])
+      return
+    worker.inbuf += data
+    while True:
+      frame = protocol.split_frame(worker.inbuf)
+      if frame is None:
+        break
+      if client and not client.closed:
+        client.outbuf += protocol.encode_frame(*frame)
+      if frame[0] in (protocol.STATUS_OK, protocol.STATUS_ERROR):
+        worker.client = None
+        self._idle.append(worker)
+    if client and not client.closed:
+      self._flush(selector, client)
+    self._start_jobs(selector)
+
+  def _remove_worker(self, selector, worker, clients):
+    """
+    Removes a *worker* whose process terminated and fails the *clients* that
+    were waiting for it. If it was the last worker, all pending jobs fail.
+    """
+
+    selector.unregister(worker.sock)
+    worker.client = None
+    self._pool.workers.remove(worker)
+    if worker in self._idle:
+      self._idle.remove(worker)
+    if not self._pool.workers:
+      clients += [x[0] for x in self._jobs]
+      self._jobs.clear()
+    for client in clients:
+      if not client.closed:
+        client.outbuf += protocol.encode_frame(protocol.STATUS_ERROR,
+                                               b'worker process terminated')
+        self._flush(selector, client)
+
+  def _start_jobs(self, selector):
+    while self._idle and self._jobs:
+      conn, frame = self._jobs.popleft()
+      if conn.closed:
+        continue
+      worker = self._idle.pop()
+      try:
+        worker.sock.sendall(frame)
+      except OSError:
+        # The job is run by the next worker, or fails if this was the last.
+        self._jobs.appendleft((conn, frame))
+        self._remove_worker(selector, worker, [])
+      else:
+        worker.client = conn
+
+  def _handle(self, conn, code, body):
+    try:
+      return self._dispatch(conn, code, protocol.parse_request(code, body))
+    except Exception as exc:
+      message = '{}: {}'.format(type(exc).__name__, exc)
+      return protocol.encode_frame(protocol.STATUS_ERROR, message.encode('utf8'))
+
+  def _dispatch(self, conn, code, args):
+    if code == protocol.OP_RELOAD:
+      self._reload(*args)
+      return protocol.encode_frame(protocol.STATUS_OK)
+    if code == protocol.OP_RUN:
+      return self._run(conn, args[:3], args[3])
+    return self._get_response(code, args)
+
+  def _run(self, conn, args, bset_hash):
+    if not self._pool or not self._pool.workers:
+      raise RuntimeError('the build server has no worker processes')
+    status, body = protocol.split_frame(bytearray(
+      self._get_response(protocol.OP_GET_ACTION, args)))
+    if status != protocol.STATUS_OK:
+      return protocol.encode_frame(status, body)
+    action_hash = protocol.decode_action(body).hash
+    if action_hash != bset_hash:
+      raise RuntimeError('build set hash inconsistency ({!r} != {!r})'
+                         .format(action_hash, bset_hash))
+    self._jobs.append((conn, protocol.encode_frame(protocol.OP_RUN_ACTION, body)))
+    return None
+
+  def _get_response(self, code, args):
+    try:
+      target = self._master.get_target(args[0])
+      operator = target.operators[args[1]]
+      bset = operator.build_sets[args[2]]
+    except (KeyError, IndexError):
+      return protocol.encode_frame(protocol.STATUS_ERROR, b'DoesNotExist')
+    responses = self._responses.setdefault(args[0], {})
+    key = (code,) + args[1:] + (bset.additional_args,)
+    response = responses.get(key)
+    if response is None:
+      if code == protocol.OP_GET_ACTION:
+        response = self._encode_action(operator, bset)
+      else:
+        response = self._encode_build_set(operator, bset)
+      responses[key] = response
+    return response
+
+  def _encode_action(self, operator, bset):
+    action = protocol.Action.from_build_set(
+      bset, self._get_additional_args(operator.target, operator, bset))
+    return protocol.encode_frame(protocol.STATUS_OK, protocol.encode_action(action))
+
+  def _encode_build_set(self, operator, bset):
+    data = {
+      'target': {'id': operator.target.id, 'operators': [operator.to_json(build_sets=[bset])]},
+      'commands': self._master.command_table([operator]),
+      'hash': bset.compute_hash(),
+      'additional_args': self._get_additional_args(operator.target, operator, bset)
+    }
+    return protocol.encode_frame(protocol.STATUS_OK, json.dumps(data).encode('utf8'))
+
+  def _reload(self, shard=None):
+    if shard is not None:
+      try:
+        self._master.reload_shard(shard)
+      except RuntimeError:
+        pass  # The graph was not loaded from a sharded graph file.
+      else:
+        key = self._master.shard_key
+        for target_id in [x for x in self._responses if key(x) == shard]:
+          del self._responses[target_id]
+        return
+    for target_id in self._master.reload():
+      self._responses.pop(target_id, None)
+
+  def _get_additional_args(self, target: 'Target', operator: 'Operator', bset: 'BuildSet'):
+    if bset.additional_args:
+      return shlex.split(bset.additional_args)
+    return []
+
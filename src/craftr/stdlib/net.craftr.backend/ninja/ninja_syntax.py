@@ -10,21 +10,53 @@ use Python.
 import re
 import textwrap
 
+
 def escape_path(word):
+    if ' ' not in word and ':' not in word:
+        return word
     return word.replace('$ ', '$$ ').replace(' ', '$ ').replace(':', '$:')
 
+
+def escape_paths(words):
+    """Escapes a list of paths with escape_path() and joins them with spaces.
+    Paths can not contain newlines, so all of them are escaped at once."""
+    if len(words) == 1:
+        return escape_path(words[0])
+    return escape_path('\n'.join(words)).replace('\n', ' ')
+
+
 class Writer(object):
-    def __init__(self, output, width=78):
+    """Writes Ninja statements to *output*. The text is collected in a
+    buffer that is written to *output* when it exceeds *buffer_size*
+    characters and in flush(), which must be called when done."""
+
+    def __init__(self, output, width=78, buffer_size=1 << 20):
         self.output = output
         self.width = width
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+
+    def _write(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered text to the output."""
+        if self._buffer:
+            self.output.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
 
     def newline(self):
-        self.output.write('\n')
+        self._write('\n')
 
     def comment(self, text, has_path=False):
         for line in textwrap.wrap(text, self.width - 2, break_long_words=False,
                                   break_on_hyphens=False):
-            self.output.write('# ' + line + '\n')
+            self._write('# ' + line + '\n')
 
     def variable(self, key, value, indent=0):
         if value is None:
@@ -62,25 +94,22 @@ class Writer(object):
     def build(self, outputs, rule, inputs=None, implicit=None, order_only=None,
               variables=None, implicit_outputs=None):
         outputs = as_list(outputs)
-        out_outputs = [escape_path(x) for x in outputs]
-        all_inputs = [escape_path(x) for x in as_list(inputs)]
-
+        text = 'build ' + escape_paths(outputs)
+        if implicit_outputs:
+            text += ' | ' + escape_paths(as_list(implicit_outputs))
+        text += ': ' + rule
+        inputs = as_list(inputs)
+        if inputs:
+            text += ' ' + escape_paths(inputs)
         if implicit:
-            implicit = [escape_path(x) for x in as_list(implicit)]
-            all_inputs.append('|')
-            all_inputs.extend(implicit)
+            text += ' | ' + escape_paths(as_list(implicit))
         if order_only:
-            order_only = [escape_path(x) for x in as_list(order_only)]
-            all_inputs.append('||')
-            all_inputs.extend(order_only)
-        if implicit_outputs:
-            implicit_outputs = [escape_path(x)
-                                for x in as_list(implicit_outputs)]
-            out_outputs.append('|')
-            out_outputs.extend(implicit_outputs)
-
-        self._line('build %s: %s' % (' '.join(out_outputs),
-                                     ' '.join([rule] + all_inputs)))
+            text += ' || ' + escape_paths(as_list(order_only))
+        width = self.width
+        if len(text) <= width:
+            lines = [text, '\n']
+        else:
+            lines = [self._wrap(text)]
 
         if variables:
             if isinstance(variables, dict):
@@ -89,8 +118,17 @@ class Writer(object):
                 iterator = iter(variables)
 
             for key, val in iterator:
-                self.variable(key, val, indent=1)
-
+                if val is None:
+                    continue
+                if isinstance(val, list):
+                    val = ' '.join(filter(None, val))  # Filter out empty strings.
+                text = '  %s = %s' % (key, val)
+                if len(text) <= width:
+                    lines += (text, '\n')
+                else:
+                    lines.append(self._wrap(text[2:], 1))
+
+        self._write(''.join(lines))
         return outputs
 
     def include(self, path):
@@ -102,52 +140,66 @@ class Writer(object):
     def default(self, paths):
         self._line('default %s' % ' '.join(as_list(paths)))
 
-    def _count_dollars_before_index(self, s, i):
-        """Returns the number of '$' characters right in front of s[i]."""
-        dollar_count = 0
-        dollar_index = i - 1
-        while dollar_index > 0 and s[dollar_index] == '$':
-            dollar_count += 1
-            dollar_index -= 1
-        return dollar_count
-
     def _line(self, text, indent=0):
         """Write 'text' word-wrapped at self.width characters."""
+        self._write(self._wrap(text, indent))
+
+    def _wrap(self, text, indent=0):
+        """Returns 'text' word-wrapped at self.width characters. The text is
+        never copied while it is searched for spaces, so this is linear in the
+        length of the text."""
         leading_space = '  ' * indent
-        while len(leading_space) + len(text) > self.width:
+        if len(leading_space) + len(text) <= self.width:
+            return leading_space + text + '\n'
+
+        def escaped(space, start):
+            # Count the '$' right in front of the space. Like the original
+            # implementation, the first character of the line is not counted.
+            i = space - 1
+            while i > start and text[i] == '$':
+                i -= 1
+            return (space - 1 - i) % 2 == 1
+
+        parts = []
+        start = 0
+        while len(leading_space) + len(text) - start > self.width:
             # The text is too wide; wrap if possible.
 
             # Find the rightmost space that would obey our width constraint and
             # that's not an escaped space.
             available_space = self.width - len(leading_space) - len(' $')
-            space = available_space
+            if available_space < 0:
+                # The original str.rfind()/str.find() calls on the remaining
+                # text counted a negative limit from its end.
+                available_space = max(0, len(text) - start + available_space)
+            space = start + available_space
             while True:
-                space = text.rfind(' ', 0, space)
-                if (space < 0 or
-                    self._count_dollars_before_index(text, space) % 2 == 0):
+                space = text.rfind(' ', start, space)
+                if space < 0 or not escaped(space, start):
                     break
 
             if space < 0:
                 # No such space; just use the first unescaped space we can find.
-                space = available_space - 1
+                space = start + available_space - 1
                 while True:
                     space = text.find(' ', space + 1)
-                    if (space < 0 or
-                        self._count_dollars_before_index(text, space) % 2 == 0):
+                    if space < 0 or not escaped(space, start):
                         break
             if space < 0:
                 # Give up on breaking.
                 break
 
-            self.output.write(leading_space + text[0:space] + ' $\n')
-            text = text[space+1:]
+            parts += [leading_space, text[start:space], ' $\n']
+            start = space + 1
 
             # Subsequent lines are continuations, so indent them.
             leading_space = '  ' * (indent+2)
 
-        self.output.write(leading_space + text + '\n')
+        parts += [leading_space, text[start:], '\n']
+        return ''.join(parts)
 
     def close(self):
+        self.flush()
         self.output.close()
 
 
@@ -1,6 +1,7 @@
 
 import {options} from '../build.craftr'
 import nr.fs
+import os
 
 from craftr.api import *
 from craftr.core import build
@@ -39,6 +40,53 @@ if not options.namingScheme:
   options.namingScheme = NamingScheme.CURRENT.to_str()
 options.namingScheme = NamingScheme(options.namingScheme).with_defaults(NamingScheme.CURRENT)
 
+# The memory in MiB that is reserved for every link step, see link_pool_depth().
+options.add('linkMemory', int, 2048)
+
+
+def physical_memory():
+  """
+  Returns the size of the physical memory of the machine in bytes, or #None
+  if it can not be determined.
+  """
+
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+  except (AttributeError, ValueError, OSError):
+    pass
+  if OS.id == 'win32':
+    import ctypes
+    class MEMORYSTATUSEX(ctypes.Structure):
+      _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong),
+                  ('ullTotalPhys', ctypes.c_ulonglong), ('ullAvailPhys', ctypes.c_ulonglong),
+                  ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                  ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong),
+                  ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+    status = MEMORYSTATUSEX()
+    status.dwLength = ctypes.sizeof(status)
+    if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+      return status.ullTotalPhys
+  return None
+
+
+def link_pool_depth():
+  """
+  Returns the number of link steps that can run in parallel without running
+  out of memory, assuming that every link step needs `linkMemory` MiB. Link
+  steps with link-time optimization easily use several GiB each.
+  """
+
+  cpus = os.cpu_count() or 1
+  memory = physical_memory()
+  if not memory or options.linkMemory <= 0:
+    return cpus
+  return max(1, min(cpus, memory // (options.linkMemory * 1024 * 1024)))
+
+
+# Link steps run in the `link` pool. Its depth can be overridden with the
+# `pool:link` option.
+pool('link', link_pool_depth())
+
 
 def short_path(x):
   y = path.rel(x, par=True)
@@ -384,7 +432,8 @@ class Compiler:
       input_files += data.outLinkLibraries + data.staticLibraries + data.dynamicLibraries
     if data.takeInputObjects:
       input_files += data.outObjectFiles
-    op = operator(action_name, commands=commands, environ=self.linker_env)
+    op = operator(action_name, commands=commands, environ=self.linker_env,
+                  pool=None if is_staticlib(data) else 'link')
     bset = BuildSet(
       {'in': input_files},
       {'product': data.productFilename})
@@ -0,0 +1,161 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+
+from craftr.core import protocol
+from craftr.core.actioncache import ActionCache, format_hit_rate, parse_size, run_cached
+
+
+def write(filename, content):
+  with open(filename, 'w') as fp:
+    fp.write(content)
+
+
+def read(filename):
+  with open(filename) as fp:
+    return fp.read()
+
+
+def test_parse_size():
+  assert parse_size('100') == 100
+  assert parse_size('2k') == 2048
+  assert parse_size('1.5M') == 3 << 19
+  assert parse_size('5G') == 5 << 30
+
+
+def test_format_hit_rate():
+  assert format_hit_rate(3, 1) == 'action cache: 3 of 4 build sets restored (75%)'
+  assert format_hit_rate(0, 0) == 'action cache: 0 of 0 build sets restored (0%)'
+
+
+def test_action_cache(tmpdir):
+  src, hdr, out = (str(tmpdir.join(x)) for x in ('a.c', 'a.h', 'a.o'))
+  write(src, 'source')
+  write(hdr, 'header')
+  write(out, 'object')
+  with ActionCache(str(tmpdir.join('cache'))) as cache:
+    key = cache.action_key('hash', [src])
+    assert key == cache.action_key('hash', [src])
+    assert key != cache.action_key('other', [src])
+    assert cache.action_key('hash', [str(tmpdir.join('missing.c'))]) is None
+    assert cache.restore(key, [out]) is None
+
+    cache.store(key, [out], [hdr], b'warning\n', 1.5)
+    assert cache.size() == len('object')
+    os.remove(out)
+    entry = cache.restore(key, [out])
+    assert entry.output == b'warning\n'
+    assert entry.duration == 1.5
+    assert list(entry.deps) == [hdr]
+    assert read(out) == 'object'
+    # The restored file can be modified without changing the cache.
+    write(out, 'modified')
+    assert cache.restore(key, [out]) is not None
+    assert read(out) == 'object'
+
+    # The action is not restored if a discovered dependency changed.
+    write(hdr, 'changed header')
+    assert cache.restore(key, [out]) is None
+    assert cache.restore(key, [out, str(tmpdir.join('b.o'))]) is None
+    assert (cache.hits, cache.misses) == (2, 3)
+    assert cache.stats() == {'hits': 2, 'misses': 3, 'size': len('object')}
+  with ActionCache(str(tmpdir.join('cache'))) as cache:
+    assert cache.stats()['hits'] == 2
+
+
+def test_action_cache_digests(tmpdir, monkeypatch):
+  src = str(tmpdir.join('a.c'))
+  write(src, 'source')
+  os.utime(src, (0, 0))
+  with ActionCache(str(tmpdir.join('cache'))) as cache:
+    digest = cache.digests([src])[src]
+
+  # The digests are shared by all processes that use the cache.
+  from craftr.core import digests
+  monkeypatch.setattr(digests, 'hash_file', None)
+  with ActionCache(str(tmpdir.join('cache'))) as cache:
+    assert cache.digests([src]) == {src: digest}
+
+
+def test_action_cache_eviction(tmpdir):
+  cache = ActionCache(str(tmpdir.join('cache')), max_size=25)
+  keys = []
+  for i in range(3):
+    filename = str(tmpdir.join('{}.o'.format(i)))
+    write(filename, str(i) * 10)
+    keys.append(cache.action_key('hash{}'.format(i), [filename]))
+    cache.store(keys[-1], [filename])
+  # The least recently used file was evicted to stay below 90% of the limit.
+  assert cache.size() == 20
+  assert cache.restore(keys[0], [str(tmpdir.join('0.o'))]) is None
+  assert cache.restore(keys[1], [str(tmpdir.join('1.o'))]) is not None
+  assert len([x for x in tmpdir.join('cache', 'cas').visit() if x.isfile()]) == 2
+  cache.close()
+
+
+def test_action_cache_hardlinks(tmpdir):
+  src, out = str(tmpdir.join('a.c')), str(tmpdir.join('a.o'))
+  write(src, 'source')
+  write(out, 'object')
+  with ActionCache(str(tmpdir.join('cache')), hardlinks=True) as cache:
+    key = cache.action_key('hash', [src])
+    cache.store(key, [out])
+    os.remove(out)
+    assert cache.restore(key, [out]) is not None
+    assert os.stat(out).st_nlink == 2
+
+
+def test_run_cached(tmpdir, capfd):
+  src, out = str(tmpdir.join('a.c')), str(tmpdir.join('a.o'))
+  depfile = str(tmpdir.join('a.o.d'))
+  write(src, 'source')
+  action = protocol.Action(
+    operator='scope@app:cc#1', hash='abc', cwd=None, environ={}, commands=[],
+    response_args=[], additional_args=[], outputs=[out], inputs=[src],
+    depfile=depfile)
+  calls = []
+
+  def run(output):
+    calls.append(output)
+    write(out, 'object')
+    write(depfile, '{}: {}\n'.format(out, src))
+    output += b'compiled\n'
+    return 0
+
+  with ActionCache(str(tmpdir.join('cache'))) as cache:
+    assert run_cached(cache, action, run) == 0
+    os.remove(out)
+    os.remove(depfile)
+    capfd.readouterr()
+    assert run_cached(cache, action, run) == 0
+    assert len(calls) == 1
+    assert capfd.readouterr().out == 'compiled\n'
+    assert read(out) == 'object'
+    assert read(depfile) == '{}: {}\n'.format(out, src)
+
+    # Failed commands are not cached.
+    write(src, 'changed')
+    assert run_cached(cache, action, lambda output: 1) == 1
+    assert run_cached(cache, action, run) == 0
+    assert len(calls) == 2
@@ -0,0 +1,75 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import pytest
+
+from craftr.core import actionindex, protocol
+
+
+def make_action(name, index):
+  return protocol.Action(
+    operator=name, hash='hash{}'.format(index), cwd=None, environ={},
+    commands=[['cc', '-c', '{}.c'.format(index)]], response_args=[-1],
+    additional_args=[], outputs=['{}.o'.format(index)])
+
+
+def test_roundtrip(tmpdir):
+  filename = str(tmpdir.join('actions.idx'))
+  actions = [('scope@{}'.format(t), 'compile#1', i, make_action(t, i))
+             for t in ('lib', 'app', 'ä') for i in range(300)]
+  actionindex.write(filename, reversed(actions))
+  with actionindex.ActionIndex(filename) as index:
+    assert len(index) == len(actions)
+    for target, operator, i, action in actions:
+      assert index.find(target, operator, i) == action
+    assert index.find('scope@lib', 'compile#1', 300) is None
+    assert index.find('scope@lib', 'compile', 0) is None
+    assert index.find('scope@zzz', 'compile#1', 0) is None
+    assert index.find('', '', 0) is None
+
+
+def test_empty(tmpdir):
+  filename = str(tmpdir.join('actions.idx'))
+  actionindex.write(filename, [])
+  with actionindex.ActionIndex(filename) as index:
+    assert len(index) == 0
+    assert index.find('scope@lib', 'compile#1', 0) is None
+
+
+def test_replace(tmpdir):
+  filename = str(tmpdir.join('actions.idx'))
+  actionindex.write(filename, [('a@b', 'c#1', 0, make_action('a', 0))])
+  with actionindex.ActionIndex(filename) as index:
+    actionindex.write(filename, [('a@b', 'c#1', 0, make_action('b', 0))])
+    assert index.find('a@b', 'c#1', 0).operator == 'a'
+  with actionindex.ActionIndex(filename) as index:
+    assert index.find('a@b', 'c#1', 0).operator == 'b'
+  assert tmpdir.listdir() == [tmpdir.join('actions.idx')]
+
+
+def test_invalid(tmpdir):
+  filename = tmpdir.join('actions.idx')
+  for data in (b'', b'CRAFTRGB\x01\x00\x00\x00\x00\x00\x00\x00'):
+    filename.write_binary(data)
+    with pytest.raises(ValueError):
+      actionindex.ActionIndex(str(filename))
@@ -0,0 +1,180 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import pytest
+
+from craftr.core.build import BuildSet, Commands, Master, Operator, Target
+
+
+def make_chain(master, names):
+  target = master.add_target(Target(master, 'scope@chain'))
+  op = target.add_operator(Operator(master, 'copy#1',
+    Commands([['cp', '$<in', '$@out', '$flags']])))
+  op.variables['flags'] = []
+  bsets = []
+  for prev, name in zip(names, names[1:]):
+    bset = BuildSet(master)
+    bset.add_input_files('in', [prev])
+    bset.add_output_files('out', [name])
+    bsets.append(op.add_build_set(bset))
+  return op, bsets
+
+
+class TestBuildSetHash:
+
+  def test_cached_and_invalidated(self, tmpdir):
+    master = Master()
+    op, (bset,) = make_chain(master, [str(tmpdir.join('a')), str(tmpdir.join('b'))])
+    h = bset.compute_hash()
+    assert bset.compute_hash() is h
+
+    bset.variables['foo'] = 'bar'
+    h2 = bset.compute_hash()
+    assert h2 != h
+
+    op.variables['flags'] = ['-v']
+    h3 = bset.compute_hash()
+    assert h3 != h2
+
+    bset.depfile = str(tmpdir.join('b.d'))
+    h4 = bset.compute_hash()
+    assert h4 != h3
+
+    bset.add_input_files('in', [str(tmpdir.join('c'))])
+    assert bset.compute_hash() != h4
+
+  def test_invalidated_by_in_place_changes(self, tmpdir):
+    master = Master()
+    op, _ = make_chain(master, [str(tmpdir.join('a')), str(tmpdir.join('b'))])
+    bset = BuildSet(master, environ={'CC': 'gcc'})
+    bset.add_input_files('in', [str(tmpdir.join('a'))])
+    bset.add_output_files('out', [str(tmpdir.join('c'))])
+    op.add_build_set(bset)
+
+    hashes = [bset.compute_hash()]
+    bset.inputs['in'].append(str(tmpdir.join('x')))
+    hashes.append(bset.compute_hash())
+    bset.outputs['out'][0] = str(tmpdir.join('d'))
+    hashes.append(bset.compute_hash())
+    bset.inputs['extra'] = [str(tmpdir.join('y'))]
+    hashes.append(bset.compute_hash())
+    bset.inputs['extra'] += [str(tmpdir.join('z'))]
+    hashes.append(bset.compute_hash())
+    bset.environ['CC'] = 'clang'
+    hashes.append(bset.compute_hash())
+    assert len(set(hashes)) == len(hashes)
+
+    # Loaded build sets are tracked the same way.
+    loaded = BuildSet.from_json(Master(), op, bset.to_json())
+    h = loaded.compute_hash()
+    assert h == bset.compute_hash()
+    loaded.environ.pop('CC')
+    assert loaded.compute_hash() != h
+
+  def test_deep_hash(self, tmpdir):
+    master = Master()
+    files = [str(tmpdir.join(str(i))) for i in range(5)]
+    op, bsets = make_chain(master, files)
+    deep = [x.compute_hash(deep=True) for x in bsets]
+    assert len(set(deep)) == len(deep)
+    assert bsets[-1].compute_hash(deep=True) == deep[-1]
+
+    bsets[0].variables['foo'] = 'bar'
+    assert bsets[-1].compute_hash(deep=True) != deep[-1]
+    assert bsets[-1].compute_hash() == bsets[-1].compute_hash()
+
+  def test_deep_hash_cycle(self, tmpdir):
+    master = Master()
+    a, b = str(tmpdir.join('a')), str(tmpdir.join('b'))
+    op, bsets = make_chain(master, [a, b])
+    bset = BuildSet(master)
+    bset.add_input_files('in', [b])
+    bset.add_output_files('out', [a])
+    op.add_build_set(bset)
+    with pytest.raises(RuntimeError):
+      bset.compute_hash(deep=True)
+
+
+class TestMaster:
+
+  def test_paths_interned(self, tmpdir):
+    master = Master()
+    files = [str(tmpdir.join(str(i))) for i in range(3)]
+    op, bsets = make_chain(master, files)
+    assert bsets[0].outputs['out'][0] is bsets[1].inputs['in'][0]
+
+    filename = str(tmpdir.join('graph.json'))
+    master.save(filename)
+    loaded = Master()
+    loaded.load(filename)
+    bsets = loaded.get_target('scope@chain').operators['copy#1'].build_sets
+    assert bsets[0].outputs['out'][0] is bsets[1].inputs['in'][0]
+    assert bsets[0].outputs['out'][0] is loaded.intern_path(files[1])
+
+  def test_canonicalize_paths(self, tmpdir):
+    master = Master()
+    with tmpdir.as_cwd():
+      result = master.canonicalize_paths(['a/../b', str(tmpdir.join('c'))])
+      assert result == [str(tmpdir.join('b')), str(tmpdir.join('c'))]
+      assert master.canonicalize_paths(['a/../b'])[0] is result[0]
+      assert master.canonicalize_paths(['b'], str(tmpdir.join('d'))) == \
+          [str(tmpdir.join('d', 'b'))]
+    with tmpdir.join('..').as_cwd():
+      assert master.canonicalize_paths(['a/../b']) == [str(tmpdir.join('..', 'b'))]
+
+  def test_affected_build_sets(self, tmpdir):
+    master = Master()
+    files = [str(tmpdir.join(str(i))) for i in range(5)]
+    op, bsets = make_chain(master, files)
+    bset = BuildSet(master)
+    bset.add_input_files('in', [files[2]])
+    bset.add_output_files('out', [str(tmpdir.join('other'))])
+    op.add_build_set(bset)
+
+    assert master.get_consumer_build_sets(files[2]) == [bsets[2], bset]
+    assert master.get_affected_build_sets([files[4]]) == []
+    assert master.get_affected_build_sets([files[3]]) == [bsets[3]]
+    assert set(master.get_affected_build_sets([files[1]])) == \
+        set(bsets[1:]) | {bset}
+
+    # Discovered dependencies (eg. from depfiles) are followed as well.
+    header = str(tmpdir.join('a.h'))
+    assert master.get_affected_build_sets([header]) == []
+    assert master.get_affected_build_sets([header], {header: [bsets[3]]}) == [bsets[3]]
+
+  def test_pools(self):
+    master = Master()
+    master.declare_pool('link', 4)
+    assert master.pools == {'link': 4}
+    assert master.get_pool_depths() == {'link': 4, 'console': 1}
+    with pytest.raises(ValueError):
+      master.declare_pool('console', 2)
+    with pytest.raises(ValueError):
+      master.declare_pool('link', 0)
+
+    commands = Commands([['run']])
+    assert Operator(master, 'a', commands, pool='link').get_pool() == 'link'
+    assert Operator(master, 'b', commands, syncio=True).get_pool() == 'console'
+    with pytest.raises(ValueError):
+      Operator(master, 'c', commands, syncio=True, pool='link')
@@ -0,0 +1,102 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sqlite3
+
+from craftr.core.buildstate import BuildState
+
+
+def test_build_state(tmpdir):
+  filename = str(tmpdir.join('state.db'))
+  with BuildState(filename) as state:
+    assert state.created
+    assert state.get_output_hash('a.o') is None
+    assert state.get_build_set('a.o') is None
+    state.record('a.o', ['a.o', 'a.d'], 'h1', 1.5, 'digest', ['a.c', 'x.h'], 10)
+    state.record('b.o', ['b.o'], 'h2', 0.5, deps=None)
+    # Pending changes are visible before they are written.
+    assert state.get_output_hash('a.d') == 'h1'
+    assert state.get_build_set('a.o').deps == ['a.c', 'x.h']
+
+  with BuildState(filename) as state:
+    assert not state.created
+    assert state.get_output_hash('a.o') == 'h1'
+    assert state.get_output_hash('b.o') == 'h2'
+    assert state.get_build_set('a.o') == (1.5, 0, 'digest', 10, ['a.c', 'x.h'])
+    assert state.get_build_set('b.o') == (0.5, 0, None, None, None)
+    assert state.durations() == {'a.o': 1.5, 'b.o': 0.5}
+
+    state.record_failure('a.o', ['a.o', 'a.d'], 2.0, 3)
+    state.record('b.o', ['b.o'], 'h3', 0.25, deps=['b.c', 'x.h'], deps_mtime=20)
+
+  with BuildState(filename) as state:
+    assert state.get_output_hash('a.o') is None
+    assert state.get_build_set('a.o') == (2.0, 3, None, None, None)
+    assert state.get_build_set('b.o').deps == ['b.c', 'x.h']
+    conn = sqlite3.connect(filename)
+    assert conn.execute('SELECT COUNT(*) FROM paths').fetchone()[0] == 3
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_build_state_all_deps(tmpdir):
+  filename = str(tmpdir.join('state.db'))
+  with BuildState(filename) as state:
+    state.record('a.o', ['a.o'], 'h1', 1.0, deps=['a.c', 'x.h'], deps_mtime=10)
+    state.record('b.o', ['b.o'], 'h2', 1.0, deps=['b.c', 'x.h'], deps_mtime=10)
+    state.record('c.o', ['c.o'], 'h3', 1.0)
+  with BuildState(filename) as state:
+    state.record_failure('b.o', ['b.o'], 1.0, 1)
+    assert state.all_deps() == {'a.o': ['a.c', 'x.h']}
+
+
+def test_build_state_batches(tmpdir):
+  filename = str(tmpdir.join('state.db'))
+  state = BuildState(filename, batch_size=2, batch_interval=3600)
+  reader = sqlite3.connect(filename)
+  count = lambda: reader.execute('SELECT COUNT(*) FROM build_sets').fetchone()[0]
+  state.record('a', ['a'], 'h', 1.0)
+  assert count() == 0
+  state.record('b', ['b'], 'h', 1.0)
+  assert count() == 2
+  state.record('c', ['c'], 'h', 1.0)
+  # An interrupted build keeps the state that has been written.
+  del state
+  assert count() == 2
+
+
+def test_build_state_digests(tmpdir):
+  filename = str(tmpdir.join('state.db'))
+  state = BuildState(filename, batch_size=3, batch_interval=3600)
+  reader = sqlite3.connect(filename)
+  count = lambda: reader.execute('SELECT COUNT(*) FROM digests').fetchone()[0]
+  state.store_digests({'a.c': (1, 10, 100, 'da'), 'b.c': (2, 20, 200, 'db')})
+  # Pending digests are visible before they are written.
+  assert state.load_digests(['a.c', 'x.c']) == {'a.c': (1, 10, 100, 'da')}
+  assert count() == 0
+  state.store_digests({'b.c': None, 'c.c': (3, 30, 300, 'dc')})
+  assert count() == 2
+  state.close()
+
+  with BuildState(filename) as state:
+    assert state.load_digests(['a.c', 'b.c', 'c.c']) == {
+      'a.c': (1, 10, 100, 'da'), 'c.c': (3, 30, 300, 'dc')}
@@ -0,0 +1,49 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from craftr.core.depslog import parse_depfile, parse_show_includes
+
+
+def test_parse_depfile():
+  text = (
+    'build/main.o: src/main.c include/a.h \\\n'
+    '  include/with\\ space.h C:\\include\\b.h \\\r\n'
+    ' include/$$dollar.h include/\\#hash.h\n'
+    'include/a.h:\n'
+    '\n'
+    'include/with\\ space.h:\n')
+  assert parse_depfile(text) == [
+    'src/main.c', 'include/a.h', 'include/with space.h', 'C:\\include\\b.h',
+    'include/$dollar.h', 'include/#hash.h']
+  assert parse_depfile('') == []
+
+
+def test_parse_show_includes():
+  output = ('main.cpp\r\n'
+            'Note: including file: C:\\include\\a.h\r\n'
+            'Note: including file:  C:\\include\\b.h\r\n'
+            'main.cpp(3): warning C4101: unused variable\r\n')
+  deps, output = parse_show_includes(output, 'Note: including file:')
+  assert deps == ['C:\\include\\a.h', 'C:\\include\\b.h']
+  assert output == 'main.cpp(3): warning C4101: unused variable\r\n'
+
@@ -0,0 +1,129 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import os
+import pytest
+
+from craftr.core import digests
+from craftr.core.buildstate import BuildState
+from craftr.core.digests import DigestCache
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+  """
+  Records the files that are read by #digests.hash_file().
+  """
+
+  files = []
+  hash_file = digests.hash_file
+  def wrapper(filename):
+    files.append(filename)
+    return hash_file(filename)
+  monkeypatch.setattr(digests, 'hash_file', wrapper)
+  return files
+
+
+def write(filename, data, age=10):
+  with open(filename, 'wb') as fp:
+    fp.write(data)
+  mtime = os.stat(filename).st_mtime - age
+  os.utime(filename, (mtime, mtime))
+
+
+def test_digests(tmpdir, hashed):
+  files = [str(tmpdir.join(x)) for x in 'abc']
+  for i, filename in enumerate(files[:2]):
+    write(filename, b'x' * i)
+  cache = DigestCache(workers=2, parallel_threshold=0)
+  result = cache.digests(files)
+  assert result == {files[0]: hashlib.sha1(b'').hexdigest(),
+                    files[1]: hashlib.sha1(b'x').hexdigest(), files[2]: None}
+  assert sorted(hashed) == files[:2]
+
+  # Unchanged files are not read again.
+  del hashed[:]
+  assert cache.digests(files) == result
+  assert hashed == []
+
+  write(files[1], b'y')
+  assert cache.digest(files[1]) == hashlib.sha1(b'y').hexdigest()
+  assert hashed == [files[1]]
+
+
+def test_racy_files_not_cached(tmpdir, hashed):
+  filename = str(tmpdir.join('a'))
+  write(filename, b'a', age=0)
+  cache = DigestCache()
+  cache.digest(filename)
+  cache.digest(filename)
+  assert hashed == [filename, filename]
+  assert len(cache) == 0
+
+
+def test_persistence(tmpdir, hashed):
+  filename = str(tmpdir.join('a'))
+  write(filename, b'a')
+  state_file = str(tmpdir.join('cache', 'state.db'))
+  with BuildState(state_file) as state:
+    digest = DigestCache(state).digest(filename)
+
+  del hashed[:]
+  with BuildState(state_file) as state:
+    assert DigestCache(state).digest(filename) == digest
+  assert hashed == []
+
+
+class DictStore(digests.DigestStore):
+
+  def __init__(self):
+    self.entries = {}
+
+  def load_digests(self, filenames):
+    return {k: self.entries[k] for k in filenames if k in self.entries}
+
+  def store_digests(self, entries):
+    for k, v in entries.items():
+      if v is None:
+        self.entries.pop(k, None)
+      else:
+        self.entries[k] = v
+
+
+def test_store(tmpdir, hashed):
+  files = [str(tmpdir.join(x)) for x in 'ab']
+  write(files[0], b'a')
+  write(files[1], b'b')
+  store = DictStore()
+  result = DigestCache(store=store).digests(files)
+  assert sorted(store.entries) == files
+
+  del hashed[:]
+  assert DigestCache(store=store).digests(files) == result
+  assert hashed == []
+
+  # A file that changed recently is removed from the store.
+  write(files[1], b'bb', age=0)
+  DigestCache(store=store).digest(files[1])
+  assert sorted(store.entries) == files[:1]
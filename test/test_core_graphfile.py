@@ -0,0 +1,279 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import pytest
+
+from craftr.core.build import BuildSet, Commands, Master, Operator, Target
+from craftr.core.graphfile import GraphVersionError, detect_format
+
+
+def make_graph(tmpdir):
+  master = Master()
+  master.declare_pool('compile', 2)
+  for name in ('lib', 'app'):
+    target = master.add_target(Target(master, 'scope@' + name))
+    op = target.add_operator(Operator(master, 'compile#1',
+      Commands([['cc', '-c', '${<src}', '-o', '${@obj}', '$flags']]),
+      environ={'CC': 'gcc'}, pool='compile'))
+    op.variables['flags'] = ['-O2', '-g']
+    for src in ('a.c', 'b.c'):
+      bset = BuildSet(master, description='compile $<src')
+      bset.add_input_files('src', [str(tmpdir.join(name, src))])
+      bset.add_output_files('obj', [str(tmpdir.join('build', name, src + '.o'))])
+      op.add_build_set(bset)
+    op = target.add_operator(Operator(master, 'run#1', Commands([['$<in']]),
+      explicit=True, syncio=True, cwd=str(tmpdir)))
+    bset = BuildSet(master)
+    bset.add_input_files('in', [str(tmpdir.join('build', name, 'a.c.o'))])
+    op.add_build_set(bset)
+  return master
+
+
+class TestBinaryGraph:
+
+  def test_roundtrip(self, tmpdir):
+    master = make_graph(tmpdir)
+    filename = str(tmpdir.join('graph.bin'))
+    master.save(filename, 'binary')
+    assert detect_format(filename) == 'binary'
+
+    loaded = Master()
+    loaded.load(filename)
+    assert sorted(loaded.target_ids()) == ['scope@app', 'scope@lib']
+    expected = master.to_json()
+    expected['targets'].sort(key=lambda x: x['id'])
+    assert json.dumps(loaded.to_json(), sort_keys=True) == \
+        json.dumps(expected, sort_keys=True)
+    assert loaded.pools == {'compile': 2}
+    assert loaded.get_target('scope@app').operators['compile#1'].pool == 'compile'
+
+  def test_lazy_loading(self, tmpdir):
+    master = make_graph(tmpdir)
+    filename = str(tmpdir.join('graph.bin'))
+    master.save(filename, 'binary')
+
+    loaded = Master()
+    loaded.load(filename)
+    assert loaded._targets == {}
+    assert len(loaded.output_files()) == 4
+
+    bset = loaded.get_output_build_set(str(tmpdir.join('build', 'app', 'b.c.o')))
+    assert bset is not None
+    assert bset.operator.target.id == 'scope@app'
+    assert list(loaded._targets) == ['scope@app']
+    assert loaded.get_output_build_set(str(tmpdir.join('nothing'))) is None
+
+    with pytest.raises(KeyError):
+      loaded.get_target('scope@nothing')
+    assert loaded.get_target('scope@lib').id == 'scope@lib'
+
+  def test_json_detected(self, tmpdir):
+    master = make_graph(tmpdir)
+    filename = str(tmpdir.join('graph.json'))
+    master.save(filename)
+    assert detect_format(filename) == 'json'
+    loaded = Master()
+    loaded.load(filename)
+    assert sorted(loaded.target_ids()) == ['scope@app', 'scope@lib']
+
+
+class TestShardedGraph:
+
+  @pytest.mark.parametrize('format', ['json', 'binary'])
+  def test_on_demand_loading(self, tmpdir, format):
+    master = make_graph(tmpdir)
+    target = master.add_target(Target(master, 'other@lib'))
+    op = target.add_operator(Operator(master, 'link#1', Commands([['ld', '$<in']])))
+    bset = BuildSet(master)
+    bset.add_input_files('in', [str(tmpdir.join('build', 'lib', 'a.c.o'))])
+    bset.add_output_files('out', [str(tmpdir.join('build', 'other.so'))])
+    op.add_build_set(bset)
+
+    filename = str(tmpdir.join('graph.manifest'))
+    assert sorted(master.save(filename, format, sharded=True)) == ['other', 'scope']
+    assert detect_format(filename) == 'sharded'
+    assert master.save(filename, format, sharded=True) == []
+
+    loaded = Master()
+    loaded.load(filename)
+    assert sorted(loaded.target_ids()) == ['other@lib', 'scope@app', 'scope@lib']
+    other = loaded.get_target('other@lib')
+    assert sorted(loaded._reader._shards) == [0]
+    inputs = next(iter(other.operators)).build_sets[0].get_input_build_sets()
+    assert [x.operator.target.id for x in inputs] == ['scope@lib']
+    assert sorted(loaded._reader._shards) == [0, 1]
+    data, expected = loaded.to_json(), master.to_json()
+    assert data['commands'] == expected['commands']
+    assert sorted(data['targets'], key=lambda x: x['id']) == \
+        sorted(expected['targets'], key=lambda x: x['id'])
+
+  def test_reload_shard(self, tmpdir):
+    master = make_graph(tmpdir)
+    filename = str(tmpdir.join('graph.manifest'))
+    master.save(filename, sharded=True)
+    loaded = Master()
+    loaded.load(filename)
+    old = loaded.get_target('scope@app')
+
+    master.get_target('scope@app').operators['compile#1'].variables['flags'] = ['-O3']
+    assert master.save(filename, sharded=True) == ['scope']
+    loaded.reload_shard('scope')
+    assert 'scope@app' not in loaded._targets
+    new = loaded.get_target('scope@app')
+    assert new is not old
+    assert new.operators['compile#1'].variables['flags'] == ['-O3']
+    assert loaded.get_output_build_set(str(tmpdir.join('build', 'app', 'a.c.o'))).operator is new.operators['compile#1']
+
+  def test_reload_shard_deep_hash(self, tmpdir):
+    master = make_graph(tmpdir)
+    target = master.add_target(Target(master, 'other@lib'))
+    op = target.add_operator(Operator(master, 'link#1', Commands([['ld', '$<in']])))
+    bset = BuildSet(master)
+    bset.add_input_files('in', [str(tmpdir.join('build', 'lib', 'a.c.o'))])
+    bset.add_output_files('out', [str(tmpdir.join('build', 'other.so'))])
+    op.add_build_set(bset)
+    filename = str(tmpdir.join('graph.manifest'))
+    master.save(filename, sharded=True)
+
+    loaded = Master()
+    loaded.load(filename)
+    dependent = loaded.get_target('other@lib').operators['link#1'].build_sets[0]
+    old_hash = dependent.compute_hash(deep=True)
+    master.get_target('scope@lib').operators['compile#1'].variables['flags'] = ['-O3']
+    assert master.save(filename, sharded=True) == ['scope']
+    loaded.reload_shard('scope')
+    assert dependent.compute_hash(deep=True) != old_hash
+
+
+class TestReload:
+
+  @pytest.mark.parametrize('format,sharded', [
+    ('json', False), ('binary', False), ('json', True), ('binary', True)])
+  def test_reload(self, tmpdir, format, sharded):
+    master = make_graph(tmpdir)
+    filename = str(tmpdir.join('graph'))
+    master.save(filename, format, sharded)
+    loaded = Master()
+    loaded.load(filename)
+    lib, app = loaded.get_target('scope@lib'), loaded.get_target('scope@app')
+    compile_op, run_op = app.operators['compile#1'], app.operators['run#1']
+    assert loaded.reload(filename) == []
+    assert loaded.get_target('scope@lib') is lib
+
+    master.get_target('scope@app').operators['compile#1'].variables['flags'] = ['-O3']
+    master.save(filename, format, sharded)
+    assert loaded.reload(filename) == ['scope@app']
+    assert loaded.get_target('scope@lib') is lib
+    assert loaded.get_target('scope@app') is app
+    assert app.operators['run#1'] is run_op
+    assert app.operators['compile#1'] is not compile_op
+    assert app.operators['compile#1'].variables['flags'] == ['-O3']
+    obj = str(tmpdir.join('build', 'app', 'a.c.o'))
+    assert loaded.get_output_build_set(obj).operator is app.operators['compile#1']
+    assert [x.operator for x in loaded.get_consumer_build_sets(obj)] == [run_op]
+
+  def test_add_and_remove(self, tmpdir):
+    master = make_graph(tmpdir)
+    filename = str(tmpdir.join('graph.json'))
+    master.save(filename)
+    loaded = Master()
+    loaded.load(filename)
+
+    other = Master()
+    target = other.add_target(Target(other, 'scope@other'))
+    op = target.add_operator(Operator(other, 'copy#1', Commands([['cp', '$<in', '$@out']])))
+    bset = BuildSet(other)
+    bset.add_input_files('in', [str(tmpdir.join('in.txt'))])
+    bset.add_output_files('out', [str(tmpdir.join('build', 'app', 'a.c.o'))])
+    op.add_build_set(bset)
+    other.save(filename)
+    assert sorted(loaded.reload(filename)) == ['scope@app', 'scope@lib', 'scope@other']
+    assert list(loaded.target_ids()) == ['scope@other']
+    obj = str(tmpdir.join('build', 'app', 'a.c.o'))
+    assert loaded.get_output_build_set(obj).operator.target.id == 'scope@other'
+    assert loaded.get_consumer_build_sets(obj) == []
+
+  def test_conflict(self, tmpdir):
+    master = make_graph(tmpdir)
+    filename = str(tmpdir.join('graph.json'))
+    master.save(filename)
+    loaded = Master()
+    loaded.load(filename)
+    app = loaded.get_target('scope@app')
+
+    # Declares an output of the unchanged scope@lib target, bypassing the check.
+    obj = str(tmpdir.join('build', 'lib', 'a.c.o'))
+    data = master.to_json()
+    bset = data['targets'][1]['operators'][0]['build_sets'][0]
+    assert data['targets'][1]['id'] == 'scope@app'
+    bset['outputs']['obj'] = [obj]
+    with open(filename, 'w') as fp:
+      json.dump(data, fp)
+    with pytest.raises(ValueError):
+      loaded.reload(filename)
+    assert loaded.get_target('scope@app') is app
+    assert loaded.get_output_build_set(obj).operator.target.id == 'scope@lib'
+
+
+class TestCommandTable:
+
+  def test_shared_commands(self, tmpdir):
+    master = make_graph(tmpdir)
+    lib = master.get_target('scope@lib').operators['compile#1']
+    app = master.get_target('scope@app').operators['compile#1']
+    assert lib.commands is app.commands
+    data = master.to_json()
+    assert len(data['commands']) == 2
+    assert data['commands'][lib.commands.compute_hash()] == lib.commands.to_json()
+    assert all(isinstance(op['commands'], str)
+               for target in data['targets'] for op in target['operators'])
+
+  @pytest.mark.parametrize('format,sharded', [
+    ('json', False), ('binary', False), ('json', True), ('binary', True)])
+  def test_roundtrip(self, tmpdir, format, sharded):
+    master = make_graph(tmpdir)
+    filename = str(tmpdir.join('graph'))
+    master.save(filename, format, sharded)
+    loaded = Master()
+    loaded.load(filename)
+    lib = loaded.get_target('scope@lib').operators['compile#1']
+    app = loaded.get_target('scope@app').operators['compile#1']
+    assert lib.commands is app.commands
+    assert lib.commands.compute_hash() == \
+        master.get_target('scope@lib').operators['compile#1'].commands.compute_hash()
+    with pytest.raises(KeyError):
+      loaded.get_commands('nothing')
+
+  def test_old_json_layout(self, tmpdir):
+    # Graphs written before the command table was added are a list of targets.
+    master = make_graph(tmpdir)
+    filename = str(tmpdir.join('graph.json'))
+    with open(filename, 'w') as fp:
+      json.dump(master.to_json()['targets'], fp)
+    with pytest.raises(GraphVersionError) as excinfo:
+      Master().load(filename)
+    assert 'older version of craftr' in str(excinfo.value)
+    with pytest.raises(GraphVersionError):
+      master.reload(filename)
+    assert sorted(master.target_ids()) == ['scope@app', 'scope@lib']
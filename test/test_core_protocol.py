@@ -0,0 +1,86 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import pytest
+import socket
+
+from craftr.core import protocol
+
+
+def test_split_frame():
+  buffer = bytearray(protocol.get_build_set_request('scope@app', 'compile#1', 3))
+  buffer += protocol.reload_request()
+  buffer += protocol.reload_request('scope')[:-1]
+  code, body = protocol.split_frame(buffer)
+  assert code == protocol.OP_GET_BUILD_SET
+  assert protocol.parse_request(code, body) == ('scope@app', 'compile#1', 3)
+  code, body = protocol.split_frame(buffer)
+  assert protocol.parse_request(code, body) == (None,)
+  assert protocol.split_frame(buffer) is None
+  buffer += b'e'
+  code, body = protocol.split_frame(buffer)
+  assert protocol.parse_request(code, body) == ('scope',)
+  assert buffer == b''
+
+
+def test_parse_request_errors():
+  with pytest.raises(protocol.ProtocolError):
+    protocol.parse_request(protocol.OP_GET_BUILD_SET, b'\x00\x00\x00\x09abc')
+  with pytest.raises(protocol.ProtocolError):
+    protocol.parse_request(protocol.OP_GET_BUILD_SET, protocol.encode_str('a'))
+  with pytest.raises(protocol.ProtocolError):
+    protocol.parse_request(255, b'')
+
+
+def test_request():
+  server, client = socket.socketpair()
+  with server, client:
+    server.sendall(protocol.encode_frame(protocol.STATUS_OK, b'data'))
+    assert protocol.request(client, protocol.reload_request()) == b'data'
+    assert protocol.recv_frame(server) == (protocol.OP_RELOAD, protocol.encode_str(''))
+    server.sendall(protocol.encode_frame(protocol.STATUS_ERROR, b'DoesNotExist'))
+    with pytest.raises(RuntimeError) as excinfo:
+      protocol.request(client, protocol.reload_request())
+    assert str(excinfo.value) == 'DoesNotExist'
+
+
+def test_parse_address():
+  assert protocol.parse_address('localhost:8080') == (socket.AF_INET, ('localhost', 8080))
+  if hasattr(socket, 'AF_UNIX'):
+    assert protocol.parse_address('unix:/tmp/a:b.sock') == (socket.AF_UNIX, '/tmp/a:b.sock')
+  for address in ('localhost', ':80', 'localhost:http'):
+    with pytest.raises(ValueError):
+      protocol.parse_address(address)
+
+
+def test_action_roundtrip():
+  action = protocol.Action(
+    operator='scope@app:compile#1', hash='abc', cwd=None,
+    environ={'CC': 'gcc', 'EMPTY': ''},
+    commands=[['gcc', '-c', 'a.c', '-o', 'a.o'], ['touch', 'ö']],
+    response_args=[1, -1], additional_args=['-v'], outputs=['a.o'],
+    inputs=['a.c'], depfile='a.o.d')
+  data = protocol.encode_action(action)
+  assert protocol.decode_action(data) == action
+  with pytest.raises(protocol.ProtocolError):
+    protocol.decode_action(data[:-3])
@@ -0,0 +1,138 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import pytest
+
+from craftr.core.build import BuildSet, Commands, Master, Operator, Target
+from craftr.core.scheduler import CycleError, Schedule
+
+
+def make_graph(tmpdir, edges, pool=None):
+  """
+  Creates a build set for every key in *edges*, with the build sets of the
+  listed names as inputs.
+  """
+
+  master = Master()
+  target = master.add_target(Target(master, 'scope@graph'))
+  op = target.add_operator(Operator(master, 'run#1', Commands([['run', '$<in']]), pool=pool))
+  bsets = {}
+  for name, inputs in edges.items():
+    bset = BuildSet(master)
+    bset.add_input_files('in', [str(tmpdir.join(x)) for x in inputs])
+    bset.add_output_files('out', [str(tmpdir.join(name))])
+    bsets[name] = op.add_build_set(bset)
+  return bsets
+
+
+#  a -> b -> d
+#  a -> c ----^
+#  e
+EDGES = {'a': [], 'b': ['a'], 'c': ['a'], 'd': ['b', 'c'], 'e': []}
+
+
+def test_levels(tmpdir):
+  bsets = make_graph(tmpdir, EDGES)
+  schedule = Schedule([bsets['d'], bsets['e']])
+  names = {v: k for k, v in bsets.items()}
+  assert [sorted(names[x] for x in level) for level in schedule.levels()] == \
+      [['a', 'e'], ['b', 'c'], ['d']]
+  assert [schedule.level(bsets[x]) for x in 'abcde'] == [0, 1, 1, 2, 0]
+  assert len(Schedule([bsets['b']])) == 2
+
+
+def test_critical_path_and_slack(tmpdir):
+  bsets = make_graph(tmpdir, EDGES)
+  durations = {bsets['a']: 1, bsets['b']: 5, bsets['c']: 2, bsets['d']: 1, bsets['e']: 3}
+  schedule = Schedule(bsets.values(), durations)
+  assert schedule.makespan == 7
+  assert schedule.critical_path() == [bsets['a'], bsets['b'], bsets['d']]
+  assert [schedule.slack(bsets[x]) for x in 'abcde'] == [0, 0, 3, 0, 4]
+  assert schedule.remaining(bsets['a']) == 7
+
+
+def test_ready_queue(tmpdir):
+  bsets = make_graph(tmpdir, EDGES)
+  durations = {bsets['e']: 10}
+  queue = Schedule(bsets.values(), durations).ready_queue()
+  assert queue.pop() is bsets['e']
+  assert queue.pop() is bsets['a']
+  assert queue.pop() is None
+  queue.done(bsets['a'])
+  ready = {queue.pop(), queue.pop()}
+  assert ready == {bsets['b'], bsets['c']}
+  assert queue.pop() is None
+  queue.done(bsets['b'])
+  assert not queue.has_ready()
+  queue.done(bsets['c'])
+  assert queue.pop() is bsets['d']
+  queue.done(bsets['d'])
+  assert queue
+  queue.done(bsets['e'])
+  assert not queue
+
+
+def test_ready_queue_failed(tmpdir):
+  bsets = make_graph(tmpdir, EDGES)
+  queue = Schedule(bsets.values()).ready_queue()
+  ready = {queue.pop(), queue.pop()}
+  assert ready == {bsets['a'], bsets['e']}
+  queue.failed(bsets['a'])
+  queue.done(bsets['e'])
+  assert queue.pop() is None
+  assert queue.running == 0
+  assert queue
+
+
+def test_ready_queue_pools(tmpdir):
+  bsets = make_graph(tmpdir, {'a': [], 'b': [], 'c': [], 'd': ['a']}, pool='link')
+  queue = Schedule(bsets.values()).ready_queue({'link': 2})
+  first = queue.pop(), queue.pop()
+  assert None not in first
+  assert not queue.has_ready()
+  assert queue.pop() is None
+  queue.done(first[0])
+  third = queue.pop()
+  assert third is not None
+  assert queue.pop() is None
+  for bset in (first[1], third):
+    queue.done(bset)
+  last = queue.pop()
+  assert {last, third, *first} == set(bsets.values())
+  assert queue.running == 1
+  queue.done(last)
+  assert not queue
+
+  # Pools without a depth are not limited.
+  queue = Schedule(bsets.values()).ready_queue({'other': 1})
+  assert None not in (queue.pop(), queue.pop(), queue.pop())
+
+
+def test_cycle(tmpdir):
+  bsets = make_graph(tmpdir, {'a': ['c'], 'b': ['a'], 'c': ['b'], 'd': ['c']})
+  with pytest.raises(CycleError) as excinfo:
+    Schedule([bsets['d']])
+  chain = excinfo.value.chain
+  assert sorted(chain, key=id) == sorted([bsets['a'], bsets['b'], bsets['c']], key=id)
+  for prev, bset in zip(chain, chain[1:] + chain[:1]):
+    assert prev in bset.get_input_build_sets()
@@ -36,3 +36,75 @@ class TestCompiler:
     assert t._parts[1].name == 'prefix'
     assert t._parts[2].type == '<'
     assert t._parts[2].name == 'srcs'
+
+
+class TestCache:
+
+  def test_compiled_templates_are_shared(self):
+    compiler = TemplateCompiler()
+    assert compiler.compile('foo $bar') is TemplateCompiler().compile('foo $bar')
+    assert compiler.compile_list(['a', '$<b']) is compiler.compile_list(('a', '$<b'))
+    assert compiler.compile('foo $bar') is not compiler.compile('foo $baz')
+
+  def test_render_cached(self):
+    t = TemplateCompiler().compile_list(['-o', '$@out', '-I${<inc}', '$flags'])
+    assert t.render({'inc': ['a', 'b']}, {'out': ['x']}, {'flags': ['-g']}) == \
+        ['-o', 'x', '-Ia', '-Ib', '-g']
+    assert t.render({'inc': []}, {'out': ['y']}, {'flags': '-O2'}) == \
+        ['-o', 'y', '-O2']
+
+
+def _outcome(func, *args):
+  try:
+    return func(*args)
+  except (KeyError, ValueError, AssertionError) as exc:
+    return type(exc)
+
+
+class TestFastRender:
+
+  TEMPLATES = [
+    '', 'foo', '$x', '${x}', 'a$x', '${x}b', 'a${x}b', '$x$y', 'a${x}b${y}c',
+    '$<in', '$@out', '-I${<in}', '${<in}.o', 'x${<in}y', '$x${<in}$y',
+    '--${x}=${@out}', '$<missing', '$missing', '$x$<in$y$z',
+  ]
+
+  INPUTS = {'in': ['a.c', 'b.c']}
+  OUTPUTS = {'out': ['a.o']}
+
+  VARIABLES = [
+    {'x': 'X', 'y': 'Y', 'z': 'Z'},
+    {'x': ['x1', 'x2'], 'y': 'Y', 'z': 'Z'},
+    {'x': 'X', 'y': ('y1',), 'z': ['z1', 'z2']},
+    {'x': [], 'y': 1, 'z': 2.5},
+    {'x': 42, 'y': ['y1'], 'z': []},
+  ]
+
+  @pytest.mark.parametrize('source', TEMPLATES)
+  def test_equivalence(self, source):
+    t = TemplateCompiler().compile(source)
+    for variables in self.VARIABLES:
+      for inputs in (self.INPUTS, {'in': []}):
+        args = (inputs, self.OUTPUTS, variables)
+        assert _outcome(t.render, *args) == _outcome(t._render_generic, *args)
+        assert _outcome(t.render, *args, True) == _outcome(t._render_generic, *args, True)
+
+  def test_sequence_before_missing_file_set(self):
+    # The sequence is found before the missing file set, like in the
+    # generic implementation.
+    t = TemplateCompiler().compile('$v${<src}')
+    with pytest.raises(ValueError):
+      t.render({}, {}, {'v': ['a', 'b']})
+    with pytest.raises(KeyError):
+      t.render({}, {}, {'v': 'a'})
+    t = TemplateCompiler().compile('${<src}$v')
+    with pytest.raises(KeyError):
+      t.render({}, {}, {'v': ['a', 'b']})
+
+  def test_equivalence_list(self):
+    t = TemplateCompiler().compile_list(self.TEMPLATES[:-3])
+    args = (self.INPUTS, self.OUTPUTS, self.VARIABLES[0])
+    expected = []
+    for x in t._templates:
+      expected += x._render_generic(*args)
+    assert t.render(*args) == expected
@@ -0,0 +1,152 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+import time
+
+from craftr import daemon
+
+pytestmark = pytest.mark.skipif(not daemon.is_supported(),
+  reason='the daemon is not supported on this platform')
+
+BUILD_SCRIPT = '''
+import * from 'craftr'
+project('test', '1.0-0')
+
+for name in {names!r}:
+  target(name)
+  operator('copy', commands=[{command!r}])
+  build_set({{'in': 'in.txt'}}, {{'out': path.join(session.build_directory, name + '.txt')}})
+'''
+
+
+# Copies the input file and appends the additional arguments.
+APPEND_SCRIPT = '''
+import sys
+with open(sys.argv[1]) as src, open(sys.argv[2], 'w') as dst:
+  dst.write(' '.join([src.read()] + sys.argv[3:]))
+'''
+
+
+class Project:
+
+  def __init__(self, tmpdir, backend='python'):
+    self.dir = tmpdir
+    self.dir.join('in.txt').write('hello')
+    self.backend = backend
+
+  def configure(self, *names, command=('cp', '$<in', '$@out')):
+    self.dir.join('build.craftr').write(BUILD_SCRIPT.format(
+      names=list(names), command=list(command)))
+    self.craftr('-c', check=True)
+
+  def craftr(self, *args, check=False):
+    command = [sys.executable, '-m', 'craftr.main', '--backend', self.backend] + list(args)
+    proc = subprocess.run(command, cwd=str(self.dir), stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    if check:
+      assert proc.returncode == 0, proc.stdout + proc.stderr
+    return proc
+
+  def status(self):
+    sock = daemon._connect(daemon.get_address(str(self.dir.join('build', 'debug'))))
+    if sock is None:
+      return None
+    with sock:
+      return daemon._get_status(sock)
+
+  def output(self, name):
+    return self.dir.join('build', 'debug', name + '.txt')
+
+
+@pytest.fixture
+def project(tmpdir):
+  project = Project(tmpdir)
+  try:
+    yield project
+  finally:
+    project.craftr('--daemon', 'stop')
+
+
+def test_forward(project):
+  project.configure('a')
+  assert project.craftr('--daemon', 'start', check=True).stdout.startswith('note: started')
+  assert project.status()['requests'] == 0
+  project.craftr('-b', check=True)
+  assert project.output('a').read() == 'hello'
+  assert project.status()['requests'] == 1
+
+  # Invokations with a different configuration are not forwarded.
+  project.output('a').remove()
+  project.craftr('-b', '-Ofoo=bar', check=True)
+  assert project.output('a').read() == 'hello'
+  assert project.status()['requests'] == 1
+
+  proc = project.craftr('-b', 'nothing')
+  assert proc.returncode != 0
+  assert "no targets matched 'nothing'" in proc.stderr
+  assert project.status()['requests'] == 2
+
+  assert project.craftr('--daemon', 'stop', check=True).stdout.startswith('note: stopped')
+  assert project.status() is None
+  assert project.craftr('--daemon', 'status').returncode == 1
+
+
+def test_reload(project):
+  project.configure('a')
+  project.craftr('--daemon', 'start', check=True)
+  project.configure('a', 'b')
+  project.craftr('-b', 'b', check=True)
+  assert project.output('b').read() == 'hello'
+  assert not project.output('a').exists()
+  assert project.status()['requests'] == 1
+
+
+def test_idle_timeout(project):
+  project.configure('a')
+  project.craftr('--daemon', 'start', '--daemon-timeout', '0.5', check=True)
+  deadline = time.time() + 10
+  while project.status() is not None:
+    assert time.time() < deadline, 'the daemon did not shut down'
+    time.sleep(0.1)
+  assert not os.path.exists(daemon.get_address(str(project.dir.join('build', 'debug'))))
+
+
+@pytest.mark.skipif(not shutil.which('ninja'), reason='ninja is not installed')
+def test_additional_args(project):
+  # The build server of the Ninja backend serves the additional arguments
+  # of the invokation, not those that the daemon was started with.
+  project.backend = 'ninja'
+  project.dir.join('append.py').write(APPEND_SCRIPT)
+  project.configure('a', 'b', command=[sys.executable, 'append.py', '$<in', '$@out'])
+  project.craftr('--daemon', 'start', check=True)
+  project.craftr('-b', 'a@=via daemon', check=True)
+  assert project.output('a').read() == 'hello via daemon'
+  project.craftr('-b', 'b', check=True)
+  assert project.output('b').read() == 'hello'
+  assert project.status()['requests'] == 2
@@ -0,0 +1,91 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import pytest
+import shutil
+import subprocess
+import sys
+
+src_dir = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+BUILD_SCRIPT = '''
+import * from 'craftr'
+import sys
+project('test', '1.0-0')
+
+target('main')
+operator('cc', commands=[[sys.executable, 'cc.py', '$<in', '$@out']])
+build_set({'in': 'main.c'}, {'out': path.join(session.build_directory, 'main.o')},
+          depfile=path.join(session.build_directory, 'main.o.d'))
+
+target('other')
+operator('copy', commands=[[sys.executable, 'cc.py', '$<in', '$@out']])
+build_set({'in': 'other.c'}, {'out': path.join(session.build_directory, 'other.o')})
+'''
+
+# Copies the source file and writes a depfile that lists hdr.h.
+CC_SCRIPT = '''
+import sys
+src, out = sys.argv[1:]
+with open(src) as fp, open(out, 'w') as dst:
+  dst.write(fp.read())
+with open(out + '.d', 'w') as fp:
+  fp.write('{}: {} hdr.h\\n'.format(out, src))
+'''
+
+
+def craftr(tmpdir, backend, *args):
+  env = dict(os.environ, PYTHONPATH=src_dir + os.pathsep + os.environ.get('PYTHONPATH', ''))
+  command = [sys.executable, '-m', 'craftr.main', '--backend', backend] + list(args)
+  proc = subprocess.run(command, cwd=str(tmpdir), env=env, stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE, universal_newlines=True)
+  assert proc.returncode == 0, proc.stdout + proc.stderr
+  return proc
+
+
+@pytest.mark.parametrize('backend', [
+  'python',
+  pytest.param('ninja', marks=pytest.mark.skipif(
+    not shutil.which('ninja'), reason='ninja is not installed'))])
+def test_affected_discovered_deps(tmpdir, backend):
+  tmpdir.join('build.craftr').write(BUILD_SCRIPT)
+  tmpdir.join('cc.py').write(CC_SCRIPT)
+  for name in ('main.c', 'other.c', 'hdr.h'):
+    tmpdir.join(name).write(name)
+  craftr(tmpdir, backend, '-c')
+
+  # The header is only known after it has been discovered by a build.
+  proc = craftr(tmpdir, backend, '--affected', 'hdr.h')
+  assert proc.stdout == ''
+  assert 'warning: "hdr.h" is not a file of the build graph' in proc.stderr
+
+  craftr(tmpdir, backend, '-b')
+  proc = craftr(tmpdir, backend, '--affected', 'hdr.h')
+  assert proc.stdout == 'test@main\n'
+  assert proc.stderr == ''
+
+  proc = craftr(tmpdir, backend, '--affected', 'other.c', 'nonexistent.c')
+  assert proc.stdout == 'test@other\n'
+  assert 'warning: "nonexistent.c"' in proc.stderr
@@ -0,0 +1,210 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import pytest
+import subprocess
+import sys
+import time
+
+from craftr.core.build import BuildSet, Commands, Master, Operator, Target
+
+ninja_dir = os.path.join(os.path.dirname(__file__), '..', 'src', 'craftr',
+                         'stdlib', 'net.craftr.backend', 'ninja')
+sys.path.insert(0, ninja_dir)
+from build_server import BuildServer
+
+src_dir = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+
+COPY = 'import shutil, sys; shutil.copy(*sys.argv[1:3]); print("copied", *sys.argv[3:])'
+FAIL = 'import sys; print("out"); print("err", file=sys.stderr); sys.exit(3)'
+
+
+def make_master(tmpdir):
+  master = Master()
+  target = master.add_target(Target(master, 'scope@app'))
+  op = target.add_operator(Operator(master, 'copy#1',
+    Commands([[sys.executable, '-c', COPY, '$<in', '$@out']])))
+  bset = BuildSet(master)
+  bset.add_input_files('in', [str(tmpdir.join('a.txt'))])
+  bset.add_output_files('out', [str(tmpdir.join('build', 'sub', 'a.txt'))])
+  bset.additional_args = '--extra arg'
+  op.add_build_set(bset)
+  op = target.add_operator(Operator(master, 'fail#1',
+    Commands([[sys.executable, '-c', FAIL]])))
+  op.add_build_set(BuildSet(master))
+  tmpdir.join('a.txt').write('hello')
+  return master, bset.compute_hash()
+
+
+def make_server(tmpdir, workers=0):
+  master, bset_hash = make_master(tmpdir)
+  server = BuildServer(master, workers=workers)
+  server.hash = bset_hash
+  return server
+
+
+@pytest.fixture
+def server(tmpdir):
+  with make_server(tmpdir) as server:
+    yield server
+
+
+def run_client(server, script, *args, operator='copy#1', env=None):
+  env = dict(os.environ, **(env or {}))
+  env['CRAFTR_BUILD_SERVER'] = server.address()
+  env['PYTHONPATH'] = src_dir + os.pathsep + env.get('PYTHONPATH', '')
+  bset_hash = server.hash if operator == 'copy#1' else \
+      server._master.get_target('scope@app').operators[operator].build_sets[0].compute_hash()
+  tstart = time.perf_counter()
+  proc = subprocess.run(
+    [sys.executable, '-X', 'importtime', os.path.join(ninja_dir, script)] +
+    list(args) + ['scope@app', operator, '0', bset_hash],
+    env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    universal_newlines=True)
+  elapsed = time.perf_counter() - tstart
+  modules, stderr = set(), []
+  for line in proc.stderr.splitlines(True):
+    if line.startswith('import time:'):
+      modules.add(line.rpartition('|')[2].strip())
+    else:
+      stderr.append(line)
+  proc.stderr = ''.join(stderr)
+  return proc, modules, elapsed
+
+
+def test_action_client(server, tmpdir):
+  proc, modules, elapsed = run_client(server, 'action_client.py')
+  assert proc.returncode == 0, proc.stderr
+  assert tmpdir.join('build', 'sub', 'a.txt').read() == 'hello'
+  assert proc.stdout == 'copied --extra arg\n'
+  assert 'craftr.core.protocol' in modules
+  heavy = {'argparse', 'json', 'craftr.core.build', 'nr.fs', 'nr.stream'}
+  assert not modules & heavy
+  if os.name != 'nt':
+    assert 'subprocess' not in modules
+
+
+def test_action_client_hash_mismatch(server):
+  server.hash = 'nothing'
+  proc, _, _ = run_client(server, 'action_client.py')
+  assert proc.returncode == 1
+  assert 'hash inconsistency' in proc.stderr
+
+
+def test_startup_time(server):
+  # The clients exit after they received the build set because of the
+  # hash mismatch, so only the startup and the request are measured. Take
+  # the best of a few runs to reduce the noise of the measurement.
+  server.hash = 'nothing'
+  results = {}
+  for script in ('action_client.py', 'build_client.py'):
+    times, imports = [], 0
+    for _ in range(3):
+      proc, modules, elapsed = run_client(server, script)
+      assert proc.returncode == 1, proc.stderr
+      times.append(elapsed)
+      imports = len(modules)
+    results[script] = (min(times), imports)
+    print('{}: {:.1f} ms, {} modules imported'.format(script, min(times) * 1000, imports))
+  assert results['action_client.py'][1] < results['build_client.py'][1]
+  assert results['action_client.py'][0] < results['build_client.py'][0]
+
+
+class TestRemoteExecution:
+
+  remote = {'CRAFTR_REMOTE_EXEC': 'true'}
+
+  def test_run(self, tmpdir):
+    with make_server(tmpdir, workers=2) as server:
+      proc, modules, _ = run_client(server, 'action_client.py', env=self.remote)
+      assert proc.returncode == 0, proc.stderr
+      assert proc.stdout == 'copied --extra arg\n'
+      assert tmpdir.join('build', 'sub', 'a.txt').read() == 'hello'
+      assert 'subprocess' not in modules or os.name == 'nt'
+
+      proc, _, _ = run_client(server, 'action_client.py', operator='fail#1', env=self.remote)
+      assert proc.returncode == 3
+      assert proc.stdout == 'out\n'
+      assert proc.stderr.startswith('err\n')
+      assert 'fatal: "scope@app:fail#1" exited with code 3.' in proc.stderr
+
+      server.hash = 'nothing'
+      proc, _, _ = run_client(server, 'action_client.py', env=self.remote)
+      assert proc.returncode == 1
+      assert 'hash inconsistency' in proc.stderr
+
+  def test_concurrent(self, tmpdir):
+    with make_server(tmpdir, workers=2) as server:
+      env = dict(os.environ, CRAFTR_BUILD_SERVER=server.address(),
+                 CRAFTR_REMOTE_EXEC='true',
+                 PYTHONPATH=src_dir + os.pathsep + os.environ.get('PYTHONPATH', ''))
+      command = [sys.executable, os.path.join(ninja_dir, 'action_client.py'),
+                 'scope@app', 'copy#1', '0', server.hash]
+      procs = [subprocess.Popen(command, env=env, stdout=subprocess.PIPE) for _ in range(6)]
+      for proc in procs:
+        assert proc.communicate()[0] == b'copied --extra arg\n'
+        assert proc.returncode == 0
+
+  def test_dead_worker(self, tmpdir):
+    with make_server(tmpdir, workers=2) as server:
+      worker = server._pool.workers[-1]
+      worker.process.terminate()
+      worker.process.join()
+      for _ in range(2):
+        proc, _, _ = run_client(server, 'action_client.py', env=self.remote)
+        assert proc.returncode == 0, proc.stderr
+        assert proc.stdout == 'copied --extra arg\n'
+
+  def test_local(self, tmpdir):
+    with make_server(tmpdir) as server:
+      proc, _, _ = run_client(server, 'action_client.py', env=self.remote)
+      assert proc.returncode == 1
+      assert 'no worker processes' in proc.stderr
+      proc, _, _ = run_client(server, 'action_client.py', '--local', env=self.remote)
+      assert proc.returncode == 0, proc.stderr
+
+
+def test_action_index(tmpdir):
+  from craftr.core import actionindex, protocol
+  master, bset_hash = make_master(tmpdir)
+  index_file = str(tmpdir.join('actions.idx'))
+  actionindex.write(index_file, (
+    (op.target.id, op.name, i, protocol.Action.from_build_set(bset))
+    for op in master.all_operators() for i, bset in enumerate(op.build_sets)))
+
+  env = dict(os.environ, PYTHONPATH=src_dir + os.pathsep + os.environ.get('PYTHONPATH', ''))
+  env.pop('CRAFTR_BUILD_SERVER', None)
+  command = [sys.executable, os.path.join(ninja_dir, 'action_client.py'),
+             '--index', index_file, 'scope@app', 'copy#1']
+  proc = subprocess.run(command + ['0', bset_hash], env=env,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  assert proc.returncode == 0, proc.stderr
+  assert proc.stdout == b'copied\n'
+  assert tmpdir.join('build', 'sub', 'a.txt').read() == 'hello'
+
+  proc = subprocess.run(command + ['1', bset_hash], env=env,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  assert proc.returncode == 1
+  assert b'not found' in proc.stderr
@@ -0,0 +1,105 @@
+# -*- coding: utf8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2018  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import io
+import os
+import sys
+
+ninja_dir = os.path.join(os.path.dirname(__file__), '..', 'src', 'craftr',
+                         'stdlib', 'net.craftr.backend', 'ninja')
+sys.path.insert(0, ninja_dir)
+from ninja_syntax import Writer, escape_path
+
+GOLDEN_FILE = os.path.join(os.path.dirname(__file__), 'data', 'ninja_syntax.golden')
+
+
+def write_statements(writer):
+  writer.comment('This file was automatically generated by Craftr')
+  writer.comment('A long comment that has to be wrapped because it does not fit into a '
+                 'single line of the configured width, with-hyphens and/slashes.')
+  writer.newline()
+  writer.variable('builddir', '/build dir/debug')
+  writer.variable('flags', ['-O2', '', '-g', '-DNAME=$$value'])
+  writer.variable('nothing', None)
+  writer.pool('link_pool', 4)
+  writer.newline()
+  writer.rule('cc', '$python /path/to/action_client.py --index $action_index '
+              '$target $operator $index $hash', description='$build_description',
+              depfile='$out.d', generator=True, pool='console', restat=True,
+              rspfile='$out.rsp', rspfile_content='$in', deps='gcc')
+  writer.variable('msvc_deps_prefix', 'Note: including file:', indent=1)
+  writer.build('/build/a.o', 'cc', '/src/a.c')
+  writer.build(['/build/with space.o', '/build/c:colon.o'], 'cc',
+               ['/src/with space.c', '/src/dollar $ space.c', '/src/c:colon.c'],
+               implicit=['/src/header.h'], order_only='/build/stamp',
+               implicit_outputs=['/build/with space.d'],
+               variables={'target': 'scope@app', 'build_description': 'compile a file'})
+  writer.build(['out'], 'phony', variables=[('a', '1'), ('b', ['x', 'y'])])
+
+  # Link steps with many inputs that need to be wrapped, some with escaped
+  # spaces and runs of dollar signs close to the wrap position.
+  inputs = ['/build/obj/file_{}.o'.format(i) for i in range(300)]
+  inputs[10] = '/build/obj/a b c d e f g h i j k l m n o p q r s t u v w x y z.o'
+  inputs[20] = '$$$$ $$$ $$ $ /build/dollars.o'
+  inputs[30] = '/build/' + 'x' * 200 + '.o'
+  writer.build('/build/app', 'link', inputs, variables={'libs': ' '.join(inputs[:50])})
+  writer.build('/build/' + 'y' * 300, 'link', ['z' * 300, 'w' * 10])
+  writer.variable('key', '$ ' * 60, indent=1)
+  writer.variable('key', ' $' * 60, indent=2)
+
+  writer.newline()
+  writer.include('/build/rules.ninja')
+  writer.subninja('/build/build.ninja.d/scope.ninja')
+  writer.default(['/build/a.o', 'out'])
+  writer.default('/build/app')
+
+
+def render(width):
+  fp = io.StringIO()
+  writer = Writer(fp, width)
+  write_statements(writer)
+  writer.flush()
+  return fp.getvalue()
+
+
+def test_golden():
+  # The output of the original ninja_syntax.Writer.
+  with open(GOLDEN_FILE) as fp:
+    expected = fp.read().split('\n#####\n')
+  assert [render(w) for w in (78, 40, 9000)] == expected
+
+
+def test_escape_path():
+  assert escape_path('/a b/c:d/$ e') == '/a$ b/c$:d/$$$ e'
+
+
+def test_buffer():
+  fp = io.StringIO()
+  writer = Writer(fp, buffer_size=100)
+  for i in range(100):
+    writer.build('/build/{}.o'.format(i), 'cc', '/src/{}.c'.format(i))
+  writer.comment('not flushed')
+  assert fp.getvalue().count('\n') == 100
+  writer.flush()
+  assert fp.getvalue().count('\n') == 101